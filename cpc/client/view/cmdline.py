@@ -145,6 +145,26 @@ class CmdLine(object):
                 co.write("\n")
         return co.getvalue()
 
+    @staticmethod
+    def _listStats(co, stats, indent):
+        for key in sorted(stats.keys()):
+            val=stats[key]
+            if isinstance(val, dict):
+                co.write("%s%s:\n"%("  "*indent, key))
+                CmdLine._listStats(co, val, indent+1)
+            elif isinstance(val, float):
+                co.write("%s%s: %.3f\n"%("  "*indent, key, val))
+            else:
+                co.write("%s%s: %s\n"%("  "*indent, key, val))
+
+    @staticmethod
+    def listStats(messageStr):
+        stats=messageStr['message']
+        co=StringIO()
+        co.write("Server statistics:\n")
+        CmdLine._listStats(co, stats, 1)
+        return co.getvalue()
+
     @staticmethod
     def listProjects(messageStr):
         list=messageStr['message']
@@ -115,6 +115,18 @@ class Command(cpc.server.queue.cmdqueue.QueueableItem):
         self.env=env
         cpc.server.queue.cmdqueue.QueueableItem.__init__(self)
 
+    def getExecutableKey(self):
+        """Get the executable the command needs to run, as a hashable tuple
+           of (executable name, minimum version string, maximum version 
+           string)."""
+        minVersion=self.minVersion
+        if minVersion is not None:
+            minVersion=minVersion.getStr()
+        maxVersion=self.maxVersion
+        if maxVersion is not None:
+            maxVersion=maxVersion.getStr()
+        return (self.executable, minVersion, maxVersion)
+
     #def setTaskID(self, id):
     #    self.taskID=id
     def setTask(self, task):
@@ -196,6 +208,8 @@ class Command(cpc.server.queue.cmdqueue.QueueableItem):
             self.workerServer=workerServer
         else:
             self.workerServer=None
+        if self.task is not None:
+            self.task.markChanged()
 
     def getRunning(self):
         """Return whether the command is running."""
@@ -18,14 +18,34 @@
 
 
 import logging
+import threading
 
 import cpc.util
 import cpc.util.log
-import resource
+from cpc.command import resource
+from cpc.command.version import Version
 
 
 log=logging.getLogger(__name__)
 
+
+# The executable match cache: a dict of worker capability fingerprints
+# (see CommandWorkerMatcher.getFingerprint()) to dicts of 
+# (executable name, min. version, max. version) -> executable ID (or None).
+matchCache=dict()
+matchCacheLock=threading.Lock()
+# the maximum number of fingerprints to keep in the cache
+maxMatchCacheSize=1024
+
+def getMatchCache(fingerprint):
+    """Get the executable match cache dict for a worker fingerprint."""
+    with matchCacheLock:
+        if fingerprint not in matchCache:
+            if len(matchCache) >= maxMatchCacheSize:
+                matchCache.clear()
+            matchCache[fingerprint]=dict()
+        return matchCache[fingerprint]
+
 class CommandWorkerMatcher(object):
     """Object that stores information about a worker for the 
        matchCommandWorker() function that is used in queue.getUntil()"""
@@ -50,6 +70,17 @@ class CommandWorkerMatcher(object):
             self.used[rsrc.name]=resource.Resource(rsrc.name, 0)
         self.type=None
         self.depleted=False
+        self.execIDs=getMatchCache(self.getFingerprint())
+
+    def getFingerprint(self):
+        """Get a hashable description of the worker's capabilities as 
+           relevant for executable matching."""
+        exes=[ (exe.name, exe.platform, exe.version.getStr(), exe.getID())
+               for exe in self.executableList.executables ]
+        exes.sort()
+        return (self.usePlatform.getName(),
+                tuple([ platform.getName() for platform in self.platforms ]),
+                tuple(exes))
 
     def checkType(self, type):
         """Check whether the command type is the same as one used before in the
@@ -59,25 +90,51 @@ class CommandWorkerMatcher(object):
             return True
         return type == self.type
 
-    def getExecID(self, cmd):
-        """Check whether the worker has the right executable."""
+    def _findExecID(self, executable, minVersion, maxVersion):
+        """Find the ID of a matching executable (or None)."""
         # first try the usePlatform
-        
-        ret=self.executableList.find(cmd.executable, self.usePlatform,
-                                     cmd.minVersion, cmd.maxVersion)
+        ret=self.executableList.find(executable, self.usePlatform,
+                                     minVersion, maxVersion)
         if ret is not None:
             return ret.getID()
         for platform in self.platforms:
-            ret=self.executableList.find(cmd.executable, platform,
-                                         cmd.minVersion, cmd.maxVersion)
+            ret=self.executableList.find(executable, platform,
+                                         minVersion, maxVersion)
             if ret is not None:
                 return ret.getID()
         return None
 
-    def checkWorkerRequirements(self, cmd):
+    def getExecID(self, cmd):
+        """Check whether the worker has the right executable."""
+        key=cmd.getExecutableKey()
+        if key not in self.execIDs:
+            self.execIDs[key]=self._findExecID(cmd.executable, cmd.minVersion,
+                                               cmd.maxVersion)
+        return self.execIDs[key]
+
+    def getBucketExecID(self, bucketKey):
+        """Check whether the worker has the right executable for a command 
+           queue matching bucket. The first three elements of a bucket key
+           are the commands' executable key (see 
+           Command.getExecutableKey())."""
+        key=bucketKey[0:3]
+        if key not in self.execIDs:
+            (executable, minVersion, maxVersion)=key
+            if minVersion is not None:
+                minVersion=Version(minVersion)
+            if maxVersion is not None:
+                maxVersion=Version(maxVersion)
+            self.execIDs[key]=self._findExecID(executable, minVersion, 
+                                               maxVersion)
+        return self.execIDs[key]
+
+    def checkProject(self, project):
+        """Check whether the worker may run commands of a project."""
         #Check if worker is project dedicated
         if 'project' in self.workerReqDict:
-            name=cmd.getTask().getProject().getName()
+            if project is None:
+                return False
+            name=project.getName()
             reqName=self.workerReqDict['project']
             log.debug("Worker is dedicated to proj. %s, command belongs to %s"%
                       (reqName, name))
@@ -85,6 +142,9 @@ class CommandWorkerMatcher(object):
                 return False
         return True
 
+    def checkWorkerRequirements(self, cmd):
+        return self.checkProject(cmd.getTask().getProject())
+
     def checkAddResources(self, cmd):
         """Check whether a command falls within the current resource allocation
            and add its requirements to the used resources if it does.
@@ -132,8 +192,22 @@ class CommandWorkerMatcher(object):
     def getWork(self, cmdQueue):
         """Get work from a command queue until the worker is filled or there is
            no more work."""
-        return cmdQueue.getUntil(matchCommandWorker, self)
-
+        return cmdQueue.getUntilBuckets(matchBucketWorker, matchCommandWorker,
+                                        self)
+
+    def hasWork(self, cmdQueue):
+        """Check whether a command queue has commands with executables the
+           worker has, without taking them from the queue. Whether they fit
+           the worker's resources is not checked."""
+        return cmdQueue.hasBuckets(matchBucketWorker, self)
+
+
+def matchBucketWorker(matcher, bucketKey):
+    """Function to use in queue.getUntilBuckets() to select the command 
+       queue buckets a worker could run commands from."""
+    if matcher.getBucketExecID(bucketKey) is None:
+        return False
+    return matcher.checkProject(bucketKey[3])
 
 def matchCommandWorker(matcher, command):
     """Function to use in queue.getUntil() to get a number of commands from
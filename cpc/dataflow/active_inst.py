@@ -370,6 +370,14 @@ class ActiveInstance(value.ValueBase):
     def getTasks(self):
         """ Get the task list """
         return self.tasks
+
+    def getTaskCount(self):
+        """Get the number of tasks of this active instance and its internal
+           network."""
+        with self.inputLock:
+            ntasks=len(self.tasks)
+        ntasks += self.subnet.getTaskCount()
+        return ntasks
     def getInputs(self):
         """Get the input value object."""
         return self.inputVal
@@ -490,11 +498,21 @@ class ActiveInstance(value.ValueBase):
            property"""
         return self.subnet
 
+    def getActiveNetwork(self):
+        """Get the active network this active instance is a part of. Is a
+           constant property"""
+        return self.activeNetwork
+
+    def markChanged(self):
+        """Mark the state of this active instance as changed, so it will be
+           written out with the next project state save."""
+        self.project.getJournal().markInstance(self)
 
     def removeTask(self, task):
         """Remove a task from the list"""
         with self.inputLock:
            self.tasks.remove(task)
+        self.markChanged()
 
     def handleTaskOutput(self, sourceTag, seqNr, output, subnetOutput,
                          warnMsg):
@@ -555,6 +573,7 @@ class ActiveInstance(value.ValueBase):
         self.outputVal.setUpdated(False)
         self.subnetOutputVal.setUpdated(False)
         self.msg.setWarning(warnMsg)
+        self.markChanged()
 
     def handleNewInput(self, sourceTag, seqNr, noNewTasks=False):
         """Process new input based on the changing of values.
@@ -596,6 +615,8 @@ class ActiveInstance(value.ValueBase):
                                                     sourceTag, True)
             # now merge it with whether we should already update
             self.updated = self.updated or (upd1 or upd2)
+            if upd1 or upd2:
+                self.markChanged()
             if noNewTasks:
                 # don't set updated flag if it's not needed; noNewTasks
                 # is true when reading in current state, and setting updated
@@ -611,7 +632,7 @@ class ActiveInstance(value.ValueBase):
                 #           self.function.getName()))
                 # and make it run.
                 if self._canRun():
-                    self._genTask()
+                    self._genTask(task.Task.getSourceTaskClass(sourceTag))
             if upd1:
                 self.stagedInputVal.setUpdated(False)
                 self.inputVal.setUpdated(False)
@@ -704,8 +725,10 @@ class ActiveInstance(value.ValueBase):
                 tp=self.subnetOutputVal.getSubType(itemList)
         return tp
 
-    def activate(self):
-        """Set the state of this active instance to active, if held."""
+    def activate(self, sourceTag=None):
+        """Set the state of this active instance to active, if held.
+           sourceTag = the source of the activation: the transaction that
+                       created the instance, or None for user actions."""
         log.debug("Activating active instance %s of fn %s"%
                   (self.instance.getName(), self.function.getName()))
         changed=False
@@ -713,13 +736,14 @@ class ActiveInstance(value.ValueBase):
             with self.lock:
                 if self.state == ActiveInstance.held:
                     if self.subnet is not None:
-                        self.subnet.activateAll()
+                        self.subnet.activateAll(sourceTag)
                     self.state=ActiveInstance.active
                     changed=True
             if changed:
-                for task in self.tasks:
-                    task.activateCommands()
-                self._reactivate()
+                for tsk in self.tasks:
+                    tsk.activateCommands()
+                self._reactivate(task.Task.getSourceTaskClass(sourceTag))
+                self.markChanged()
         return changed
 
 
@@ -737,6 +761,8 @@ class ActiveInstance(value.ValueBase):
                     self.state=ActiveInstance.held
                     for task in self.tasks:
                         task.deactivateCommands()
+        if changed:
+            self.markChanged()
         return changed
 
     def unblock(self):
@@ -752,13 +778,15 @@ class ActiveInstance(value.ValueBase):
                     changed=True
             if changed:
                 self._reactivate()
+                self.markChanged()
 
-    def _reactivate(self):
-        """Check for new inputs, and run if there are any."""
+    def _reactivate(self, taskClass=task.Task.userClass):
+        """Check for new inputs, and run if there are any.
+           taskClass = the task class for any generated task."""
         if self.inputVal.hasUpdates() or self.subnetInputVal.hasUpdates():
             self.updated=True
         if self._canRun():
-            self._genTask()
+            self._genTask(taskClass)
 
     def cancelTasks(self, seqNr):
         """Cancel all tasks (and commands) with sequence number before
@@ -774,7 +802,9 @@ class ActiveInstance(value.ValueBase):
                         ret.extend(cmds)
                     task.cancel()
                     self.tasks.remove(task)
-            return ret
+        if len(ret) > 0:
+            self.markChanged()
+        return ret
 
     def _canRun(self):
         """Whether all inputs are there for the instance to be run.
@@ -787,8 +817,9 @@ class ActiveInstance(value.ValueBase):
             return ret
         return False
 
-    def _genTask(self):
-        """Generate a task.  Assumes self.inputLock is locked ."""
+    def _genTask(self, taskClass=task.Task.userClass):
+        """Generate a task.  Assumes self.inputLock is locked .
+           taskClass = the task's class for scheduling in the task queue."""
         # prepare inputs
         log.debug("Generating task for %s (of fn %s)"%
                   (self.getCanonicalName(), self.function.getName()))
@@ -827,15 +858,24 @@ class ActiveInstance(value.ValueBase):
                                      None, self.function, self, self.project)
         self.runSeqNr+=1
         tsk=task.Task(self.project, self, self.function, fnInput, 0,
-                      self.runSeqNr)
+                      self.runSeqNr, taskClass)
         self.activeNetwork.taskQueue.put(tsk)
         self.tasks.append(tsk)
         self.updated=False
+        self.markChanged()
 
     def addTask(self, tsk):
         """Append an existing task to the task list. Useful for reading in"""
         self.tasks.append(tsk)
 
+    def clearTasks(self):
+        """Remove all tasks from the task list, and return them. Useful for
+           reading in a newer state."""
+        with self.lock:
+            ret=self.tasks
+            self.tasks=[]
+        return ret
+
     def markError(self, msg, reportAsNew=True):
         """Mark active instance as being in error state.
 
@@ -851,12 +891,14 @@ class ActiveInstance(value.ValueBase):
                 log.error(u"Instance %s (fn %s): %s"%(self.instance.getName(),
                                                       self.function.getName(),
                                                       self.msg.getError()))
+        self.markChanged()
 
 
     def setWarning(self, msg):
         """Set warning message."""
         with self.lock:
             self.msg.setWarning(msg)
+        self.markChanged()
 
     def rerun(self, recursive, clearError, outf=None):
         """Force the rerun of this instance, or clear the error if in error
@@ -915,10 +957,12 @@ class ActiveInstance(value.ValueBase):
                     self._genTask()
                 else:
                     log.debug("Cannot do rerun on %s"%self.getCanonicalName())
+                self.markChanged()
         return ret
 
-    def writeXML(self, outf, indent=0):
-        """write out values as xml."""
+    def writeXML(self, outf, indent=0, recursive=True):
+        """write out values as xml.
+           recursive = whether to write out the subnet"""
         indstr=cpc.util.indStr*indent
         iindstr=cpc.util.indStr*(indent+1)
         with self.lock:
@@ -951,7 +995,7 @@ class ActiveInstance(value.ValueBase):
             self.subnetOutputVal.writeContentsXML(outf, indent+2)
             outf.write('%s</subnet-outputs>\n'%(iindstr))
 
-            if self.subnet is not None:
+            if recursive and self.subnet is not None:
                 self.subnet.writeXML(outf, indent+1)
             if len(self.tasks) > 0:
                 outf.write('%s<tasks>\n'%iindstr)
@@ -139,6 +139,8 @@ class ActiveNetwork(network.Network):
             log.debug("Adding active instance %s"%ai.name)
             self.activeInstances[name]=ai
             network.Network.addInstance(self, inst)
+        if not inst.isImplicit():
+            self.project.getJournal().addInstance(self, inst)
         return ai
 
     #def removeInstance(self, instance):
@@ -373,12 +375,16 @@ class ActiveNetwork(network.Network):
                 #          (conn.dstAcp.value.getFullName(), val.value))
                 conn.dstAcp.update(val, sourceTag, None)
                 conn.dstAcp.propagate(sourceTag, None)
+        if not conn.isImplicit():
+            self.project.getJournal().addConnection(self, conn)
 
-    def activateAll(self):
-        """Activate all activeinstances in this network, starting them."""
+    def activateAll(self, sourceTag=None):
+        """Activate all activeinstances in this network, starting them.
+           sourceTag = the source of the activation (see activate() of 
+                       ActiveInstance)"""
         with self.lock:
             for inst in self.activeInstances.itervalues():
-                inst.activate()
+                inst.activate(sourceTag)
 
     def deactivateAll(self):
         """De-activate all activeinstances in this network, starting them."""
@@ -405,6 +411,15 @@ class ActiveNetwork(network.Network):
                 cputime += ai.getCumulativeCputime()
         return cputime
 
+    def getTaskCount(self):
+        """Get the number of tasks of all active instances in this network
+           and all subnets."""
+        ntasks=0
+        with self.lock:
+            for ai in self.activeInstances.itervalues():
+                ntasks += ai.getTaskCount()
+        return ntasks
+
     def findErrorStates(self, errlist, warnlist):
         """Find any error states associated with this any of the
            sub-instances. Fill errlist & warnlist with active instances in
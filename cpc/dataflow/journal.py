@@ -0,0 +1,415 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import logging
+import os
+import threading
+import xml.sax
+import xml.sax.saxutils
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from cpc.util.ordered_dict import OrderedDict
+
+
+import cpc.util
+import cpc.util.rng
+import apperror
+import keywords
+import readxml
+
+log=logging.getLogger(__name__)
+
+curVersion=1
+
+class StateJournal(object):
+    """The state journal of a project: an append-only file (_state.journal)
+       with the changes to the project state since the last full state
+       snapshot (_state.xml) was written.
+
+       Each journal entry describes a change in a single active network:
+       a new instance, a new connection, or the new state of an active
+       instance (written without its subnet). Both the snapshot and the
+       journal carry a snapshot ID, so that a journal that belongs to an
+       older snapshot is never replayed."""
+    def __init__(self, project, basedir, maxSize):
+        """Initialize an empty journal.
+
+           project = the project this journal belongs to
+           basedir = the project's base directory
+           maxSize = the journal size in bytes above which it is compacted
+                     into a new snapshot."""
+        self.project=project
+        self.filename=os.path.join(basedir, "_state.journal")
+        self.maxSize=maxSize
+        # protects the list of pending changes
+        self.lock=threading.Lock()
+        # serializes journal appends and snapshots
+        self.writeLock=threading.Lock()
+        self.snapshotID=None
+        self.needSnapshot=True
+        self.size=0
+        # the change generation: incremented with every change
+        self.generation=0
+        # the generation at the last save (snapshot or journal write)
+        self.savedGeneration=0
+        # the generation at the last snapshot, or None if the last snapshot
+        # is out of date.
+        self.snapshotGeneration=None
+        self.newSnapshotGeneration=None
+        self._clear()
+
+    def _clear(self):
+        """Clear the pending changes. Assumes self.lock is locked."""
+        # lists of (active network, instance) and (active network, connection)
+        self.newInstances=[]
+        self.newConnections=[]
+        # the active instances with changed state
+        self.changedInstances=OrderedDict()
+
+    def addInstance(self, activeNetwork, inst):
+        """Note the addition of a new (explicit) instance to an active
+           network."""
+        with self.lock:
+            self.newInstances.append( (activeNetwork, inst) )
+            self.generation+=1
+
+    def addConnection(self, activeNetwork, conn):
+        """Note the addition of a new (explicit) connection to an active
+           network."""
+        with self.lock:
+            self.newConnections.append( (activeNetwork, conn) )
+            self.generation+=1
+
+    def markInstance(self, ai):
+        """Note a change in the state of an active instance."""
+        with self.lock:
+            self.changedInstances[ai]=True
+            self.generation+=1
+
+    def markSnapshotNeeded(self):
+        """Note a change that can't be journaled (such as a new import), and
+           that requires a new snapshot to be written."""
+        with self.lock:
+            self.needSnapshot=True
+            self.generation+=1
+
+    def isChanged(self):
+        """Whether there are any changes since the last save."""
+        with self.lock:
+            return self.needSnapshot or self.generation != self.savedGeneration
+
+    def isSnapshotCurrent(self):
+        """Whether the last snapshot describes the current state, without
+           the need for the journal."""
+        with self.lock:
+            return ( (not self.needSnapshot) and
+                     self.snapshotGeneration == self.generation )
+
+    def needsSnapshot(self):
+        """Whether the next save should be a full snapshot."""
+        with self.lock:
+            return self.needSnapshot or self.size > self.maxSize
+
+    def getFilename(self):
+        """Get the file name of the journal."""
+        return self.filename
+
+    def getSnapshotID(self):
+        """Get the ID of the snapshot the journal currently belongs to."""
+        with self.lock:
+            return self.snapshotID
+
+    def reset(self, snapshotID, snapshotCurrent=False):
+        """Reset the journal after the project state has been read in.
+
+           snapshotID = the ID of the snapshot that the journal file belongs
+                        to, or None if it can't be appended to.
+           snapshotCurrent = whether the snapshot describes the full state
+                             (i.e. the journal was empty)"""
+        with self.lock:
+            self._clear()
+            self.snapshotID=snapshotID
+            self.needSnapshot=(snapshotID is None)
+            self.savedGeneration=self.generation
+            if snapshotCurrent:
+                self.snapshotGeneration=self.generation
+            else:
+                self.snapshotGeneration=None
+            if snapshotID is not None:
+                self.size=os.path.getsize(self.filename)
+            else:
+                self.size=0
+
+    def beginSnapshot(self):
+        """Start writing a new snapshot: all pending changes will be part of
+           it. Assumes that self.writeLock is locked.
+           Returns the new snapshot ID."""
+        with self.lock:
+            self._clear()
+            self.needSnapshot=False
+            self.newSnapshotGeneration=self.generation
+            return cpc.util.rng.getRandomHash()
+
+    def abortSnapshot(self):
+        """Mark that writing a snapshot failed. Assumes that self.writeLock
+           is locked."""
+        with self.lock:
+            self.needSnapshot=True
+
+    def endSnapshot(self, snapshotID):
+        """Finish writing a snapshot by starting a new, empty journal for it.
+           Assumes that self.writeLock is locked."""
+        header=('<?xml version="1.0"?>\n<journal version="%d" snapshot="%s">\n'%
+                (curVersion, snapshotID))
+        outf=open(self.filename, 'w')
+        try:
+            outf.write(header)
+        finally:
+            outf.close()
+        with self.lock:
+            self.snapshotID=snapshotID
+            self.size=len(header)
+            self.savedGeneration=self.newSnapshotGeneration
+            self.snapshotGeneration=self.newSnapshotGeneration
+
+    def write(self):
+        """Append all pending changes to the journal, unless a new snapshot
+           is needed. The changes are rendered with the project's update
+           lock held, so that an entry never mixes states from before and 
+           after a transaction, just like in a snapshot (see 
+           Project.writeState()).
+           Returns the number of bytes written."""
+        # the same lock order as in Project.writeState()
+        self.project.updateLock.acquire()
+        updateLocked=True
+        try:
+            with self.writeLock:
+                with self.lock:
+                    if self.needSnapshot or self.snapshotID is None:
+                        return 0
+                    newInstances=self.newInstances
+                    newConnections=self.newConnections
+                    changedInstances=self.changedInstances
+                    generation=self.generation
+                    self._clear()
+                if (len(newInstances) == 0 and len(newConnections) == 0 and
+                    len(changedInstances) == 0):
+                    with self.lock:
+                        self.savedGeneration=generation
+                    return 0
+                co=StringIO()
+                for net, inst in newInstances:
+                    self._beginEntry(co, net)
+                    inst.writeXML(co, 1)
+                    co.write('</entry>\n')
+                for net, conn in newConnections:
+                    self._beginEntry(co, net)
+                    conn.writeXML(co, 1)
+                    co.write('</entry>\n')
+                for ai in changedInstances.iterkeys():
+                    self._beginEntry(co, ai.getActiveNetwork())
+                    ai.writeXML(co, 1, recursive=False)
+                    co.write('</entry>\n')
+                data=co.getvalue()
+                # the entries are rendered: transactions can continue while
+                # they are appended. The write lock keeps the appends in 
+                # order.
+                self.project.updateLock.release()
+                updateLocked=False
+                try:
+                    outf=open(self.filename, 'a')
+                    try:
+                        outf.write(data)
+                    finally:
+                        outf.close()
+                except:
+                    # the pending changes are lost: only a snapshot can 
+                    # recover
+                    self.markSnapshotNeeded()
+                    raise
+                with self.lock:
+                    self.size+=len(data)
+                    self.savedGeneration=generation
+                return len(data)
+        finally:
+            if updateLocked:
+                self.project.updateLock.release()
+
+    def _beginEntry(self, outf, activeNetwork):
+        """Start a journal entry for a change in an active network."""
+        parent=activeNetwork.getParentInstance()
+        if parent is not None:
+            netName=parent.getCanonicalName()
+        else:
+            netName=""
+        outf.write('<entry network=%s>\n'%
+                   xml.sax.saxutils.quoteattr(netName).encode('utf-8'))
+
+    def read(self, snapshotID, taskList):
+        """Replay the journal on top of the snapshot that has just been read,
+           and reset the journal.
+
+           snapshotID = the ID of that snapshot
+           taskList = the list of tasks read from the snapshot
+           Returns the updated list of tasks."""
+        if snapshotID is None or not os.path.exists(self.filename):
+            self.reset(None)
+            return taskList
+        reader=JournalReader(self.project, snapshotID, taskList)
+        reader.read(self.filename)
+        log.debug("Replayed %d journal entries for project %s"%
+                  (reader.getEntryCount(), self.project.getName()))
+        if reader.canAppend():
+            self.reset(snapshotID, reader.getEntryCount() == 0)
+        else:
+            self.reset(None)
+        return reader.getTaskList()
+
+
+class JournalSnapshotMismatch(Exception):
+    """Raised to stop reading a journal that belongs to another snapshot."""
+    pass
+
+class JournalReader(readxml.ProjectXMLReader):
+    """Reader that replays a project's state journal."""
+    entryEnd='</entry>\n'
+
+    def __init__(self, project, snapshotID, taskList):
+        """Initialize based on the project the journal belongs to.
+
+           project = the project
+           snapshotID = the ID of the snapshot that was read
+           taskList = the list of tasks read from the snapshot"""
+        readxml.ProjectXMLReader.__init__(self, project.getTopLevelLib(),
+                                          project.getImportList(), project)
+        self.snapshotID=snapshotID
+        self.taskList=list(taskList)
+        self.nEntries=0
+        # whether the journal belongs to the snapshot
+        self.matched=False
+        # whether the journal ends with an incomplete entry
+        self.torn=False
+
+    def getEntryCount(self):
+        return self.nEntries
+
+    def canAppend(self):
+        """Whether new entries can be appended to the journal: it must belong
+           to the snapshot that was read, and be complete."""
+        return self.matched and not self.torn
+
+    def read(self, filename):
+        """Read and replay the journal."""
+        self.filename=filename
+        self.dirName=None
+        self.loc=None
+        parser=xml.sax.make_parser()
+        parser.setContentHandler(self)
+        inf=open(filename, 'r')
+        try:
+            data=inf.read()
+        finally:
+            inf.close()
+        # only replay complete entries: the last one may have been cut off
+        # by a crash while it was being written.
+        end=data.rfind(self.entryEnd)
+        if end >= 0:
+            end+=len(self.entryEnd)
+        else:
+            # there are no entries: only check the header
+            start=data.find('<journal')
+            if start < 0:
+                return
+            end=data.find('>\n', start)
+            if end < 0:
+                return
+            end+=len('>\n')
+        if end < len(data):
+            self.torn=True
+            log.warning("Ignoring incomplete last entry of state journal %s"%
+                        filename)
+        try:
+            # the journal is never closed while it's being written to.
+            parser.feed(data[:end])
+            parser.feed('</journal>\n')
+            parser.close()
+        except JournalSnapshotMismatch:
+            log.info("Ignoring state journal %s: it belongs to another snapshot"%
+                     filename)
+            return
+        except xml.sax.SAXParseException as e:
+            raise readxml.ProjectXMLError("Corrupt state journal: %s"%str(e),
+                                          self)
+        except readxml.ProjectXMLError as e:
+            raise e
+        except apperror.ApplicationError as e:
+            raise readxml.ProjectXMLError(str(e), self)
+        for ai in self.affectedInputAIs:
+            ai.handleNewInput(self, None, noNewTasks=True)
+
+    def startElement(self, name, attrs):
+        if name == "journal":
+            if attrs.has_key('version'):
+                if int(attrs.getValue('version')) > curVersion:
+                    raise readxml.ProjectXMLError(
+                                        "Can't read journal from the future.",
+                                        self)
+            if (not attrs.has_key('snapshot') or
+                attrs.getValue('snapshot') != self.snapshotID):
+                raise JournalSnapshotMismatch()
+            self.matched=True
+        elif name == "entry":
+            if not attrs.has_key('network'):
+                raise readxml.ProjectXMLError("journal entry has no network",
+                                              self)
+            netName=attrs.getValue('network')
+            if netName == "":
+                net=self.project.network
+            else:
+                net=self.project.network.getNamedActiveInstance(netName).\
+                        getNet()
+            self.networkStack.append(net)
+            self.network=net
+        else:
+            if (name == "active" and self.activeInst is None and
+                self.valueReader is None and self.cmdReader is None and
+                self.fnInputReader is None):
+                # the entry replaces the active instance's tasks
+                ai=self.network.getActiveInstance(
+                                        keywords.fixID(attrs.getValue("id")))
+                for tsk in ai.clearTasks():
+                    if tsk in self.taskList:
+                        self.taskList.remove(tsk)
+            readxml.ProjectXMLReader.startElement(self, name, attrs)
+
+    def endElement(self, name):
+        if name == "journal":
+            pass
+        elif name == "entry":
+            self.networkStack.pop()
+            self.network=None
+            self.nEntries+=1
+        else:
+            readxml.ProjectXMLReader.endElement(self, name)
@@ -48,6 +48,7 @@ import task
 import transaction
 import lib
 import readxml
+import journal
 from cpc.dataflow.value import ValError
 
 log=logging.getLogger(__name__)
@@ -84,6 +85,9 @@ class Project(object):
         else:
             self.queue=queue
         self.cmdQueue=cmdQueue
+        # the journal of state changes since the last state snapshot
+        self.journal=journal.StateJournal(self, basedir,
+                                          conf.getStateJournalMaxSize())
         # the file list
         self.fileList=value.FileList(basedir)
         # create the active network (the top-level network)
@@ -123,6 +127,10 @@ class Project(object):
                 self.inputNr+=1
         return newsub
 
+    def getJournal(self):
+        """Get the state journal. This is a const property"""
+        return self.journal
+
     def getFileList(self):
         """Get the project's file list. This pointer is a const property,
            and the file list has its own locking mechanism."""
@@ -455,6 +463,8 @@ class Project(object):
             reader=readxml.ProjectXMLReader(self.topLevelImport, self.imports,
                                             self)
             reader.readFile(fileObject, filename)
+            # new function definitions can't be journaled
+            self.journal.markSnapshotNeeded()
 
     def importName(self, name):
         """Import a named module."""
@@ -482,6 +492,7 @@ class Project(object):
                 reader=readxml.ProjectXMLReader(newlib, self.imports, self)
                 reader.read(filename)
                 self.imports.add(newlib)
+                self.journal.markSnapshotNeeded()
                 return newlib
             else:
                 return self.imports.get(name)
@@ -546,12 +557,17 @@ class Project(object):
         """Get the task queue."""
         return self.queue
 
-    def writeXML(self, outf, indent=0):
+    def writeXML(self, outf, indent=0, snapshotID=None):
         """Write the function definitions and top-level network description
-           in XML to outf."""
+           in XML to outf.
+           snapshotID = an optional state snapshot ID to write out"""
         indstr=cpc.util.indStr*indent
         iindstr=cpc.util.indStr*(indent+1)
-        outf.write('%s<cpc version="%d">\n'%(indstr, readxml.curVersion))
+        if snapshotID is None:
+            outf.write('%s<cpc version="%d">\n'%(indstr, readxml.curVersion))
+        else:
+            outf.write('%s<cpc version="%d" snapshot="%s">\n'%
+                       (indstr, readxml.curVersion, snapshotID))
         for name in self.imports.getLibNames():
             outf.write('%s<import name="%s" />\n'%(iindstr,name))
         outf.write('\n')
@@ -563,7 +579,22 @@ class Project(object):
            XML file."""
         outFile.write('  <cpc-project id="%s" dir=""/>\n'%(self.name))
 
-    def readState(self,stateFile="_state.xml"):
+    def getStateFilename(self):
+        """Get the full file name of the current state snapshot, or None if
+           there is no snapshot."""
+        fname=os.path.join(self.basedir, "_state.xml")
+        if os.path.exists(fname):
+            return fname
+        return None
+
+    def readState(self, stateFile="_state.xml", runningCmdList=None):
+        """Read the project state: the state snapshot and, if the default
+           state file is read, the journal of changes since that snapshot.
+
+           stateFile = the state file to read
+           runningCmdList = an optional running command list that takes the
+                            commands that were running when the state was
+                            saved. Other commands are queued."""
         fname=os.path.join(self.basedir, stateFile)
         if os.path.exists(fname):
             log.debug("Importing project state from %s"%fname)
@@ -573,6 +604,10 @@ class Project(object):
                                                 self)
                 reader.readFile(fname, fname)
                 tasks=reader.getTaskList()
+                if stateFile == "_state.xml":
+                    tasks=self.journal.read(reader.getSnapshotID(), tasks)
+                else:
+                    self.journal.reset(None)
                 for tsk in tasks:
                     cmds=tsk.getCommands()
                     if len(cmds) < 1:
@@ -581,20 +616,60 @@ class Project(object):
                     else:
                         log.debug("Queuing command")
                         for cmd in cmds:
-                            self.cmdQueue.add(cmd)
+                            if ( runningCmdList is None or
+                                 not runningCmdList.restore(cmd) ):
+                                self.cmdQueue.add(cmd)
 
 
+    def getTaskCount(self):
+        """Get the number of tasks (queued or with queued or running
+           commands) in the project."""
+        return self.network.getTaskCount()
+
+    def isChanged(self):
+        """Whether the project state has changed since it was last saved."""
+        return self.journal.isChanged()
+
+    def isSnapshotCurrent(self):
+        """Whether the project's last state snapshot is up to date."""
+        return self.journal.isSnapshotCurrent()
+
     def writeState(self):
+        """Write a full state snapshot, and start a new state journal.
+           Returns the number of bytes written."""
         with self.updateLock:
-            fname=os.path.join(self.basedir, "_state.xml")
-            nfname=os.path.join(self.basedir, "_state.xml.new")
-            fout=open(nfname, 'w')
-            fout.write('<?xml version="1.0"?>\n')
-            self.writeXML(fout, 0)
-            fout.close()
-            # now we use POSIX file renaming  atomicity to make sure the state
-            # is always a consistent file.
-            os.rename(nfname, fname)
+            with self.journal.writeLock:
+                snapshotID=self.journal.beginSnapshot()
+                try:
+                    fname=os.path.join(self.basedir, "_state.xml")
+                    nfname=os.path.join(self.basedir, "_state.xml.new")
+                    fout=open(nfname, 'w')
+                    fout.write('<?xml version="1.0"?>\n')
+                    self.writeXML(fout, 0, snapshotID)
+                    ret=fout.tell()
+                    fout.close()
+                    # now we use POSIX file renaming  atomicity to make sure
+                    # the state is always a consistent file.
+                    os.rename(nfname, fname)
+                    # the old journal no longer matches the snapshot, so a
+                    # crash at this point is harmless.
+                    self.journal.endSnapshot(snapshotID)
+                except:
+                    self.journal.abortSnapshot()
+                    raise
+        return ret
+
+    def saveState(self):
+        """Save the changes to the project state since the last save: as a
+           new state snapshot if one is needed, or otherwise by appending them
+           to the state journal.
+           Returns the number of bytes written."""
+        if not self.journal.isChanged():
+            return 0
+        if self.journal.needsSnapshot():
+            return self.writeState()
+        else:
+            return self.journal.write()
 
     ########################################################
     # Member functions from the ValueBase interface:
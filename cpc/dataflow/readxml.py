@@ -102,6 +102,7 @@ class ProjectXMLReader(xml.sax.handler.ContentHandler):
         self.curValue=None
         self.taskList=[]
         self.fileVersion=None
+        self.snapshotID=None
         self.descReader=None # the description reader
         self.descReaderEndTag=None
         self.descContext=None # a describable context
@@ -113,6 +114,10 @@ class ProjectXMLReader(xml.sax.handler.ContentHandler):
     def getTaskList(self):
         return self.taskList
 
+    def getSnapshotID(self):
+        """Get the ID of the state snapshot that was read, if any."""
+        return self.snapshotID
+
     def setDocumentLocator(self, locator):
         #log.debug("Setting main locator")
         if self.fnInputReader is not None:
@@ -215,6 +220,8 @@ class ProjectXMLReader(xml.sax.handler.ContentHandler):
                 self.fileVersion=0
             if self.fileVersion > curVersion:
                 raise ProjectXMLError("Can't read file from the future.")
+            if attrs.has_key('snapshot'):
+                self.snapshotID=attrs.getValue('snapshot')
         elif name == "import":
             if not attrs.has_key('name'):
                 raise ProjectXMLError("import has no name", self)
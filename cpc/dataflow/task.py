@@ -23,11 +23,16 @@ try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
-import Queue
 import traceback
 import sys
 import os
 import threading
+import time
+from collections import deque
+try:
+    from collections import OrderedDict
+except ImportError:
+    from cpc.util.ordered_dict import OrderedDict
 
 
 import cpc.util
@@ -48,34 +53,218 @@ class TaskNoNetError(TaskError):
         self.str=("Trying to add new instance in instance %s without subnet"%
                   name)
 
+class TaskQueueClassStats(object):
+    """Statistics for a single task class in the task queue."""
+    def __init__(self):
+        self.nPut=0 # the number of tasks put in the queue
+        self.nGet=0 # the number of tasks taken from the queue
+        self.totalWait=0. # the total time tasks spent waiting in the queue
+        self.maxWait=0. # the maximum time a task spent waiting in the queue
+
+    def addWait(self, wait):
+        """Account for a task taken out of the queue after wait seconds."""
+        self.nGet+=1
+        self.totalWait+=wait
+        if wait > self.maxWait:
+            self.maxWait=wait
+
+    def toJSON(self):
+        ret=dict()
+        ret['put'] = self.nPut
+        ret['get'] = self.nGet
+        if self.nGet > 0:
+            ret['avg_wait'] = self.totalWait/self.nGet
+        else:
+            ret['avg_wait'] = 0.
+        ret['max_wait'] = self.maxWait
+        return ret
+
+
 class TaskQueue(object):
-    """A task queue holds the a list of tasks to execute in order."""
+    """A task queue holds the a list of tasks to execute. 
+
+       Tasks are taken from the queue by task class (see Task.userClass, 
+       etc.): tasks of a higher-precedence class go before those of a 
+       lower-precedence class. So that a steady stream of higher-class 
+       tasks can't starve a lower class, a waiting class is served anyway
+       after a configured number of higher-class tasks, or once its next 
+       task has waited for a configured time. Within a class, projects are
+       served round-robin, and each project's tasks are served in order.
+
+       put() never blocks, because it is called with dataflow locks held.
+       Tasks beyond the configured queue size are spilled: they are queued 
+       anyway, and sources of new tasks should call throttle() once they
+       hold no more locks, to wait for the queue to drain."""
     def __init__(self, cmdQueue):
         log.debug("Creating new task queue.")
-        self.queue=Queue.Queue(maxsize=ServerConf().getTaskQueueSize())
+        conf=ServerConf()
+        self.maxsize=conf.getTaskQueueSize()
+        self.throttleTime=conf.getTaskQueueThrottleTime()
+        self.classBurst=conf.getTaskQueueClassBurst()
+        self.classMaxWait=conf.getTaskQueueClassMaxWait()
         self.cmdQueue=cmdQueue
+        self.cond=threading.Condition()
+        # for each task class, an ordered dict of project -> deque of 
+        # (task, queue time) tuples. The ordered dict's order is the 
+        # round-robin order of projects.
+        self.classes=[ OrderedDict() for taskClass in Task.taskClasses ]
+        self.stats=[ TaskQueueClassStats() for taskClass in Task.taskClasses ]
+        # for each task class, the number of tasks of other classes taken
+        # from the queue while it had tasks waiting.
+        self.passedOver=[ 0 for taskClass in Task.taskClasses ]
+        self.size=0
+        # the number of queued None items.
+        self.nNone=0
+        # backpressure statistics
+        self.peakSize=0 # the maximum queue size
+        self.nSpilled=0 # the number of tasks put in a full queue
+        self.nThrottled=0 # the number of throttle() calls that had to wait
+        self.nThrottleTimeouts=0 # the number of these that timed out
+        self.throttleWait=0. # the total time spent waiting in throttle()
+
+    def _isFull(self):
+        """Whether the queue is at or beyond its size limit."""
+        return self.maxsize > 0 and self.size >= self.maxsize
 
     def put(self, task):
-        """Put a task in the queue."""
-        # Use a timeout in order to avoid freezing the server completely
-        # if the queue is full.
-        self.queue.put(task, timeout=15)
+        """Put a task in the queue. Never blocks: if the queue is full, the
+           task is spilled beyond the queue's size limit."""
+        with self.cond:
+            if self._isFull():
+                self.nSpilled+=1
+            projects=self.classes[task.taskClass]
+            if task.project not in projects:
+                projects[task.project]=deque()
+            projects[task.project].append( (task, time.time()) )
+            self.stats[task.taskClass].nPut+=1
+            self.size+=1
+            if self.size > self.peakSize:
+                self.peakSize=self.size
+            self.cond.notify_all()
+
+    def throttle(self):
+        """Wait until the queue is below its size limit, or until the 
+           configured throttle time has passed. To be called by sources 
+           of new tasks (e.g. the request handlers of finished commands and
+           of project commands) while they hold no dataflow locks or request
+           pool slots. Must not be called from the task exec threads or the
+           heartbeat monitor thread: they are the ones that drain the queue.
+           Returns whether the queue is below its size limit."""
+        with self.cond:
+            if not self._isFull():
+                return True
+            self.nThrottled+=1
+            starttime=time.time()
+            endtime=starttime+self.throttleTime
+            while self._isFull():
+                remaining=endtime-time.time()
+                if remaining <= 0:
+                    self.nThrottleTimeouts+=1
+                    break
+                self.cond.wait(remaining)
+            self.throttleWait+=time.time()-starttime
+            return not self._isFull()
 
     def putNone(self):
         """Put a none into the queue to make sure threads are reading it."""
-        self.queue.put(None)
+        with self.cond:
+            self.nNone+=1
+            self.cond.notify_all()
+
+    def _isStarved(self, taskClass, now):
+        """Whether a lower-precedence task class with waiting tasks should 
+           go ahead of higher-precedence classes. Must be called with the 
+           condition variable locked."""
+        if self.classBurst > 0 and self.passedOver[taskClass]>=self.classBurst:
+            return True
+        # the next task of the class is the first one of the first project
+        dq=self.classes[taskClass].itervalues().next()
+        task, queueTime=dq[0]
+        return self.classMaxWait > 0 and now-queueTime >= self.classMaxWait
+
+    def _getTask(self):
+        """Take the next task from the queue. Must be called with the 
+           condition variable locked and the queue non-empty."""
+        now=time.time()
+        waiting=[ taskClass for taskClass in Task.taskClasses 
+                  if len(self.classes[taskClass]) > 0 ]
+        getClass=waiting[0]
+        for taskClass in waiting[1:]:
+            if self._isStarved(taskClass, now):
+                getClass=taskClass
+                break
+        for taskClass in waiting:
+            if taskClass != getClass:
+                self.passedOver[taskClass]+=1
+        self.passedOver[getClass]=0
+        projects=self.classes[getClass]
+        project, dq=projects.popitem(last=False)
+        task, queueTime=dq.popleft()
+        if len(dq) > 0:
+            # put the project at the back of the round-robin order
+            projects[project]=dq
+        self.stats[getClass].addWait(now-queueTime)
+        self.size-=1
+        return task
 
     def get(self):
-        return self.queue.get()
+        """Get the next task from the queue (or None), blocking until there 
+           is one."""
+        with self.cond:
+            while self.size == 0 and self.nNone == 0:
+                self.cond.wait()
+            if self.nNone > 0:
+                self.nNone-=1
+                return None
+            task=self._getTask()
+            self.cond.notify_all()
+            return task
 
     def empty(self):
-        return self.queue.empty()
+        with self.cond:
+            return self.size == 0 and self.nNone == 0
+
+    def getStats(self):
+        """Get a dict with the task queue statistics: the queue depth, and
+           the number of tasks and their wait times per task class and the
+           queue depth per project."""
+        ret=dict()
+        with self.cond:
+            ret['depth'] = self.size
+            ret['max_depth'] = self.maxsize
+            ret['peak_depth'] = self.peakSize
+            ret['spilled'] = self.nSpilled
+            ret['throttled'] = self.nThrottled
+            ret['throttle_timeouts'] = self.nThrottleTimeouts
+            ret['throttle_wait'] = self.throttleWait
+            projectDepths=dict()
+            for taskClass in Task.taskClasses:
+                depth=0
+                for project, dq in self.classes[taskClass].iteritems():
+                    depth+=len(dq)
+                    name=project.getName()
+                    projectDepths[name]=projectDepths.get(name, 0)+len(dq)
+                classStats=self.stats[taskClass].toJSON()
+                classStats['depth'] = depth
+                ret[Task.taskClassNames[taskClass]] = classStats
+            ret['projects'] = projectDepths
+        return ret
 
 
 class Task(object):
     """A task is a queueable and runnable function with inputs."""
+    # Task classes, in order of scheduling precedence in the task queue:
+    # tasks generated by user actions (set, commit, rerun, etc.)
+    userClass=0
+    # tasks generated by the handling of finished commands
+    commandClass=1
+    # tasks generated by the output of other tasks
+    generatedClass=2
+    taskClasses=[ userClass, commandClass, generatedClass ]
+    taskClassNames=[ "user", "command", "generated" ]
+
     def __init__(self, project, activeInstance, function, fnInput,
-                 priority, seqNr):
+                 priority, seqNr, taskClass=userClass):
         """Create a task based on a function
 
            project = the project of this task
@@ -84,6 +273,7 @@ class Task(object):
            fnInput = the FunctionRunInput object
            priority = the task's priority.
            seqNr = the task's sequence number
+           taskClass = the task's class for scheduling in the task queue.
            """
 
         #log.debug("creating task")
@@ -92,6 +282,7 @@ class Task(object):
         self.activeInstance=activeInstance
         self.function=function
         self.priority=priority
+        self.taskClass=taskClass
         self.id=id(self)
         self.project = project
         # we want only one copy of a task running at a time
@@ -154,10 +345,15 @@ class Task(object):
                           self.activeInstance.instance.getName())
                 # a transaction object that serves as the function run
                 # output object.
+                if cmd is not None:
+                    taskClass=Task.commandClass
+                else:
+                    taskClass=Task.generatedClass
                 fnOutput=transaction.Transaction(self.project,
                                                  self,
                                                  self.activeInstance.getNet(),
-                                                 self.function.getLib())
+                                                 self.function.getLib(),
+                                                 taskClass)
                 self.fnInput.setFunctionRunOutput(fnOutput)
                 self.fnInput.cmd=cmd
                 self.fnOutput=fnOutput
@@ -226,6 +422,8 @@ class Task(object):
                 self.fnOutput.setError(errmsg)
                 #self.activeInstance.markError(errmsg)
                 return (True, None, canceled)
+        # the task's commands have changed
+        self.markChanged()
         return (finished, self.fnOutput.cmds, canceled)
 
     def handleOutput(self):
@@ -263,6 +461,16 @@ class Task(object):
                                 log.error("Error removing subdir in persistence directory: %s" % dir_path)
 
 
+    @staticmethod
+    def getSourceTaskClass(sourceTag):
+        """Get the task class for tasks generated in response to an update
+           from a source tag. Transactions resulting from task output 
+           carry their task class; anything else is a user action."""
+        taskClass=getattr(sourceTag, 'taskClass', None)
+        if taskClass is None:
+            return Task.userClass
+        return taskClass
+
     def getID(self):
         return "%s.%s"%(self.activeInstance.getCanonicalName(), self.seqNr)
 
@@ -272,6 +480,11 @@ class Task(object):
     def getProject(self):
         return self.project
 
+    def markChanged(self):
+        """Mark the state of the task (and its commands) as changed, so it
+           will be written out with the next project state save."""
+        self.activeInstance.markChanged()
+
     def writeXML(self, outf, indent=0):
         indstr=cpc.util.indStr*indent
         iindstr=cpc.util.indStr*(indent+1)
@@ -112,17 +112,21 @@ class Transaction(run.FunctionRunOutput):
     """Holds a set of new output data + new connections + new instances to
        add in a single transaction. All updates must happen through this
        object"""
-    def __init__(self, project, task, activeNetwork, importLib):
+    def __init__(self, project, task, activeNetwork, importLib, 
+                 taskClass=None):
         """Initialize. Task may be None if outputs/subnetOutputs/cmds are 
            empty.
 
            project = the project this transaction belongs to
            task = the task this transaction belongs to (may be None)
            activeNetwork = the active network this transaction manipulates
-           importLib = the import library to use."""
+           importLib = the import library to use.
+           taskClass = the task class for any tasks generated as a result
+                       of this transaction, or None for user transactions."""
         run.FunctionRunOutput.__init__(self)
         self.activeNetwork=activeNetwork
         self.task=task
+        self.taskClass=taskClass
         if task is not None:
             self.activeInstance=task.activeInstance
             self.seqNr=task.seqNr
@@ -263,6 +267,10 @@ class Transaction(run.FunctionRunOutput):
                 for ai in affectedInputAIs:
                     #log.debug("affected input AI %s"%ai.getCanonicalName())
                     ai.handleNewInput(self, self.seqNr)
+            if affectedOutputAIs is not None:
+                # values may have been set directly on these
+                for ai in affectedOutputAIs:
+                    ai.markChanged()
         except:
             fo=StringIO()
             traceback.print_exception(sys.exc_info()[0], sys.exc_info()[1],
@@ -285,7 +293,7 @@ class Transaction(run.FunctionRunOutput):
         log.debug("Finished transaction locks")
         if addedInstances is not None:
             for inst in addedInstances: 
-                inst.activate()
+                inst.activate(self)
         #log.debug("TRANSACTION ENDING *****************")
             
 
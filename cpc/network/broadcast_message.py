@@ -32,10 +32,75 @@ from cpc.util import json_serializer
 from cpc.network.node import Node
 import json
 import logging
+import threading
+import time
 #messages that are broadcasted to all nodes
 log=logging.getLogger(__name__)
+
+
+class BroadcastRound(object):
+    """The messages of one broadcast, sent concurrently. Each message is
+       sent in its own thread; the results are collected until all messages
+       are done or the timeout has passed.
+
+       The results are a dict of node ID -> dict with 'status' (OK, ERROR or
+       TIMEOUT) and 'message'."""
+    def __init__(self, timeout):
+        self.deadline=time.time()+timeout
+        self.cond=threading.Condition()
+        self.results=dict()
+        # the tuples of node IDs whose messages are still being sent
+        self.pending=set()
+
+    def start(self, nodeIds, function, *args):
+        """Call function(*args) in a new thread. The function returns the
+           results for the nodes in nodeIds."""
+        key=tuple(nodeIds)
+        with self.cond:
+            self.pending.add(key)
+        th=threading.Thread(target=self._run, args=(key, function, args))
+        th.daemon=True
+        th.start()
+
+    def wait(self):
+        """Wait for the messages. Returns the results; nodes that did not
+           answer in time get a TIMEOUT status, and their late results are
+           dropped."""
+        with self.cond:
+            while len(self.pending) > 0:
+                remaining=self.deadline-time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            for key in self.pending:
+                for nodeId in key:
+                    self.results[nodeId] = { 'status' : 'TIMEOUT',
+                                             'message' : 'No response in time' }
+            self.pending.clear()
+            return dict(self.results)
+
+    def _run(self, key, function, args):
+        try:
+            results=function(*args)
+        except Exception as e:
+            results=dict( (nodeId, { 'status' : 'ERROR',
+                                     'message' : str(e) } ) for nodeId in key)
+        with self.cond:
+            if key in self.pending:
+                self.pending.remove(key)
+                self.results.update(results)
+                self.cond.notifyAll()
+
+
 class BroadcastMessage(ServerToServerMessage):
+    """Sends a message to all nodes of the network, or to the neighbouring
+       nodes only. The messages are sent concurrently, and the broadcast
+       functions return the per-node results (see BroadcastRound).
 
+       With broadcast_fan_out set, a network-wide broadcast is sent to at
+       most that many nodes, which relay it to the others (see relay()), so
+       that large networks don't need a message from this server to every
+       node."""
 
     def __init__(self):
         self.conf = ServerConf()
@@ -87,33 +152,106 @@ class BroadcastMessage(ServerToServerMessage):
         topology = ServerToServerMessage.getNetworkTopology()
         if not topology:
             log.error("Cannot find network topology.")
-            return
-        
-        #we dont want to broadcast to ourself
-        node = Node.getSelfNode(ServerConf())
+            return dict()
 
-        
-        topology.removeNode(node.getId())     
-        for node in topology.nodes.itervalues():
-            self._sendMessage(node,fields,files,headers)
+        #we dont want to broadcast to ourself
+        selfId = Node.getSelfNode(self.conf).getId()
+        nodeIds = [ nodeId for nodeId in topology.nodes.iterkeys()
+                    if nodeId != selfId ]
+        # files can't be relayed.
+        relay = ( len(files) == 0 )
+        return self._sendToNodes(nodeIds, fields, files, headers,
+                                 self.conf.getBroadcastTimeout(), relay)
 
 
     def broadcastToNeighboursOnly(self,fields,files = [],headers=dict()):
-        conf = ServerConf()
-        for node in conf.getNodes().nodes.itervalues():
-            self._sendMessage(node,fields,files,headers)
+        nodeIds = self.conf.getNodes().nodes.keys()
+        return self._sendToNodes(nodeIds, fields, files, headers,
+                                 self.conf.getBroadcastTimeout(), False)
+
+
+    def relay(self, nodeIds, fields, timeout):
+        """Send a relayed broadcast on to a group of nodes.
+           nodeIds = the IDs of the nodes to send to
+           fields = dict of the message's field names and values
+           timeout = the time in seconds to wait for the nodes
+           Returns the per-node results."""
+        fields = [ Input(name, value) for name, value in fields.iteritems() ]
+        return self._sendToNodes(nodeIds, fields, [], dict(), timeout, True)
+
+
+    def _sendToNodes(self, nodeIds, fields, files, headers, timeout, relay):
+        """Send a message to a list of nodes, concurrently. If relay is set
+           and there are more nodes than broadcast_fan_out, the nodes are
+           split into groups, and the message is sent to the first node of
+           each group, which relays it to the rest of its group."""
+        nodeIds = sorted(nodeIds)
+        fanOut = self.conf.getBroadcastFanOut()
+        bround = BroadcastRound(timeout)
+        if relay and fanOut > 0 and len(nodeIds) > fanOut:
+            for i in range(fanOut):
+                group = nodeIds[i::fanOut]
+                if len(group) > 1:
+                    bround.start(group, self._relayGroup, group, fields,
+                                 timeout)
+                else:
+                    bround.start(group, self._sendMessage, group[0], fields,
+                                 [], dict())
+        else:
+            for nodeId in nodeIds:
+                bround.start([nodeId], self._sendMessage, nodeId, fields,
+                             files, headers)
+        results = bround.wait()
+        for nodeId, result in results.iteritems():
+            if result['status'] != "OK":
+                log.warning("Broadcast to %s failed: %s: %s"%
+                            (nodeId, result['status'], result['message']))
+        return results
+
+
+    def _relayGroup(self, group, fields, timeout):
+        """Send a message to the first node of a group, to be relayed to the
+           rest of the group. If that node fails, the message is sent to the
+           rest of the group directly."""
+        relayFields = dict( (field.name, field.value) for field in fields )
+        # the relaying node needs time to collect the results of its group.
+        relayTimeout = 0.8*timeout
+        relayMsg = [ Input('cmd', "broadcast-relay"),
+                     Input('relay_fields', json.dumps(relayFields)),
+                     Input('relay_nodes', json.dumps(group[1:])),
+                     Input('relay_timeout', str(relayTimeout)) ]
+        startTime = time.time()
+        try:
+            resp = self._sendRequest(group[0], relayMsg, [], dict())
+            presp = ProcessedResponse(resp)
+            if presp.getStatus() == "OK":
+                return presp.getData()
+            message = presp.getMessage()
+        except Exception as e:
+            message = str(e)
+        ret = { group[0] : { 'status' : 'ERROR', 'message' : message } }
+        remaining = timeout-(time.time()-startTime)
+        if len(group) > 1 and remaining > 0:
+            log.info("Relaying broadcast through %s failed; sending directly"%
+                     group[0])
+            ret.update(self._sendToNodes(group[1:], fields, [], dict(),
+                                         remaining, False))
+        return ret
 
 
-    def _sendMessage(self,node,fields,files = [],headers=dict()):
-        self.node = node
+    def _sendMessage(self,nodeId,fields,files = [],headers=dict()):
+        """Send a message to a single node. Returns the result for it."""
+        presp = ProcessedResponse(self._sendRequest(nodeId, fields, files,
+                                                    headers))
+        return { nodeId : { 'status' : presp.getStatus(),
+                            'message' : presp.getMessage() } }
 
-        #TODO find nicer way to do this
-        #a bit backwards to initialize the parent object here.
-        ServerToServerMessage.__init__(self,node.getId())
-        #self.initialize(node.server_id)
-        headers['end-node'] = node.getHostname()
-        headers['end-node-port'] = node.getServerSecurePort()
-        msg = ServerRequest.prepareRequest(fields,[],headers)
-        resp  = self.putRequest(msg)
-        #print ProcessedResponse(resp).pprint()
 
+    def _sendRequest(self,nodeId,fields,files,headers):
+        # a new message object for each node, as they are sent concurrently.
+        msg = ServerToServerMessage(nodeId)
+        headers = dict(headers)
+        headers['end-node'] = msg.endNode.getHostname()
+        headers['end-node-port'] = msg.endNode.getServerSecurePort()
+        req = ServerRequest.prepareRequest(fields,files,headers)
+        return msg.putRequest(req)
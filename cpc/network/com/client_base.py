@@ -23,6 +23,7 @@ import ssl
 import logging
 import cpc.util.log
 import client_connection
+from cpc.network.com.connection_base import StaleConnectionError
 from cpc.util import CpcError
 '''
 Created on Mar 10, 2011
@@ -69,38 +70,63 @@ class ClientBase(object):
         self.useNoSSLFalback=False
 
     def putRequest(self, req, require_certificate_authentication=None, disable_cookies=False):
-        self.__connect(require_certificate_authentication, disable_cookies)
-        try:
+        return self.__sendRequest(req, "PUT",
+                                  require_certificate_authentication,
+                                  disable_cookies)
+
+    def postRequest(self, req, require_certificate_authentication=None, disable_cookies=False):
+        return self.__sendRequest(req, "POST",
+                                  require_certificate_authentication,
+                                  disable_cookies)
+
+    def closeClient(self):
+        self.conn.close()
 
-            ret=self.conn.sendRequest(req,"PUT")
+    def __sendRequest(self, req, method, require_certificate_authentication,
+                      disable_cookies):
+        reused=self.__connect(require_certificate_authentication,
+                              disable_cookies)
+        try:
+            return self.conn.sendRequest(req, method)
+        except StaleConnectionError as e:
+            if not reused:
+                raise ClientConnectionError(e.exc,self.host,self.port)
+            # the server closed the idle connection before it could have
+            # acted on the request: try again with a new one. Any other
+            # failure may come after the request was processed, and
+            # retrying it could do its work twice.
+            log.debug("Reused connection to %s:%s failed (%s); reconnecting"%
+                      (self.host, self.port, e))
         except httplib.HTTPException as e:
             raise ClientConnectionError(e,self.host,self.port)
         except socket.error as e:
             raise ClientConnectionError(e,self.host,self.port)
-        return ret
-
-    def postRequest(self, req, require_certificate_authentication=None, disable_cookies=False):
-        self.__connect(require_certificate_authentication, disable_cookies)
+        if hasattr(req.msg, 'seek'):
+            req.msg.seek(0)
+        self.__connect(require_certificate_authentication, disable_cookies,
+                       False)
         try:
-            ret=self.conn.sendRequest(req)
+            return self.conn.sendRequest(req, method)
+        except StaleConnectionError as e:
+            raise ClientConnectionError(e.exc,self.host,self.port)
         except httplib.HTTPException as e:
             raise ClientConnectionError(e,self.host,self.port)
         except socket.error as e:
             raise ClientConnectionError(e,self.host,self.port)
-        return ret
-
-    def closeClient(self):
-        self.conn.conn.close()
 
     # the order in which we determine whether to require certificate from server for authentication is
     # 1, overrides lower priorities : argument require_certificate_authentication
     # 2, if self.require_certificate_authentication is set
     # default to true
-    def __connect(self, require_certificate_authentication=None, disable_cookies=False):
+    def __connect(self, require_certificate_authentication=None, disable_cookies=False,
+                  reuse=True):
 
         '''
         inputs:
              require_certificate_authentication:boolean  requires a certificate from the server
+             reuse:boolean  whether an idle pooled connection may be used
+        returns:
+             whether an idle pooled connection was used
         '''
         if require_certificate_authentication is not None:
             require_certificate_authentication = require_certificate_authentication
@@ -120,7 +146,7 @@ class ClientBase(object):
                 log.log(cpc.util.log.TRACE,"Connecting HTTPS with no cert authentication")
                 self.conn=client_connection.ClientConnectionNoCertRequired(
                             self.conf, disable_cookies)
-            self.conn.connect(self.host,self.port)
+            return self.conn.connect(self.host,self.port,reuse)
         except httplib.HTTPException as e:
             raise ClientConnectionError(e,self.host,self.port)
         except socket.error as e:
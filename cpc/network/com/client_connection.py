@@ -71,7 +71,8 @@ class ClientConnectionBase(ConnectionBase):
             if cookie is not None:
                 request.headers['cookie'] = cookie
 
-        request.headers["Connection"]= "close"
+        # the connection is kept for the next request
+        request.headers["Connection"]= "keep-alive"
         return request
 
 
@@ -79,9 +80,45 @@ class ClientConnectionBase(ConnectionBase):
         cookie = response.getheader('set-cookie', None)
         if cookie is not None and self.cookieHandler is not None:
             self.cookieHandler.setCookie(cookie)
-
+        # older servers close the connection after some requests.
+        self.keepAlive = not response.will_close
         return response
 
+    def connect(self,host,port,reuse=True):
+        """Connect to a server, reusing an idle connection from the
+           connection pool if there is one and reuse is True.
+           Returns whether the connection was reused."""
+        self.host = host
+        self.port = port
+        self.keepAlive = False
+        self.conn = None
+        if reuse:
+            self.conn = ClientConnectionPool().getConnection(host, port)
+        reused = self.conn is not None
+        if not reused:
+            self.conn = self.newConnection()
+            self.conn.connect()
+        self.connected=True
+        ClientConnectionPool().addStats(not reused)
+        return reused
+
+    def newConnection(self):
+        """Create a new, unconnected, https connection."""
+        raise NotImplementedError("not implemented by subclass")
+
+    def handleSocket(self):
+        if self.keepAlive:
+            ClientConnectionPool().putConnection(self.conn, self.host,
+                                                 self.port)
+            self.conn = None
+        else:
+            self.conn.close()
+
+    def close(self):
+        """Close the connection, if it isn't kept in the pool."""
+        if self.conn is not None:
+            self.conn.close()
+
 
 class ClientConnectionRequireCert(ClientConnectionBase):
     """
@@ -94,26 +131,18 @@ class ClientConnectionRequireCert(ClientConnectionBase):
         self.conf = conf
         self.cookieHandler = None # We disallow this for now
 
-    def connect(self,host,port):
-
-        self.host = host
-        self.port = port
+    def newConnection(self):
         privateKey = self.conf.getPrivateKey()
         keyChain = self.conf.getCaChainFile()
         cert = self.conf.getCertFile()
 
         log.log(cpc.util.log.TRACE,"Connecting VerHTTPS to host %s, port %s"%(
             self.host,self.port))
-        self.conn = HttpsConnectionWithCertReq(self.host,
-                                            self.port,
-                                            privateKey,
-                                            keyChain,
-                                            cert)
-        self.conn.connect()
-        self.connected=True
-
-    def handleSocket(self):
-        pass
+        return HttpsConnectionWithCertReq(self.host,
+                                          self.port,
+                                          privateKey,
+                                          keyChain,
+                                          cert)
 
 
 
@@ -133,16 +162,7 @@ class ClientConnectionNoCertRequired(ClientConnectionBase):
             self.cookieHandler = CookieHandler(conf)
         else:
             self.cookieHandler = None
-    def connect(self,host,port):
-
-        self.host = host
-        self.port = port
-
+    def newConnection(self):
         log.log(cpc.util.log.TRACE,"Connecting HTTPS with no cert req to host %s, port %s"%(
             self.host,self.port))
-        self.conn = HttpsConnectionNoCertReq(self.host,self.port)
-        self.conn.connect()
-        self.connected=True
-
-    def handleSocket(self):
-        pass
\ No newline at end of file
+        return HttpsConnectionNoCertReq(self.host,self.port)
@@ -1,9 +1,24 @@
+import httplib
 import mmap
+import socket
+import tempfile
 from cpc.network.com.client_response import ClientResponse
+from cpc.network.server_response import chunkSize
 from cpc.util import ClientError, cpc
 
 import logging
 log=logging.getLogger(__name__)
+
+class StaleConnectionError(ClientError):
+    """Raised when a request could not be sent, or when the connection was
+       closed before any of the response arrived: the usual signs of a
+       connection the server closed while it was idle. A request on a
+       fresh connection can safely be tried again after this.
+       exc = the underlying exception"""
+    def __init__(self, exc):
+        ClientError.__init__(self, exc)
+        self.exc=exc
+
 class ConnectionBase:
     """
     Abstract class
@@ -33,8 +48,16 @@ class ConnectionBase:
     def sendRequest(self,req,method="POST"):
         req = self.prepareHeaders(req)
 
-        self.conn.request(method, "/copernicus",req.msg,req.headers)
-        response=self.conn.getresponse()
+        try:
+            self.conn.request(method, "/copernicus",req.msg,req.headers)
+        except socket.error as e:
+            # the request was not sent completely, so the server can't have
+            # acted on it.
+            raise StaleConnectionError(e)
+        try:
+            response=self.conn.getresponse()
+        except httplib.BadStatusLine as e:
+            raise StaleConnectionError(e)
         if response.status!=200:
             errorStr = "ERROR: %d: %s"%(response.status, response.reason)
             resp_mmap = mmap.mmap(-1, int(len(errorStr)), mmap.ACCESS_WRITE)
@@ -48,18 +71,21 @@ class ConnectionBase:
             length=response.getheader('content-length', None)
             if length is None:
                 length=response.getheader('Content-Length', None)
-            if length is None:
+            if length is not None:
+                log.log(cpc.util.log.TRACE,"Response length is %s"%(length))
+
+                #this covers the case where are reponse only sends back headers
+                # as we cannot initialize an mmap object of length 0
+                if int(length) == 0:
+                    length  = 1
+                resp_mmap = mmap.mmap(-1, int(length), access=mmap.ACCESS_WRITE)
+
+                resp_mmap.write(response.read(length))
+            elif response.getheader('transfer-encoding', '').lower() == \
+                    'chunked':
+                resp_mmap = self._readStreamed(response)
+            else:
                 raise ClientError("response has no length")
-            log.log(cpc.util.log.TRACE,"Response length is %s"%(length))
-
-
-            #this covers the case where are reponse only sends back headers
-            # as we cannot initialize an mmap object of length 0
-            if int(length) == 0:
-                length  = 1
-            resp_mmap = mmap.mmap(-1, int(length), access=mmap.ACCESS_WRITE)
-
-            resp_mmap.write(response.read(length))
 
         resp_mmap.seek(0)
         headerTuples = response.getheaders()
@@ -72,4 +98,27 @@ class ConnectionBase:
 
         self.handleSocket()
 
-        return ClientResponse(resp_mmap,headers)
\ No newline at end of file
+        return ClientResponse(resp_mmap,headers)
+
+    def _readStreamed(self, response):
+        """Read a response sent with chunked transfer encoding, whose length
+           isn't known in advance, by spooling it to a file.
+           Returns an mmap object with the response."""
+        tmp = tempfile.TemporaryFile()
+        try:
+            while True:
+                # httplib decodes the chunks.
+                data = response.read(chunkSize)
+                if len(data) == 0:
+                    break
+                tmp.write(data)
+            length = tmp.tell()
+            log.log(cpc.util.log.TRACE,"Streamed response length is %d"%
+                    length)
+            if length == 0:
+                return mmap.mmap(-1, 1, access=mmap.ACCESS_WRITE)
+            tmp.flush()
+            return mmap.mmap(tmp.fileno(), length, access=mmap.ACCESS_READ)
+        finally:
+            # the mapping stays valid after the file is closed.
+            tmp.close()
\ No newline at end of file
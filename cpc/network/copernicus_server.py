@@ -4,9 +4,12 @@ import SocketServer
 import logging
 import socket
 import select
+import threading
+import time
 from cpc.network.https.real_https_connection import HttpsConnectionWithCertReq
 
 from cpc.network.https_connection_pool import ServerConnectionPool
+from cpc.network.request_pool import RequestPoolFullError
 import cpc.server.message
 
 from cpc.util.conf.server_conf import ServerConf
@@ -29,6 +32,108 @@ class HTTPServer__base(SocketServer.ThreadingMixIn,HTTPServer):
         """Get the server command list."""
         return cpc.server.message.scSecureList
 
+    def startServing(self):
+        """Called when the server starts serving requests."""
+        pass
+
+    def takeRevertedSockets(self):
+        """Take the established server connections that have been reverted
+           to receive requests."""
+        return []
+
+    def initParking(self):
+        """Initialize the list of parked connections."""
+        # dict of parked socket -> the time at which it is closed, or None
+        self.parkedSockets=dict()
+        self.parkedLock=threading.Lock()
+
+    def process_request(self, request, client_address):
+        """Hand a connection to the request thread pool, or close it if
+           too many connections are waiting."""
+        try:
+            self.getState().getRequestPool().submit(
+                                self.process_request_thread, request,
+                                client_address)
+        except RequestPoolFullError:
+            log.warning("Request queue full: closing connection from %s"%
+                        str(client_address))
+            self.shutdown_request(request)
+
+    def parkConnection(self, request, timeout):
+        """Keep an idle keep-alive connection until its next request
+           arrives, without holding a request thread.
+           timeout = the time in seconds after which the connection is
+                     closed, or None to keep it"""
+        request.parked=True
+        if hasattr(request, "pending") and request.pending() > 0:
+            # the next request has already arrived.
+            self.process_request(request, request.getpeername())
+            return
+        deadline=None
+        if timeout is not None:
+            deadline=time.time()+timeout
+        with self.parkedLock:
+            self.parkedSockets[request]=deadline
+
+    def _getParkedSockets(self):
+        with self.parkedLock:
+            return self.parkedSockets.keys()
+
+    def _unpark(self, sock):
+        """Handle the next request on a parked connection."""
+        with self.parkedLock:
+            del self.parkedSockets[sock]
+        try:
+            client_address=sock.getpeername()
+        except socket.error:
+            # the other side has gone away.
+            self.shutdown_request(sock)
+            return
+        self.process_request(sock, client_address)
+
+    def _closeIdleSockets(self):
+        """Close the parked connections that have been idle for too long."""
+        now=time.time()
+        with self.parkedLock:
+            expired=[ sock for sock, deadline in self.parkedSockets.iteritems()
+                      if deadline is not None and deadline < now ]
+            for sock in expired:
+                del self.parkedSockets[sock]
+        for sock in expired:
+            log.log(cpc.util.log.TRACE,"Closing idle connection")
+            self.shutdown_request(sock)
+
+    def _parkIfKept(self, request):
+        """Park the connection if its handler kept it alive. Returns
+           whether it was parked."""
+        if getattr(request, "park", False):
+            request.park=False
+            self.parkConnection(request, request.parkTimeout)
+            return True
+        return False
+
+    def shutdown_request(self, request):
+        if not self._parkIfKept(request):
+            SocketServer.TCPServer.shutdown_request(self, request)
+
+    def serve_forever(self, poll_interval=0.5):
+        """Handle requests until shutdown, watching the listening socket
+           and the parked connections."""
+        self._BaseServer__is_shut_down.clear()
+        try:
+            while not self._BaseServer__shutdown_request:
+                r, w, e = select.select([self.socket]+self._getParkedSockets(),
+                                        [], [], poll_interval)
+                for sock in r:
+                    if self.socket == sock:
+                        self._handle_request_noblock()
+                    else:
+                        self._unpark(sock)
+                self._closeIdleSockets()
+        finally:
+            self._BaseServer__shutdown_request = False
+            self._BaseServer__is_shut_down.set()
+
 
 class CopernicusServer(HTTPServer__base):
 
@@ -41,6 +146,18 @@ class CopernicusServer(HTTPServer__base):
         # shutdown if we seen keep-alive in the header
         self.daemon_threads = True
         self.serverState = serverState
+        self.initParking()
+
+    def startServing(self):
+        self.serverState.startConnectServerThread()
+
+    def takeRevertedSockets(self):
+        ret=[]
+        for sock in list(self.serverState.readableSockets):
+            if sock != self.socket:
+                self.serverState.removeReadableSocket(sock)
+                ret.append(sock)
+        return ret
 
     def serve_forever(self, poll_interval=0.5):
         """Handle one request at a time until shutdown.
@@ -48,7 +165,7 @@ class CopernicusServer(HTTPServer__base):
         self.timeout. If you need to do periodic tasks, do them in
         another thread.
         """
-        self.serverState.startConnectServerThread()
+        self.startServing()
         self.serverState.addReadableSocket(self.socket)
 
 
@@ -59,7 +176,9 @@ class CopernicusServer(HTTPServer__base):
                 # connecting to the socket to wake this up instead of
                 # polling. Polling reduces our responsiveness to a
                 # shutdown request and wastes cpu at all other times.
-                r, w, e = select.select( self.serverState.readableSockets
+                parkedSockets = self._getParkedSockets()
+                r, w, e = select.select( self.serverState.readableSockets +
+                                         parkedSockets
                                         , []
                                         , self.serverState.readableSockets
                                         , poll_interval)
@@ -70,6 +189,8 @@ class CopernicusServer(HTTPServer__base):
                 for sock in r:
                     if self.socket == sock:
                         self._handle_request_noblock()
+                    elif sock in parkedSockets:
+                        self._unpark(sock)
                     else:
                         #Sockets that have been reverted from write to read
                         #end up here.
@@ -88,6 +209,7 @@ class CopernicusServer(HTTPServer__base):
                             except:
                                 self.handle_error(request, client_address)
                                 self.shutdown_request(request)
+                self._closeIdleSockets()
 
 
         finally:
@@ -96,6 +218,8 @@ class CopernicusServer(HTTPServer__base):
 
 
     def shutdown_request(self,request):
+        if self._parkIfKept(request):
+            return
         if(hasattr(request,"revertSocket") and request.revertSocket==True):
             node = ServerConf().getNodes().get(request.serverId)
 
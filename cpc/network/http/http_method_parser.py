@@ -25,7 +25,12 @@ import logging
 import shutil
 import filecmp
 import os
+import cpc.util
 import cpc.util.log
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
 '''
 Created on Mar 7, 2011
 
@@ -36,6 +41,155 @@ import urlparse
 
 
 log=logging.getLogger(__name__)
+
+class MultipartError(cpc.util.CpcError):
+    pass
+
+
+class MultipartReader(object):
+    """Reads a multipart/form-data message body in fixed-size chunks, so
+       that memory use doesn't depend on the size of the parts. Parts are
+       scanned for the boundary in a buffer, and file parts are written
+       once, directly into the temporary file that the request keeps."""
+    # the size of the chunks read from the stream
+    chunkSize = 256*1024
+    # the maximum size of the headers of a part
+    maxHeaderSize = 64*1024
+
+    def __init__(self, msgStream, boundary, contentLength=None):
+        """Initialize with a stream positioned at the start of the body.
+           msgStream = the input stream
+           boundary = the boundary string from the content-type header
+           contentLength = the length of the body, or None if unknown"""
+        self.msgStream = msgStream
+        self.remaining = contentLength
+        # parts start after a CRLF and the boundary; the first boundary
+        # has no CRLF before it, so we add one.
+        self.delimiter = "\r\n--"+boundary
+        self.buf = "\r\n"
+
+    def _fill(self):
+        """Read the next chunk into the buffer. Returns False at the end of
+           the body."""
+        n = self.chunkSize
+        if self.remaining is not None:
+            n = min(n, self.remaining)
+        if n == 0:
+            return False
+        data = self.msgStream.read(n)
+        if len(data) == 0:
+            return False
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        self.buf += data
+        return True
+
+    def _skipToDelimiter(self, outf):
+        """Copy data up to the next delimiter to outf (or discard it if outf
+           is None) and consume the delimiter."""
+        while True:
+            i = self.buf.find(self.delimiter)
+            if i >= 0:
+                if outf is not None and i > 0:
+                    outf.write(self.buf[:i])
+                self.buf = self.buf[i+len(self.delimiter):]
+                return
+            # keep enough to find a delimiter that straddles chunks
+            keep = len(self.delimiter)-1
+            if len(self.buf) > keep:
+                if outf is not None:
+                    outf.write(self.buf[:-keep])
+                self.buf = self.buf[-keep:]
+            if not self._fill():
+                raise MultipartError("Multipart message ended before its "
+                                     "boundary")
+
+    def _readUntil(self, sep, maxSize):
+        """Read and consume the buffer up to and including sep.
+           Returns the data before sep."""
+        while True:
+            i = self.buf.find(sep)
+            if i >= 0:
+                ret = self.buf[:i]
+                self.buf = self.buf[i+len(sep):]
+                return ret
+            if len(self.buf) > maxSize:
+                raise MultipartError("Multipart header too long")
+            if not self._fill():
+                raise MultipartError("Multipart message ended in a header")
+
+    def _readExactly(self, n, outf):
+        """Copy exactly n bytes to outf."""
+        while n > 0:
+            if len(self.buf) == 0 and not self._fill():
+                raise MultipartError("Multipart message part too short")
+            data = self.buf[:n]
+            self.buf = self.buf[len(data):]
+            outf.write(data)
+            n -= len(data)
+
+    def read(self):
+        """Read the message body.
+           Returns a tuple of a dict of parameters and a dict of files."""
+        params = dict()
+        files = dict()
+        # skip any preamble
+        self._skipToDelimiter(None)
+        while True:
+            # the delimiter is followed by '--' for the last one, or
+            # by optional whitespace and a CRLF.
+            while len(self.buf) < 2 and self._fill():
+                pass
+            if self.buf.startswith("--"):
+                break
+            self._readUntil("\r\n", self.maxHeaderSize)
+            while len(self.buf) < 2 and self._fill():
+                pass
+            if self.buf.startswith("\r\n"):
+                # a part without headers
+                headerBlock = ""
+                self.buf = self.buf[2:]
+            else:
+                headerBlock = self._readUntil("\r\n\r\n",
+                                              self.maxHeaderSize)
+            headers = mimetools.Message(StringIO(headerBlock+"\r\n\r\n"))
+            log.log(cpc.util.log.TRACE,'multipart headers are %s'%
+                    headers.headers)
+            disposition = headers['Content-Disposition']
+            notused,contentDispositionParams = cgi.parse_header(disposition)
+            name = contentDispositionParams['name']
+            if ServerRequest.isFile(disposition):
+                outf = tempfile.TemporaryFile(mode="w+b")
+            else:
+                outf = StringIO()
+            contentLength = headers.getheader('Content-Length')
+            if contentLength:
+                # the data can contain anything, so the delimiter must
+                # directly follow it.
+                self._readExactly(int(contentLength), outf)
+                if not self.buf.startswith(self.delimiter):
+                    while ( len(self.buf) < len(self.delimiter) and
+                            self._fill() ):
+                        pass
+                    if not self.buf.startswith(self.delimiter):
+                        raise MultipartError("Multipart part %s longer than "
+                                             "its content-length"%name)
+                self.buf = self.buf[len(self.delimiter):]
+            else:
+                self._skipToDelimiter(outf)
+            if ServerRequest.isFile(disposition):
+                outf.seek(0)
+                files[name] = outf
+            else:
+                params[name] = outf.getvalue()
+                log.log(cpc.util.log.TRACE,"param %s is %s"%
+                        (name, params[name]))
+        # read the rest of the body, so the connection can be reused.
+        if self.remaining is not None:
+            while self._fill():
+                self.buf = ""
+        return (params, files)
+
 #handles parsing of the HTTP methods
 class HttpMethodParser(object):
     '''
@@ -108,98 +262,14 @@ class HttpMethodParser(object):
     
     @staticmethod
     def handleMultipart(mainHeaders,msgStream):
-        files = dict()
-        params = dict()
-
-        BOUNDARY = "--"+HttpMethodParser.extractBoundary(mainHeaders)        
-        stopBoundary = BOUNDARY+"--"
-        terminateBoundary = ''
-        
-        msgStream.readline() #has an empty line at start that we want to get rid of
-          
-        while terminateBoundary != stopBoundary:
-            headers = mimetools.Message(msgStream)
-            
-            terminateBoundary = ''
-            log.log(cpc.util.log.TRACE,'multipart headers are %s'%headers.headers)
-            
-            if(ServerRequest.isFile(headers['Content-Disposition'])):
-                file = tempfile.TemporaryFile(mode="w+b")
-            
-            name =  ServerRequest.getFieldName(headers['Content-Disposition'])            
-            notused,contentDispositionParams = cgi.parse_header(headers['Content-Disposition'])                        
-            name = contentDispositionParams['name']
-             
-            
-            #if we have a content length we just read it and store the data
-            
-            contentLength = headers.getheader('Content-Length')
-            if(contentLength):   # If a content length is sent we parse the nice way
-                bytes = int(contentLength)
-                if(ServerRequest.isFile(headers['Content-Disposition'])):
-                    file.write(msgStream.read(bytes))
-                    
-                else: 
-                    line  = msgStream.read(bytes)
-                    log.log(cpc.util.log.TRACE,"line is "+line)
-                    params[name] = line  
-                    
-                msgStream.readline()    ## we will have a trailin CRLF that we just want to get rid of
-            
-            if(ServerRequest.isFile(headers['Content-Disposition'])):
-                readBytes = 0
-                while(True):
-                    line = msgStream.readline()                    
-                    if re.search(BOUNDARY,line):
-                        #time to wrap it up
-                        
-                        if(line[-2:] == '\r\n'):                          
-                            line = line[:-2]
-                        elif(line[-1:] == '\n'):                     
-                            line = line[:-1]
-                        
-                        terminateBoundary = line                                               
-                        
-                        file.seek(0)
-                        skipBytes = 2
-
-                        realFile = tempfile.TemporaryFile(mode="w+b")
-                        realFile.write(file.read(readBytes-skipBytes))
-                        
-                        file.close()                        
-                        realFile.seek(0)
-                        
-                        #For testing during dev only!!
-                        #runTest(realFile)                                                      
-                        
-                        files[name]= realFile
-                        break
-                    else:
-                        readBytes +=len(line)
-                        file.write(line)   
-                
-            else:  
-                while(True):
-                    line = msgStream.readline()
-
-                    if(line[-2:] == '\r\n'):                      
-                        line = line[:-2]
-                    elif(line[-1:] == '\n'):                     
-                        line = line[:-1]
-                                            
-                    if re.search(BOUNDARY,line):       
-                        terminateBoundary = line   
-                        break;                                 
-                    
-                    else:
-                        if name in params:
-                            params[name]+= line
-                        else: 
-                            params[name] = line    
-            
+        boundary = HttpMethodParser.extractBoundary(mainHeaders)
+        contentLength = None
+        if 'content-length' in mainHeaders:
+            contentLength = long(mainHeaders['content-length'])
+        reader = MultipartReader(msgStream, boundary, contentLength)
+        (params, files) = reader.read()
         return ServerRequest(mainHeaders,None,params,files)
 
-    
     @staticmethod
     #//extracts the boundary sent from the header
     def extractBoundary(headers):
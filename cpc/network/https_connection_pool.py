@@ -25,6 +25,7 @@ Created on Jul 18, 2011
 import logging
 from Queue import Queue,Empty
 import threading
+import time
 from cpc.util.conf.server_conf import ServerConf
 
 import cpc.util.log
@@ -157,3 +158,67 @@ class ServerConnectionPool(ConnectionPool):
 #        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, max_fails)
         ConnectionPool.putConnection(self,connection,node.getHostname(),
            node.getServerSecurePort())
+
+
+class ClientConnectionPool(ConnectionPool):
+    """
+    Singleton that keeps the idle keep-alive connections of clients and
+    workers to servers, so that their requests don't each need a new TLS
+    handshake. Connections are only reused while they have been idle for
+    less than maxIdleTime seconds: the server closes idle connections.
+    """
+    __shared_state = {}
+    # the maximum idle time of a reused connection. This is shorter than the
+    # server's default keep_alive_timeout.
+    maxIdleTime=15
+    # the maximum number of idle connections kept per host and port.
+    maxIdleConnections=4
+
+    def __init__(self):
+        self.__dict__ = self.__shared_state
+
+        if len(self.__shared_state)>0:
+            return
+
+        ConnectionPool.__init__(self)
+        self.stats = { 'connections' : 0,
+                       'requests' : 0 }
+        log.log(cpc.util.log.TRACE,"instantiation of client connection pool")
+
+    def getConnection(self,host,port):
+        """Get an idle connection to a host, or None if there is none."""
+        now=time.time()
+        with self.listlock:
+            q = self.getOrCreateQueue(host,port)
+            while True:
+                try:
+                    connection, lastUsed = q.get(False)
+                except Empty:
+                    return None
+                if now - lastUsed < self.maxIdleTime:
+                    log.log(cpc.util.log.TRACE,"Reusing connection to "
+                                               "host:%s:%s"%(host,port))
+                    return connection
+                connection.close()
+
+    def putConnection(self,connection,host,port):
+        """Keep a connection with no outstanding requests for reuse."""
+        with self.listlock:
+            q = self.getOrCreateQueue(host,port)
+            if q.qsize() >= self.maxIdleConnections:
+                connection.close()
+            else:
+                q.put( (connection, time.time()), False)
+
+    def addStats(self, newConnection):
+        """Count a request, and whether it needed a new connection."""
+        with self.listlock:
+            self.stats['requests'] += 1
+            if newConnection:
+                self.stats['connections'] += 1
+
+    def getStats(self):
+        """Get a dict with the number of requests and the number of new
+           connections (TLS handshakes) they took."""
+        with self.listlock:
+            return dict(self.stats)
@@ -0,0 +1,443 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import errno
+import logging
+import select
+import socket
+import ssl
+import tempfile
+import threading
+import time
+
+import cpc.util
+import cpc.util.log
+
+log=logging.getLogger(__name__)
+
+# the maximum size of a request's request line and headers.
+maxHeadSize=65536
+# request bodies larger than this are spooled to a temporary file.
+spoolSize=1024*1024
+# the size of a single read.
+readSize=65536
+# the maximum number of reads from one connection before the others get
+# their turn.
+maxReads=16
+# the maximum number of connections accepted in one go.
+acceptBatch=64
+
+
+class ReactorError(cpc.util.CpcError):
+    pass
+
+
+class EpollPoller(object):
+    """Watches file descriptors with epoll."""
+    def __init__(self):
+        self.epoll=select.epoll()
+
+    def register(self, fd, write=False):
+        self.epoll.register(fd, self._events(write))
+
+    def modify(self, fd, write=False):
+        self.epoll.modify(fd, self._events(write))
+
+    def unregister(self, fd):
+        self.epoll.unregister(fd)
+
+    def poll(self, timeout):
+        """Wait for events. Returns the list of file descriptors that are
+           ready, or that have an error."""
+        try:
+            return [ fd for fd, event in self.epoll.poll(timeout) ]
+        except IOError as e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+
+    def _events(self, write):
+        if write:
+            return select.EPOLLOUT
+        return select.EPOLLIN
+
+
+class PollPoller(EpollPoller):
+    """Watches file descriptors with poll()."""
+    def __init__(self):
+        self.epoll=select.poll()
+
+    def poll(self, timeout):
+        try:
+            return [ fd for fd, event in self.epoll.poll(timeout*1000) ]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def _events(self, write):
+        if write:
+            return select.POLLOUT
+        return select.POLLIN
+
+
+class SelectPoller(object):
+    """Watches file descriptors with select(), for systems without epoll
+       or poll."""
+    def __init__(self):
+        self.readers=set()
+        self.writers=set()
+
+    def register(self, fd, write=False):
+        if write:
+            self.writers.add(fd)
+        else:
+            self.readers.add(fd)
+
+    def modify(self, fd, write=False):
+        self.unregister(fd)
+        self.register(fd, write)
+
+    def unregister(self, fd):
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+
+    def poll(self, timeout):
+        try:
+            r, w, e = select.select(list(self.readers), list(self.writers),
+                                    [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        return r+w
+
+
+def makePoller():
+    """Make the best poller this system has."""
+    if hasattr(select, "epoll"):
+        return EpollPoller()
+    if hasattr(select, "poll"):
+        return PollPoller()
+    return SelectPoller()
+
+
+class ReactorConnection(object):
+    """A connection that the reactor reads a request from."""
+    def __init__(self, sock, clientAddress, timeout):
+        """Initialize the connection.
+           sock = the socket
+           clientAddress = the address of the other side
+           timeout = the time in seconds after which an idle connection is
+                     closed, or None to keep it"""
+        self.sock=sock
+        self.clientAddress=clientAddress
+        self.timeout=timeout
+        self.handshaking=False
+        # whether the loop has stopped watching the connection
+        self.detached=False
+        # the request head read so far
+        self.head=""
+        # the request, once the head is complete
+        self.body=None
+        # the number of body bytes still to be read
+        self.remaining=0
+        # data received after the end of the request
+        self.leftover=""
+        self.touch()
+
+    def touch(self):
+        """Reset the idle timer."""
+        if self.timeout is None:
+            self.deadline=None
+        else:
+            self.deadline=time.time()+self.timeout
+
+    def feed(self, data):
+        """Add received data. Returns whether the request is complete; it
+           can then be read from self.body."""
+        if self.body is None:
+            self.head+=data
+            end=self.head.find("\r\n\r\n")
+            if end < 0:
+                if len(self.head) > maxHeadSize:
+                    raise ReactorError("Request head too long")
+                return False
+            end+=4
+            self.remaining=self._getContentLength(self.head[:end])
+            self.body=tempfile.SpooledTemporaryFile(spoolSize)
+            self.body.write(self.head[:end])
+            data=self.head[end:]
+            self.head=""
+        n=min(len(data), self.remaining)
+        self.body.write(data[:n])
+        self.remaining-=n
+        if self.remaining > 0:
+            return False
+        self.leftover=data[n:]
+        self.body.seek(0)
+        return True
+
+    def _getContentLength(self, head):
+        """Get the body length from a request head."""
+        contentLength=0
+        for line in head.split("\r\n")[1:]:
+            key, sep, value=line.partition(":")
+            key=key.strip().lower()
+            if key == "content-length":
+                try:
+                    contentLength=int(value.strip())
+                except ValueError:
+                    raise ReactorError("Invalid content-length '%s'"%
+                                       value.strip())
+            elif key == "transfer-encoding":
+                # none of our clients send these.
+                raise ReactorError("Unsupported transfer-encoding '%s'"%
+                                   value.strip())
+        return contentLength
+
+
+class ReactorMixIn(object):
+    """Mix-in class for the HTTPS servers that reads requests in a single
+       event loop thread, and only hands complete requests to the request
+       thread pool.
+
+       The loop does the TLS handshakes, reads the request heads and bodies,
+       and holds the idle keep-alive connections and reverted server
+       connections, so that none of these need a thread. Responses are
+       written by the request threads, after which a kept connection is
+       handed back to the loop."""
+
+    def initReactor(self):
+        """Initialize the event loop."""
+        self.poller=makePoller()
+        # dict of file descriptor -> ReactorConnection
+        self.reactorConnections=dict()
+        # connections with data left to read
+        self.readyConnections=set()
+        # list of (socket, timeout) tuples handed back by request threads
+        self.returnedConnections=[]
+        self.reactorLock=threading.Lock()
+        self.wakeReceiver, self.wakeSender=socket.socketpair()
+        self.wakeReceiver.setblocking(False)
+        self.wakeSender.setblocking(False)
+        self.nextExpiryCheck=0
+        # the TLS handshake of new connections is done in the loop.
+        if isinstance(self.socket, ssl.SSLSocket):
+            self.socket.do_handshake_on_connect=False
+        self.socket.setblocking(False)
+        self.poller.register(self.socket.fileno())
+        self.poller.register(self.wakeReceiver.fileno())
+
+    def serve_forever(self, poll_interval=0.5):
+        """Handle requests until shutdown."""
+        self.startServing()
+        self.initReactor()
+        self._BaseServer__is_shut_down.clear()
+        try:
+            while not self._BaseServer__shutdown_request:
+                self._adoptConnections()
+                if len(self.readyConnections) > 0:
+                    timeout=0
+                else:
+                    timeout=poll_interval
+                ready=self.readyConnections
+                self.readyConnections=set()
+                for fd in self.poller.poll(timeout):
+                    if fd == self.socket.fileno():
+                        self._accept()
+                    elif fd == self.wakeReceiver.fileno():
+                        self._drainWakeup()
+                    else:
+                        conn=self.reactorConnections.get(fd)
+                        if conn is not None:
+                            ready.add(conn)
+                for conn in ready:
+                    # the connection may have been closed in the meantime.
+                    if not conn.detached:
+                        self._serviceConnection(conn)
+                self._closeExpired()
+        finally:
+            self._BaseServer__shutdown_request = False
+            self._BaseServer__is_shut_down.set()
+
+    def parkConnection(self, request, timeout):
+        """Hand a kept connection back to the event loop. Called by the
+           request threads.
+           timeout = the time in seconds after which the connection is
+                     closed, or None to keep it"""
+        request.parked=True
+        with self.reactorLock:
+            self.returnedConnections.append( (request, timeout) )
+        try:
+            self.wakeSender.send("x")
+        except socket.error:
+            # the loop is already being woken up.
+            pass
+
+    def _drainWakeup(self):
+        try:
+            while self.wakeReceiver.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def _accept(self):
+        """Accept new connections."""
+        for i in range(acceptBatch):
+            try:
+                sock, clientAddress=self.get_request()
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    log.debug("Error accepting connection: %s"%str(e))
+                return
+            self._addConnection(sock, self.conf.getKeepAliveTimeout(),
+                                clientAddress=clientAddress,
+                                handshake=isinstance(sock, ssl.SSLSocket))
+
+    def _adoptConnections(self):
+        """Take in the connections returned by the request threads, and
+           the reverted server connections."""
+        with self.reactorLock:
+            returned=self.returnedConnections
+            self.returnedConnections=[]
+        for sock, timeout in returned:
+            data=getattr(sock, "requestLeftover", "")
+            sock.requestLeftover=""
+            self._addConnection(sock, timeout, data=data)
+        for sock in self.takeRevertedSockets():
+            log.log(cpc.util.log.TRACE,"Preparing established connection "
+                                       "and setting it to read")
+            self._addConnection(sock, None)
+
+    def _addConnection(self, sock, timeout, data="", clientAddress=None,
+                       handshake=False):
+        """Start reading a request from a connection.
+           sock = the socket
+           timeout = the idle timeout, or None
+           data = data already received from the connection
+           clientAddress = the address of the other side, if known
+           handshake = whether the TLS handshake is still to be done"""
+        try:
+            if clientAddress is None:
+                clientAddress=sock.getpeername()
+            sock.setblocking(False)
+        except socket.error:
+            # the other side has gone away.
+            self.shutdown_request(sock)
+            return
+        conn=ReactorConnection(sock, clientAddress, timeout)
+        self.reactorConnections[sock.fileno()]=conn
+        self.poller.register(sock.fileno())
+        if handshake:
+            conn.handshaking=True
+            return
+        # there may already be data buffered, which the poller won't see.
+        self._serviceConnection(conn, data)
+
+    def _serviceConnection(self, conn, data=""):
+        """Read from a connection, and dispatch its request when it is
+           complete."""
+        try:
+            if conn.handshaking and not self._handshake(conn):
+                return
+            received=self._recv(conn)
+            if received is None:
+                self._closeConnection(conn)
+                return
+            data+=received
+            if data != "":
+                conn.touch()
+            if conn.feed(data):
+                self._dispatch(conn)
+        except (socket.error, ReactorError) as e:
+            log.debug("Closing connection from %s: %s"%
+                      (str(conn.clientAddress), str(e)))
+            self._closeConnection(conn)
+
+    def _handshake(self, conn):
+        """Continue the TLS handshake. Returns whether it is done."""
+        fd=conn.sock.fileno()
+        try:
+            conn.sock.do_handshake()
+        except ssl.SSLError as e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.poller.modify(fd, False)
+                return False
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.poller.modify(fd, True)
+                return False
+            raise
+        conn.handshaking=False
+        self.poller.modify(fd, False)
+        return True
+
+    def _recv(self, conn):
+        """Read the data available on a connection. Returns the data, or
+           None if the other side closed the connection."""
+        chunks=[]
+        for i in range(maxReads):
+            try:
+                data=conn.sock.recv(readSize)
+            except ssl.SSLError as e:
+                if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                    return "".join(chunks)
+                raise
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return "".join(chunks)
+                raise
+            if data == "":
+                return None
+            chunks.append(data)
+        # there may be more; it is read in the next round.
+        self.readyConnections.add(conn)
+        return "".join(chunks)
+
+    def _dispatch(self, conn):
+        """Hand a complete request to the request thread pool."""
+        self._detach(conn)
+        conn.sock.setblocking(True)
+        conn.sock.requestInput=conn.body
+        conn.sock.requestLeftover=conn.leftover
+        self.process_request(conn.sock, conn.clientAddress)
+
+    def _detach(self, conn):
+        """Stop watching a connection."""
+        fd=conn.sock.fileno()
+        self.poller.unregister(fd)
+        del self.reactorConnections[fd]
+        self.readyConnections.discard(conn)
+        conn.detached=True
+
+    def _closeConnection(self, conn):
+        self._detach(conn)
+        self.shutdown_request(conn.sock)
+
+    def _closeExpired(self):
+        """Close the connections that have been idle for too long."""
+        now=time.time()
+        if now < self.nextExpiryCheck:
+            return
+        self.nextExpiryCheck=now+1
+        expired=[ conn for conn in self.reactorConnections.itervalues()
+                  if conn.deadline is not None and conn.deadline < now ]
+        for conn in expired:
+            log.log(cpc.util.log.TRACE,"Closing idle connection")
+            self._closeConnection(conn)
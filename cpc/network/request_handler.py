@@ -20,7 +20,6 @@
 
 import BaseHTTPServer
 import socket
-import mmap
 import logging
 import os
 import uuid
@@ -45,6 +44,7 @@ from cpc.util.conf.server_conf import ServerConf
 from cpc.network.http.http_method_parser import HttpMethodParser
 from cpc.server.state.user_handler import UserLevel, User
 import cpc.server.message
+import cpc.network.server_response
 import cpc.util.log
 
 
@@ -66,9 +66,33 @@ class handler_base(BaseHTTPServer.BaseHTTPRequestHandler):
         self.responseCode = 200
         self.set_cookie = None
         self.regexp = '^%s[/?]?'%self.application_root  #checks if a request is referring to application root
-        self.rfile = socket._fileobject(self.request, "rb", self.rbufsize)
+        # with the reactor front end, the request has already been read.
+        requestInput = getattr(self.request, "requestInput", None)
+        if requestInput is not None:
+            self.request.requestInput = None
+            self.rfile = requestInput
+        else:
+            self.rfile = socket._fileobject(self.request, "rb", self.rbufsize)
         self.wfile = socket._fileobject(self.request, "wb", self.wbufsize)
         self.request.revertSocket = False
+        if not getattr(self.request, "parked", False):
+            self.server.getState().addConnectionStats(1, 0)
+
+    def handle(self):
+        """Handle a single request. A connection that is kept alive is
+           parked by the server until its next request arrives, so idle
+           connections don't hold a request thread."""
+        self.close_connection = 1
+        self.handle_one_request()
+        if not self.close_connection and not self.request.revertSocket:
+            headers = getattr(self, "headers", None)
+            # connections of clients and workers are closed once they have
+            # been idle for a while; those of servers are kept.
+            if headers is not None and 'originating-server-id' in headers:
+                self.request.parkTimeout = None
+            else:
+                self.request.parkTimeout = ServerConf().getKeepAliveTimeout()
+            self.request.park = True
 
 
     def isApplicationRoot(self):
@@ -116,9 +140,12 @@ class handler_base(BaseHTTPServer.BaseHTTPRequestHandler):
         #can handle single part and multipart messages
         #take the input and put it into a request object
         #process the message
+        # clients that send more requests ask to keep the connection.
+        keepAlive = ( self.headers.get('connection', '').lower() ==
+                      "keep-alive" )
         if(self.isApplicationRoot()):
             request = HttpMethodParser.parsePOST(self.headers.dict,self.rfile)
-            self.processMessage(request)
+            self.processMessage(request, closeConnection=not keepAlive)
 
         else:
             self.processMessage() #this is not a valid command i.e we did not find the resource
@@ -176,7 +203,10 @@ class handler_base(BaseHTTPServer.BaseHTTPRequestHandler):
             self.send_header("content-length", len(retresp.message))
             for (key, val) in retresp.headers.iteritems():
                 kl=key.lower()
-                if kl!="content-length" and kl!="server" and kl!="date":
+                # the reply is sent with a content-length, also if it was
+                # streamed to us.
+                if (kl!="content-length" and kl!="transfer-encoding" and 
+                    kl!="server" and kl!="date"):
                     self.log.log(cpc.util.log.TRACE,
                         "Sending header '%s'='%s'"%(kl,val))
                     self.send_header(key,val)
@@ -184,7 +214,9 @@ class handler_base(BaseHTTPServer.BaseHTTPRequestHandler):
             self.send_header("Connection",  "keep-alive")
             self.end_headers()
             retresp.message.seek(0)
-            self.wfile.write(retresp.message.read(len(retresp.message)))
+            cpc.network.server_response.copyChunked(retresp.message,
+                                                    self.wfile,
+                                                    len(retresp.message))
 
         else:
             if(self.isApplicationRoot()):
@@ -294,11 +326,29 @@ class handler_base(BaseHTTPServer.BaseHTTPRequestHandler):
 
     def _sendResponse(self,retmsg,closeConnection=True,revertSocket=False):
         conf = ServerConf()
-        rets = retmsg.render()
-        self.log.log(cpc.util.log.TRACE,"Done. Reply message is: '%s'\n"%rets)
+        if retmsg.isStream():
+            # the response is written while it is sent: its length isn't 
+            # known yet.
+            rets = None
+            length = None
+            self.log.log(cpc.util.log.TRACE,"Done. Reply is streamed")
+        elif retmsg.isFile():
+            # files are streamed, so we only need their size here.
+            rets = None
+            length = retmsg.getFileSize()
+            self.log.log(cpc.util.log.TRACE,"Done. Reply is a file of %d bytes"%
+                         length)
+        else:
+            rets = retmsg.render()
+            length = len(rets)
+            self.log.log(cpc.util.log.TRACE,"Done. Reply message is: '%s'\n"%
+                         rets)
 
         self.send_response(self.responseCode)
-        self.send_header("content-length", len(rets))
+        if length is not None:
+            self.send_header("content-length", length)
+        else:
+            self.send_header("Transfer-Encoding", "chunked")
         if 'originating-server-id' not in retmsg.headers:
             self.send_header("originating-server-id", conf.getServerId())
 
@@ -320,12 +370,20 @@ class handler_base(BaseHTTPServer.BaseHTTPRequestHandler):
         else:
             self.send_header("Connection",  "keep-alive")
         self.end_headers()
-        if isinstance(rets, mmap.mmap):
-            # we need this because strings don't support reads, and
-            # write expects this.
-            str = rets.read(len(rets))
-            #print str
-            self.wfile.write(str)
+        if retmsg.isStream():
+            cw=cpc.network.server_response.ChunkedWriter(self.wfile)
+            try:
+                retmsg.writeStream(cw)
+                cw.close()
+            except:
+                # the response can't be completed: the client sees that the
+                # connection is closed before the end of the response.
+                self.close_connection = 1
+                raise
+        elif rets is None:
+            # the connection may be encrypted, so we can't use sendfile;
+            # the file is written in chunks instead.
+            retmsg.writeFile(self.wfile)
         else:
             self.wfile.write(rets)
         retmsg.close()
@@ -343,6 +401,12 @@ class handler_base(BaseHTTPServer.BaseHTTPRequestHandler):
 
         self.log.log(cpc.util.log.TRACE,'"%s" %s %s',
                          self.requestline, str(code), str(size))
+        self.server.getState().addConnectionStats(0, 1)
+
+    #overriding the method in BaseHTTPServer.BaseHTTPRequestHandler, which
+    # writes to stderr.
+    def log_error(self, format, *args):
+        self.log.debug(format, *args)
 
         #KEEPING THE ACTUALL CALL FOR FUTURE REFERENCE
         # self.log_message('"%s" %s %s',
@@ -0,0 +1,157 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import threading
+import logging
+import time
+import sys
+import traceback
+from Queue import Queue, Full
+
+import cpc.util
+
+log=logging.getLogger(__name__)
+
+
+class RequestPoolFullError(cpc.util.CpcError):
+    pass
+
+
+class BulkSlot(object):
+    """Context manager that holds one of the request pool's bulk slots."""
+    def __init__(self, pool):
+        self.pool=pool
+
+    def __enter__(self):
+        startTime=time.time()
+        self.pool.bulkSemaphore.acquire()
+        self.pool._addBulkWait(time.time()-startTime)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.pool.bulkSemaphore.release()
+        return False
+
+
+class RequestPool(object):
+    """A fixed-size pool of threads that handle the server's connections,
+       with a bounded queue of accepted connections waiting for a thread.
+
+       Handling connections in a fixed number of threads keeps slow requests
+       from starting ever more threads. Two kinds of request can hold a
+       thread for long, so they are limited further:
+       - bulk data transfers (building and unpacking tar files) run in a
+         limited number of slots, so that control requests such as
+         heartbeats always find a free thread.
+       - long polls are only admitted while at most half of the threads
+         are waiting in one."""
+    def __init__(self, nThreads, queueSize, nBulk):
+        """Initialize the pool; the threads are started with start().
+           nThreads = the number of threads
+           queueSize = the maximum number of waiting connections
+           nBulk = the maximum number of concurrent bulk data transfers"""
+        self.nThreads=nThreads
+        self.queue=Queue(queueSize)
+        self.bulkSemaphore=threading.Semaphore(nBulk)
+        self.maxLongPolls=nThreads/2
+        self.threads=[]
+        self.lock=threading.Lock()
+        self.busy=0
+        self.longPolls=0
+        self.stats = { 'handled' : 0,
+                       'rejected' : 0,
+                       'queue_time' : 0.,
+                       'max_queue_time' : 0.,
+                       'bulk_wait_time' : 0.,
+                       'long_polls_refused' : 0 }
+
+    def start(self):
+        """Start the threads."""
+        for i in range(self.nThreads):
+            th=threading.Thread(target=self._run,
+                                name="RequestThread-%d"%i)
+            th.daemon=True
+            th.start()
+            self.threads.append(th)
+
+    def submit(self, function, *args):
+        """Queue a function to be called in one of the threads. Raises a
+           RequestPoolFullError if the queue is full."""
+        try:
+            self.queue.put_nowait( (function, args, time.time()) )
+        except Full:
+            with self.lock:
+                self.stats['rejected'] += 1
+            raise RequestPoolFullError("Request queue full")
+
+    def bulk(self):
+        """Get a context manager for running a bulk data transfer."""
+        return BulkSlot(self)
+
+    def startLongPoll(self):
+        """Ask to wait in a long poll. Returns whether that is allowed; if
+           so, endLongPoll() must be called afterwards."""
+        with self.lock:
+            if self.longPolls >= self.maxLongPolls:
+                self.stats['long_polls_refused'] += 1
+                return False
+            self.longPolls += 1
+            return True
+
+    def endLongPoll(self):
+        with self.lock:
+            self.longPolls -= 1
+
+    def getStats(self):
+        """Get a dict with the pool's statistics. Queue times are in
+           seconds."""
+        with self.lock:
+            ret=dict(self.stats)
+            ret['threads'] = self.nThreads
+            ret['busy'] = self.busy
+            ret['long_polls'] = self.longPolls
+        ret['queued'] = self.queue.qsize()
+        if ret['handled'] > 0:
+            ret['mean_queue_time'] = ret['queue_time']/ret['handled']
+        else:
+            ret['mean_queue_time'] = 0.
+        return ret
+
+    def _addBulkWait(self, waitTime):
+        with self.lock:
+            self.stats['bulk_wait_time'] += waitTime
+
+    def _run(self):
+        """The thread function."""
+        while True:
+            function, args, queuedTime=self.queue.get()
+            queueTime=time.time()-queuedTime
+            with self.lock:
+                self.busy += 1
+                self.stats['handled'] += 1
+                self.stats['queue_time'] += queueTime
+                self.stats['max_queue_time'] = max(queueTime,
+                                            self.stats['max_queue_time'])
+            try:
+                function(*args)
+            except:
+                log.error("Error in request thread: %s"%
+                          "".join(traceback.format_exception(*sys.exc_info())))
+            with self.lock:
+                self.busy -= 1
@@ -26,6 +26,7 @@ from threading import Thread
 import traceback
 
 from cpc.network.copernicus_server import HTTPServer__base, CopernicusServer
+from cpc.network.reactor import ReactorMixIn
 import request_handler
 from cpc.server.state.server_state import ServerState
 from cpc.util.conf.server_conf import ServerConf
@@ -96,6 +97,7 @@ class HTTPSServerNoCertAuthentication(HTTPServer__base):
         BaseHTTPServer.HTTPServer.__init__(self, (conf.getServerHost(),
                                            conf.getClientSecurePort()),
                                            handler_class)
+        self.initParking()
 
         #https part
         fpem = conf.getPrivateKey()
@@ -119,9 +121,29 @@ class HTTPSServerNoCertAuthentication(HTTPServer__base):
 
 
 
+class ReactorHTTPSServerWithCertAuthentication(ReactorMixIn,
+                                              HTTPSServerWithCertAuthentication):
+    """
+    HTTPSServerWithCertAuthentication that reads its requests in an event loop
+    """
+    pass
+
+
+class ReactorHTTPSServerNoCertAuthentication(ReactorMixIn,
+                                             HTTPSServerNoCertAuthentication):
+    """
+    HTTPSServerNoCertAuthentication that reads its requests in an event loop
+    """
+    pass
+
+
 def serveHTTPSWithCertAuthentication(serverState):
     try:
-        httpd = HTTPSServerWithCertAuthentication(request_handler.handlerForRequestWithCertReq, ServerConf(), serverState)
+        if ServerConf().getServerFrontEnd() == "reactor":
+            serverClass = ReactorHTTPSServerWithCertAuthentication
+        else:
+            serverClass = HTTPSServerWithCertAuthentication
+        httpd = serverClass(request_handler.handlerForRequestWithCertReq, ServerConf(), serverState)
         sa = httpd.socket.getsockname()
         log.info("Serving HTTPS for server communication on %s port %s..."%(sa[0], sa[1]))
         httpd.serve_forever();
@@ -137,7 +159,11 @@ def serveHTTPSWithCertAuthentication(serverState):
 
 def serveHTTPSWithNoCertReq(serverState):
     try:
-        httpd = HTTPSServerNoCertAuthentication(request_handler.handlerForRequestWithNoCertReq, ServerConf(), serverState)
+        if ServerConf().getServerFrontEnd() == "reactor":
+            serverClass = ReactorHTTPSServerNoCertAuthentication
+        else:
+            serverClass = HTTPSServerNoCertAuthentication
+        httpd = serverClass(request_handler.handlerForRequestWithNoCertReq, ServerConf(), serverState)
         sa = httpd.socket.getsockname()
         log.info("Serving HTTPS for client communication on %s port %s..."%(sa[0], sa[1]))
         httpd.serve_forever()
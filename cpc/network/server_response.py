@@ -17,9 +17,67 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import os
 import json
 import mmap
 from cpc.util import json_serializer
+
+# the size of the chunks in which files are written to connections: files are
+# never read into memory as a whole.
+chunkSize=256*1024
+
+def copyChunked(inf, outf, length):
+    """Copy length bytes from one file object to another, in chunks."""
+    while length > 0:
+        data=inf.read(min(chunkSize, length))
+        if len(data) == 0:
+            raise IOError("File ended %d bytes early"%length)
+        outf.write(data)
+        length-=len(data)
+
+class ChunkedWriter(object):
+    """File object that writes to another file object with HTTP chunked
+       transfer encoding. Data is collected into chunks of about chunkSize
+       bytes."""
+    def __init__(self, outf):
+        self.outf=outf
+        self.buf=[]
+        self.bufSize=0
+        self.pos=0
+
+    def write(self, data):
+        if len(data) == 0:
+            return
+        self.buf.append(data)
+        self.bufSize+=len(data)
+        self.pos+=len(data)
+        if self.bufSize >= chunkSize:
+            self.flush()
+
+    def tell(self):
+        """Get the number of bytes written (before encoding)."""
+        return self.pos
+
+    def flush(self):
+        """Write the collected data as a chunk."""
+        if self.bufSize > 0:
+            self.outf.write("%x\r\n"%self.bufSize)
+            self.outf.write(''.join(self.buf))
+            self.outf.write("\r\n")
+            self.buf=[]
+            self.bufSize=0
+        self.outf.flush()
+
+    def close(self):
+        """Write the last chunk and the end of the body. The output file is
+           not closed."""
+        if self.bufSize > 0:
+            self.outf.write("%x\r\n%s\r\n"%(self.bufSize, ''.join(self.buf)))
+            self.buf=[]
+            self.bufSize=0
+        self.outf.write("0\r\n\r\n")
+        self.outf.flush()
+
 class ServerResponse(object):
     '''
     data structure for the command ser ver response format.
@@ -32,6 +90,7 @@ class ServerResponse(object):
         self.resp = []
         self.file = None
         self.mmap = None
+        self.streamFn = None
 
     def add(self, message, data=None, status="OK"):
         newresp=dict()
@@ -58,6 +117,15 @@ class ServerResponse(object):
             self.headers['Content-Type'] = contentTypeStr[0]
         self.file=file
 
+    def setStream(self, streamFn, contentTypeStr):
+        """Set the response to be streamed to the client with chunked
+           transfer encoding, instead of being spooled to a file first. Only
+           for clients that said they can read chunked responses.
+           streamFn = a function that writes the response to the file object
+                      it is called with, once the headers have been sent."""
+        self.headers['Content-Type'] = contentTypeStr
+        self.streamFn=streamFn
+
     def clearAll(self):
         del self.resp
         self.resp = []
@@ -81,6 +149,30 @@ class ServerResponse(object):
             self.mmap= mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
             return self.mmap
 
+    def isStream(self):
+        """Whether the response is streamed."""
+        return self.streamFn is not None
+
+    def writeStream(self, outf):
+        """Write the streamed response to a file object."""
+        self.streamFn(outf)
+
+    def isFile(self):
+        """Whether the response is a file."""
+        return self.file is not None
+
+    def getFileSize(self):
+        """Get the size of the response file."""
+        # buffered writes aren't seen by fstat.
+        self.file.flush()
+        return os.fstat(self.file.fileno()).st_size
+
+    def writeFile(self, outf):
+        """Write the response file to a file object in chunks, from its
+           start."""
+        self.file.seek(0)
+        copyChunked(self.file, outf, self.getFileSize())
+
     def close(self):
         if self.mmap is not None:
             self.mmap.close()
@@ -37,6 +37,9 @@ from cpc.util.openssl import OpenSSL
 from cpc.network.cache import Cache, NetworkTopologyCache
 from cpc.network.server_to_server_message import ServerToServerMessage
 from cpc.network.broadcast_message import BroadcastMessage
+from cpc.network.server_request import ServerRequest
+from cpc.network.server_response import ServerResponse
+import cpc.server.message
 
 from cpc.network.node_connect_request import NodeConnectRequest
 import json
@@ -102,6 +105,49 @@ class SCNetworkTopologyUpdate(ServerCommand):
         log.info("Update network topology done")
 
 
+class SCBroadcastRelay(ServerCommand):
+    """
+    A broadcast message to handle here and to relay to a group of nodes.
+    Replies with the results for this node and the group.
+    """
+    def __init__(self):
+        ServerCommand.__init__(self, "broadcast-relay")
+
+    def run(self, serverState, request, response):
+        fields = json.loads(request.getParam('relay_fields'))
+        nodeIds = json.loads(request.getParam('relay_nodes'))
+        timeout = float(request.getParam('relay_timeout'))
+        conf = ServerConf()
+
+        #handle the message here
+        params = dict( (str(name), value) for name, value in fields.iteritems() )
+        localRequest = ServerRequest(request.headers, None, params)
+        localRequest.session = request.session
+        localResponse = ServerResponse()
+        status = "OK"
+        try:
+            scList = cpc.server.message.scSecureList
+            serverCmd = scList.getServerCommand(localRequest)
+            serverCmd[0].run(serverState, localRequest, localResponse)
+            serverCmd[0].finish(serverState, localRequest)
+            messages = []
+            for resp in localResponse.resp:
+                if resp['status'] != "OK":
+                    status = "ERROR"
+                messages.append(resp.get('message', ''))
+            message = "; ".join(messages)
+        except cpc.util.CpcError as e:
+            status = "ERROR"
+            message = str(e)
+        results = { conf.getServerId() : { 'status' : status,
+                                           'message' : message } }
+
+        #and relay it to the rest of the group
+        if len(nodeIds) > 0:
+            results.update(BroadcastMessage().relay(nodeIds, fields, timeout))
+        response.add("", results)
+
+
 class SCConnectionParamUpdate(ServerCommand):
     def __init__(self):
         ServerCommand.__init__(self, "persist-connection")
@@ -73,6 +73,12 @@ class ProjectServerCommand(ServerCommand):
             raise UserError("You don't have access to this project")
         return project
 
+    def throttleTasks(self, serverState):
+        """Apply backpressure to the client if the command generated more
+           tasks than the task queue can hold. To be called at the end of 
+           a command, when it holds no more dataflow locks."""
+        serverState.getProjectList().getTaskQueue().throttle()
+
     def getUser(self, request):
         if 'user' not in request.session:
             log.error("A command related to project was called with no user set")
@@ -192,6 +198,7 @@ class SCProjectActivate(ProjectServerCommand):
         else:
             response.add("Activated: %s in project %s"%(item, prj.getName()))
             log.info("Activated: %s in project %s"%(item, prj.getName()))
+        self.throttleTasks(serverState)
 
 class SCProjectDeactivate(ProjectServerCommand):
     """De-activate all elements in a project."""
@@ -236,6 +243,7 @@ class SCProjectRerun(ProjectServerCommand):
         lst=prj.rerun(item, recursive, clearError, outf)
         response.add(outf.getvalue())
         log.info("Force rerun on %s: %s"%(prj.getName(), item))
+        self.throttleTasks(serverState)
 
 class SCProjectList(ProjectServerCommand):
     """List named items in a project: instances or networks."""
@@ -347,6 +355,7 @@ class SCProjectAddInstance(ProjectServerCommand):
         response.add("Added instance '%s' of function %s"%(name, functionName))
         log.info("Add-instance on %s: %s of %s"%(prj.getName(), name,
                                                  functionName))
+        self.throttleTasks(serverState)
 
 class SCProjectConnect(ProjectServerCommand):
     """Add a connection to the top-level active network."""
@@ -360,6 +369,7 @@ class SCProjectConnect(ProjectServerCommand):
         prj.scheduleConnect(src, dst, outf)
         response.add(outf.getvalue())
         log.info("Connected %s: %s -> %s"%(prj.getName(), src, dst))
+        self.throttleTasks(serverState)
 
 class SCProjectImport(ProjectServerCommand):
     """Import a module (file/lib) to the project."""
@@ -510,6 +520,7 @@ class SCProjectSet(ProjectServerCommand):
         except cpc.dataflow.ApplicationError as e:
             response.add("Item not found: %s"%(str(e)))
         log.info("Project set %s: %s"%(prj.getName(), itemname))
+        self.throttleTasks(serverState)
 
 class SCProjectTransact(ProjectServerCommand):
     """Start a transaction to be able to commit several project-set commands 
@@ -535,6 +546,7 @@ class SCProjectCommit(ProjectServerCommand):
         prj.commit(outf)
         response.add(outf.getvalue())
         log.info("Project commit %s"%(prj.getName()))
+        self.throttleTasks(serverState)
 
 class SCProjectRollback(ProjectServerCommand):
     """Cancel several project-set commands in a project."""
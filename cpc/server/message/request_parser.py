@@ -110,12 +110,15 @@ scSecureList.add(state.SCServerInfo())
 # worker workload requests
 scSecureList.add(worker.SCWorkerReady())  
 scSecureList.add(worker.SCWorkerReadyForwarded())  
+scSecureList.add(worker.SCWorkerReadyProbe())
 scSecureList.add(worker.SCCommandFinished())
 scSecureList.add(worker.SCCommandFinishedForward())  
 scSecureList.add(worker.SCCommandFailed())  
+scSecureList.add(worker.SCCommandsFinished())
 # heartbeat requests
 scSecureList.add(worker.SCWorkerHeartbeat())
 scSecureList.add(worker.SCHeartbeatForwarded())
+scSecureList.add(worker.SCHeartbeatForwardedBatch())
 scSecureList.add(worker.SCDeadWorkerFetch())
 # overlay network topology
 scSecureList.add(network.ScAddNode())
@@ -128,6 +131,7 @@ scSecureList.add(network.SCNetworkTopology())
 scSecureList.add(network.SCNetworkTopologyClient())
 scSecureList.add(network.SCNetworkTopologyUpdate())
 scSecureList.add(network.SCConnectionParamUpdate())
+scSecureList.add(network.SCBroadcastRelay())
 
 # asset tracking
 scSecureList.add(tracking.SCPullAsset())
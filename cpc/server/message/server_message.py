@@ -29,6 +29,7 @@ from cpc.network.server_to_server_message import ServerToServerMessage
 from cpc.network.com.input import Input
 from cpc.network.server_request import ServerRequest
 from cpc.util import json_serializer
+import cpc.util.transfer
 
 log=logging.getLogger(__name__)
 
@@ -53,7 +54,8 @@ class ServerMessage(ServerToServerMessage):
 
     def workerReadyForwardedRequest(self, workerID, archdata, topology,
                                     originatingServer, heartbeatInterval,
-                                    originatingClient=None):
+                                    originatingClient=None,
+                                    acceptCodecs=None, cachedFiles=None):
         cmdstring='worker-ready-forward'
         fields = []
         fields.append(Input('cmd', cmdstring))
@@ -67,15 +69,42 @@ class ServerMessage(ServerToServerMessage):
                 default = json_serializer.toJson,
                 indent=4))
         fields.append(topologyInput)
+        if cachedFiles is not None:
+            # the hashes of the files in the worker's file cache
+            fields.append(Input(cpc.util.transfer.cachedFilesField,
+                                cachedFiles))
         headers = dict()
         headers['originating-server-id'] = originatingServer
         if originatingClient is not None:
             headers['originating-client'] = originatingClient
+        if acceptCodecs is not None:
+            # the transfer codecs the worker can read
+            headers[cpc.util.transfer.acceptHeader] = acceptCodecs
+        headers[cpc.util.transfer.acceptStreamHeader] = '1'
         response= self.putRequest(ServerRequest.prepareRequest(fields, [],
             headers))
         return response
 
 
+    def workerReadyProbeRequest(self, archdata, topology, timeout):
+        """Ask a server whether it, or a server it would forward a
+           worker-ready request to, has commands for a worker. The server
+           should answer within timeout seconds."""
+        cmdstring='worker-ready-probe'
+        fields = []
+        fields.append(Input('cmd', cmdstring))
+        fields.append(Input('version', "1"))
+        fields.append(Input('worker', archdata))
+        fields.append(Input('timeout', str(timeout)))
+        fields.append(Input('topology',
+            json.dumps(topology,
+                default = json_serializer.toJson,
+                indent=4)))
+        response= self.putRequest(ServerRequest.prepareRequest(fields, [],
+            dict()))
+        return response
+
+
     def commandFinishedForwardedRequest(self, cmdID, workerServer,
                                         projectServer, returncode,
                                         cputime, haveData):
@@ -131,6 +160,20 @@ class ServerMessage(ServerToServerMessage):
             headers))
         return response
 
+    def heartbeatForwardedBatchRequest(self, workerServer, heartbeats):
+        """A server-to-server request with the heartbeat signals of several
+           workers. Used in forwarding non-local heartbeat requests.
+           heartbeats = a list of dicts with the worker_id, worker_dir,
+                        iteration and heartbeat_items of each signal."""
+        cmdstring='heartbeat-forward-batch'
+        fields = []
+        fields.append(Input('cmd', cmdstring))
+        fields.append(Input('version', "1"))
+        fields.append(Input('worker_server', workerServer))
+        fields.append(Input('heartbeats', json.dumps(heartbeats)))
+        response= self.putRequest(ServerRequest.prepareRequest(fields, []))
+        return response
+
     def deadWorkerFetchRequest(self, workerDir, runDir):
         """A server-to-sever request for fetching a set of run directories
            from a dead worker's output."""
@@ -142,6 +185,9 @@ class ServerMessage(ServerToServerMessage):
         fields.append(Input('run_dir', runDir))
         files = []
         headers = dict()
+        headers[cpc.util.transfer.acceptHeader] = \
+                cpc.util.transfer.getAcceptValue()
+        headers[cpc.util.transfer.acceptStreamHeader] = '1'
         #self.connect()
         response= self.putRequest(ServerRequest.prepareRequest(fields, files,
             headers))
@@ -119,6 +119,8 @@ class SCListServerItems(ServerCommand):
             retstr = UserHandler().getUsersAsList()
         elif toList == "modules":
             retstr = getModulesList()
+        elif toList == "stats":
+            retstr = serverState.getStats()
 
 
         else:
@@ -20,10 +20,11 @@
 import json
 import logging
 import os
-import tarfile
 import tempfile
+import threading
 import time
 import shutil
+import Queue
 
 try:
     from cStringIO import StringIO
@@ -36,10 +37,12 @@ except ImportError:
 import cpc.command.platform_exec_reader
 import cpc.util
 import cpc.util.log
+import cpc.util.transfer
 
 from cpc.command.worker_matcher import CommandWorkerMatcher
 
 from cpc.network.com.client_response import ProcessedResponse
+from cpc.network.server_response import copyChunked
 from cpc.util import json_serializer
 from cpc.network.node import Nodes
 from cpc.server.message.server_message import ServerMessage
@@ -54,6 +57,91 @@ import cpc.command.heartbeat
 
 log=logging.getLogger(__name__)
 
+# the content hashes of command input files, to compare with the files in
+# workers' file caches.
+inputFileHashes=cpc.util.transfer.FileHashCache()
+
+
+def getForwardNodes(conf, request):
+    """Get the neighbouring servers a worker-ready request should be
+       forwarded to, and the network topology to send along.
+       returns: a tuple of (the list of nodes in priority order, topology)"""
+    topology = Nodes()
+    if request.hasParam('topology'):
+        topology = json.loads(request.getParam('topology')
+                              ,object_hook = json_serializer.fromJson)
+
+    thisNode = Node.getSelfNode(conf)
+    thisNode.nodes = conf.getNodes()
+    topology.addNode(thisNode)
+
+    nodes = [ node for node in conf.getNodes().getNodesByPriority()
+              if topology.exists(node.getId()) == False ]
+    return (nodes, topology)
+
+
+def probeNodes(nodes, workerData, topology, timeout):
+    """Ask servers concurrently whether they, or the servers they would
+       forward a worker-ready request to, have commands for a worker.
+       nodes = the nodes to ask
+       workerData = the worker's platform + executables description
+       topology = the network topology to send along
+       timeout = the time in seconds to wait for the answers
+       Yields (node, hasWork) tuples: first the nodes that have commands
+       (hasWork=True) in the order they answer, followed by the nodes that
+       can't answer the question (hasWork=None): servers that don't know
+       the request, or that forward to such servers. Servers that don't
+       answer in time are skipped."""
+    answers=Queue.Queue()
+    for node in nodes:
+        th=threading.Thread(target=_probeNode,
+                            args=(node, workerData, topology, timeout,
+                                  answers))
+        th.daemon=True
+        th.start()
+    unknown=[]
+    deadline=time.time()+timeout
+    for i in range(len(nodes)):
+        remaining=deadline-time.time()
+        try:
+            if remaining > 0:
+                node, hasWork=answers.get(timeout=remaining)
+            else:
+                # the caller took its time with an earlier node: the
+                # answers that have come in since are still used.
+                node, hasWork=answers.get_nowait()
+        except Queue.Empty:
+            break
+        if hasWork is None:
+            unknown.append(node)
+        elif hasWork:
+            yield (node, True)
+    for node in unknown:
+        yield (node, None)
+
+def _probeNode(node, workerData, topology, timeout, answers):
+    """Probe a single server; puts (node, whether it has work) in the
+       answers queue, with None if the server doesn't know."""
+    hasWork=False
+    try:
+        clnt=ServerMessage(node.getId())
+        presp=ProcessedResponse(clnt.workerReadyProbeRequest(workerData,
+                                                             topology,
+                                                             timeout))
+        if presp.getStatus() == "OK":
+            data=presp.getData()
+            if data['has_work']:
+                hasWork=True
+            elif len(data.get('unknown_servers', [])) > 0:
+                # it forwards to servers that don't know probes.
+                hasWork=None
+        else:
+            hasWork=None
+    except Exception as e:
+        log.debug("Worker-ready probe of %s failed: %s"%(node.getId(),
+                                                         str(e)))
+    answers.put( (node, hasWork) )
+
 
 #Child to Parent message
 class WorkerReadyBase(ServerCommand):
@@ -62,6 +150,36 @@ class WorkerReadyBase(ServerCommand):
        which implement the same functions. This way we kan enforce the
        setting of worker_server and heartbeat-interval properties only on
        the server, not the client."""
+    # the maximum time in seconds to wait for more commands once there are
+    # commands to send back: the dataflow tends to queue related commands
+    # in quick succession.
+    settleTime=1.
+    # the time in seconds to wait for other servers to answer whether they
+    # have commands.
+    probeTimeout=5.
+
+    def _getWork(self, serverState, cwm, maxWait):
+        """Get the commands for a worker from the command queue, waiting for
+           new commands to be queued for at most maxWait seconds while the
+           worker has resources left.
+           Returns the list of commands."""
+        cmdQueue=serverState.getCmdQueue()
+        addCount=cmdQueue.getAddCount()
+        cmds=cwm.getWork(cmdQueue)
+        deadline=time.time()+maxWait
+        while not cwm.isDepleted():
+            timeout=deadline-time.time()
+            if len(cmds) > 0:
+                timeout=min(timeout, self.settleTime)
+            if timeout <= 0:
+                break
+            newAddCount=cmdQueue.waitForAdd(addCount, timeout)
+            if newAddCount == addCount:
+                # nothing was added before the time-out
+                break
+            addCount=newAddCount
+            cmds.extend(cwm.getWork(cmdQueue))
+        return cmds
 
     def run(self, serverState, request, response):
         # first read platform capabilities and executables
@@ -77,14 +195,41 @@ class WorkerReadyBase(ServerCommand):
         cwm=CommandWorkerMatcher(rdr.getPlatforms(),
                                  rdr.getExecutableList(),
                                  rdr.getWorkerRequirements())
-        cmds=cwm.getWork(serverState.getCmdQueue())
-        if not cwm.isDepleted():
-            # now sleep for 5 seconds to give the dataflow time to react to any
-            # new state.
-            time.sleep(5)
-            cmds.extend(cwm.getWork(serverState.getCmdQueue()))
         # now check the forwarded variables
         conf=serverState.conf
+        if self.forwarded:
+            # the originating server has already waited for its own commands
+            # and other servers might be asked after us.
+            maxWait=0
+        elif request.hasParam('max-wait'):
+            # the worker keeps this request outstanding until there are
+            # commands for it (a long poll).
+            maxWait=min(int(request.getParam('max-wait')),
+                        conf.getWorkerReadyMaxWait())
+        else:
+            maxWait=conf.getWorkerReadyWait()
+        # waiting requests hold a request thread, so only a limited number
+        # may wait at the same time.
+        requestPool=serverState.getRequestPool()
+        maxMaxWait=conf.getWorkerReadyMaxWait()
+        waiting=False
+        if maxWait > 0:
+            waiting=requestPool.startLongPoll()
+            if not waiting:
+                log.debug("Too many waiting worker-ready requests")
+                # the worker polls instead, until there is room again.
+                maxWait=0
+                maxMaxWait=0
+        try:
+            cmds=self._getWork(serverState, cwm, maxWait)
+        finally:
+            if waiting:
+                requestPool.endLongPoll()
+        # tells the worker that it can ask us to wait (for long polls)
+        response.headers['worker-ready-max-wait']=str(maxMaxWait)
+        # tells the worker that it can send its finished commands and
+        # heartbeat in one commands-finished request.
+        response.headers['commands-finished-batch']='1'
         originatingServer=None
         heartbeatInterval=None
         try:
@@ -120,90 +265,163 @@ class WorkerReadyBase(ServerCommand):
             runningCmdList=serverState.getRunningCmdList()
             runningCmdList.add(cmds, originatingServer, heartbeatInterval)
             # construct the tar file with the workloads.
-            tff=tempfile.TemporaryFile()
-            tf=tarfile.open(fileobj=tff, mode="w:gz")
-            # make the commands ready
-            for cmd in cmds:
-                log.debug("Adding command id %s to tar file."%cmd.id)
-                # write the command description to the command's directory
-                task=cmd.getTask()
-                #log.debug(cmd)
-                project=task.getProject()
-                taskDir = "task_%s"%task.getID()
-                cmddir=cmd.getDir()
-                if not os.path.exists(cmddir):
-                    log.debug("cmddir %s did not exist. Created directory."%cmd.id)
-                    os.mkdir(cmddir)
-                arcdir="%s"%(cmd.id)
-                log.debug("cmddir=%s"%cmddir)
-                outf=open(os.path.join(cmddir, "command.xml"), "w")
-                cmd.writeWorkerXML(outf)
-                outf.close()
-                tf.add(cmddir, arcname=arcdir, recursive=True)
-                # set the state of the command.
-            tf.close()
-            del(tf)
-            tff.seek(0)
-            # now send it back
-            response.setFile(tff,'application/x-tar')
+            codec=cpc.util.transfer.chooseCodec(
+                        request.headers.get(cpc.util.transfer.acceptHeader),
+                        conf.getTransferCodec())
+            # the files the worker already has in its file cache
+            cachedFiles=None
+            if request.hasParam(cpc.util.transfer.cachedFilesField):
+                cachedFiles=set(request.getParam(
+                                cpc.util.transfer.cachedFilesField).split())
+            def writeArchive(outf):
+                self._writeCmdArchive(outf, cmds, codec, cachedFiles,
+                                      requestPool)
+            if request.headers.has_key(cpc.util.transfer.acceptStreamHeader):
+                # the archive is written into the response as it is sent.
+                response.setStream(writeArchive, 'application/x-tar')
+            else:
+                # older workers read responses by their content-length, so
+                # the archive is spooled to a file and sent from there.
+                tff=tempfile.TemporaryFile()
+                writeArchive(tff)
+                tff.seek(0)
+                # the file is closed after the response is sent.
+                response.setFile(tff,'application/x-tar')
+            response.headers[cpc.util.transfer.codecHeader]=codec
+            response.headers[cpc.util.transfer.resultManifestHeader]='1'
             #project.writeTasks()
-            # the file is closed after the response is sent.
             log.info("Did direct worker-ready")
         else:
-            nodes = conf.getNodes().getNodesByPriority()
-
-            topology = Nodes()
-            if request.hasParam('topology'):
-                topology = json.loads(request.getParam('topology')
-                                      ,object_hook = json_serializer.fromJson)
-
-            thisNode = Node.getSelfNode(conf)
-            thisNode.nodes = conf.getNodes()
-            topology.addNode(thisNode)
-
+            nodes, topology = getForwardNodes(conf, request)
+            if conf.getWorkerReadyForward() == "probe":
+                # ask all servers at once, and only forward to those that
+                # have work.
+                nodes = ( node for node, hasWork in
+                          probeNodes(nodes, workerData, topology,
+                                     self.probeTimeout) )
             hasJob =False # temporary flag that should be removed
             for node in nodes:
-                if topology.exists(node.getId()) == False:
-                    clnt=ServerMessage(node.getId())
-
-                    clientResponse=clnt.workerReadyForwardedRequest(workerID,
-                                        workerData,
-                                        topology,
-                                        originatingServer,
-                                        heartbeatInterval,
-                                        request.headers['originating-client'])
-
-                    if clientResponse.getType() == 'application/x-tar':
-
-                        log.log(cpc.util.log.TRACE,
-                                'got work from %s'%
-                                (clientResponse.headers[
-                                     'originating-server-id']))
-                        hasJob=True
-                        # we need to rewrap the message
-
-                        #TODO stupid intermediary step because the mmap form
-                        # clientresponse is prematurely closed
-                        tmp = tempfile.TemporaryFile('w+b')
-
-                        message = clientResponse.getRawData()
-
-                        tmp.write(message.read(len(message)))
-                        tmp.seek(0)
-
-                        #for key in clientResponse.headers:
-                        #    print "%s:%s"%(key,clientResponse.headers[key])
-
-                        response.setFile(tmp,'application/x-tar')
-                        response.headers['originating-server-id']=\
-                                  clientResponse.headers[
-                                      'originating-server-id']
-                    #OPTIMIZE leads to a lot of folding and unfolding of
-                    #packages
+                if self._forward(node, request, response, workerID,
+                                 workerData, topology, originatingServer,
+                                 heartbeatInterval):
+                    hasJob=True
+                    # only one server's commands can be sent back
+                    break
             if not hasJob:
                 response.add("No command")
             log.info("Did delegated worker-ready")
 
+    def _forward(self, node, request, response, workerID, workerData,
+                 topology, originatingServer, heartbeatInterval):
+        """Forward a worker-ready request to a server, and put the commands
+           it sends back in the response.
+           Returns whether there were commands."""
+        clnt=ServerMessage(node.getId())
+
+        clientResponse=clnt.workerReadyForwardedRequest(workerID,
+                            workerData,
+                            topology,
+                            originatingServer,
+                            heartbeatInterval,
+                            request.headers['originating-client'],
+                            request.headers.get(
+                                cpc.util.transfer.acceptHeader),
+                            request.getParam(
+                              cpc.util.transfer.cachedFilesField))
+
+        if clientResponse.getType() != 'application/x-tar':
+            return False
+        log.log(cpc.util.log.TRACE,
+                'got work from %s'%
+                (clientResponse.headers[
+                     'originating-server-id']))
+        # we need to rewrap the message
+
+        #TODO stupid intermediary step because the mmap form
+        # clientresponse is prematurely closed
+        tmp = tempfile.TemporaryFile('w+b')
+
+        message = clientResponse.getRawData()
+
+        copyChunked(message, tmp, len(message))
+        tmp.seek(0)
+
+        #for key in clientResponse.headers:
+        #    print "%s:%s"%(key,clientResponse.headers[key])
+
+        response.setFile(tmp,'application/x-tar')
+        response.headers['originating-server-id']=\
+                  clientResponse.headers[
+                      'originating-server-id']
+        # the archive is passed on as is, so the worker
+        # needs to know how it was encoded.
+        for header in [ cpc.util.transfer.codecHeader,
+                  cpc.util.transfer.resultManifestHeader ]:
+            if clientResponse.headers.has_key(header):
+                response.headers[header]=\
+                        clientResponse.headers[header]
+        #OPTIMIZE leads to a lot of folding and unfolding of
+        #packages
+        return True
+
+
+    def _writeCmdArchive(self, outf, cmds, codec, cachedFiles, requestPool):
+        """Write the tar archive with the directories of the commands sent 
+           to a worker, holding a bulk request pool slot.
+           outf = the file object to write to
+           cmds = the list of commands
+           codec = the transfer codec
+           cachedFiles = the set of hashes of the worker's cached files, or
+                         None
+           requestPool = the server's request pool"""
+        tf=cpc.util.transfer.TarWriter(outf, codec)
+        # make the commands ready
+        with requestPool.bulk():
+            for cmd in cmds:
+                log.debug("Adding command id %s to tar file."%cmd.id)
+                # write the command description to the command's
+                # directory
+                cmddir=cmd.getDir()
+                if not os.path.exists(cmddir):
+                    log.debug("cmddir %s did not exist. Created directory."%
+                              cmd.id)
+                    os.mkdir(cmddir)
+                arcdir="%s"%(cmd.id)
+                log.debug("cmddir=%s"%cmddir)
+                cmdf=open(os.path.join(cmddir, "command.xml"), "w")
+                cmd.writeWorkerXML(cmdf)
+                cmdf.close()
+                self._addCmdDir(tf, cmddir, arcdir, cachedFiles)
+            tf.close()
+
+    def _addCmdDir(self, tf, cmddir, arcdir, cachedFiles):
+        """Add a command directory to a workload tar file, leaving out
+           the files the worker has in its file cache.
+           tf = the TarWriter
+           cmddir = the command directory
+           arcdir = the name of the directory in the tar file
+           cachedFiles = the set of hashes of the worker's cached files, or
+                         None"""
+        if cachedFiles is None or len(cachedFiles) == 0:
+            tf.add(cmddir, arcname=arcdir, recursive=True)
+            return
+        manifest=dict()
+        def exclude(filename):
+            if ( os.path.isfile(filename) and
+                 not os.path.islink(filename) and
+                 os.path.getsize(filename) >= cpc.util.transfer.minCachedSize
+               ):
+                fileHash=inputFileHashes.getHash(filename)
+                if fileHash in cachedFiles:
+                    manifest[os.path.relpath(filename, cmddir)]=fileHash
+                    return True
+            return False
+        tf.add(cmddir, arcname=arcdir, recursive=True, exclude=exclude)
+        if len(manifest) > 0:
+            log.debug("Left out %d cached files for %s"%(len(manifest),
+                                                         arcdir))
+            tf.addData(os.path.join(arcdir, cpc.util.transfer.manifestName),
+                       json.dumps(manifest))
 
 class SCWorkerReady(WorkerReadyBase):
     def __init__(self):
@@ -215,6 +433,39 @@ class SCWorkerReadyForwarded(WorkerReadyBase):
         self.forwarded=True
         ServerCommand.__init__(self, "worker-ready-forward")
 
+class SCWorkerReadyProbe(ServerCommand):
+    """Answer whether this server, or a server it would forward a
+       worker-ready request to, has commands for a worker. Nothing is taken
+       from the queue. The servers that can't tell because they don't know
+       probes are listed separately."""
+    def __init__(self):
+        ServerCommand.__init__(self, "worker-ready-probe")
+
+    def run(self, serverState, request, response):
+        rdr=cpc.command.platform_exec_reader.PlatformExecutableReader()
+        workerData=request.getParam('worker')
+        rdr.readString(workerData,"Worker-reported platform + executables")
+        cwm=CommandWorkerMatcher(rdr.getPlatforms(),
+                                 rdr.getExecutableList(),
+                                 rdr.getWorkerRequirements())
+        hasWork=cwm.hasWork(serverState.getCmdQueue())
+        # the servers that can't tell whether they have work.
+        unknown=[]
+        if not hasWork:
+            nodes, topology = getForwardNodes(serverState.conf, request)
+            # leave the asking server time to get our answer.
+            timeout=0.8*float(request.getParam('timeout'))
+            for node, nodeHasWork in probeNodes(nodes, workerData, topology,
+                                                timeout):
+                if nodeHasWork:
+                    hasWork=True
+                    break
+                unknown.append(node.getId())
+        if hasWork:
+            unknown=[]
+        response.add("", { 'has_work' : hasWork,
+                           'unknown_servers' : unknown })
+
 class CommandFinishError(cpc.util.CpcError):
     pass
 
@@ -265,6 +516,30 @@ class CommandFinishedBase(ServerCommand):
             # backward compatibility
             runfile=request.getFile('rundata')
 
+        haveRemoteData=( request.hasParam('run_data') and
+                         int(request.getParam('run_data'))!=0 )
+        taskQueue=self.finishCommand(serverState, cmdID, workerServer,
+                                     projServer, returncode, cputime, runfile,
+                                     haveRemoteData)
+        if taskQueue is not None:
+            # apply backpressure to the worker if the command's output
+            # generated more tasks than the queue can hold.
+            taskQueue.throttle()
+
+    def finishCommand(self, serverState, cmdID, workerServer, projServer,
+                      returncode, cputime, runfile, haveRemoteData):
+        """Handle a finished command, or forward it to its project server.
+           cmdID = the command's ID
+           workerServer = the name of the server of the worker that ran it
+           projServer = the name of the command's project server
+           returncode = the command's return code, or None
+           cputime = the used cpu time
+           runfile = the file object with the run data, or None
+           haveRemoteData = whether the run data is a remote asset on the
+                            worker server.
+           Returns the task queue to throttle() once the request holds no
+           more resources, or None."""
+        selfName=Node.getSelfNode(serverState.conf).getId()
         if projServer != selfName:
             # forward the request using remote assets. Note that the workers
             # usually don't take this path anyway and forward directly to the
@@ -281,13 +556,13 @@ class CommandFinishedBase(ServerCommand):
                                                       returncode,
                                                       cputime,
                                                       runfile is not None)
+            return None
         else:
             # handle the input locally.
             # get the remote asset if it exists
             if ( workerServer is not None and
                  runfile is None and
-                 ( request.hasParam('run_data') and
-                   int(request.getParam('run_data'))!=0 ) ):
+                 haveRemoteData ):
                 #remote asset tracking
                 log.info("Pulling asset from %s"%workerServer)
                 serverState.getRemoteAssets().addAsset(cmdID, workerServer)
@@ -297,7 +572,12 @@ class CommandFinishedBase(ServerCommand):
                     runfile = rundata.getRawData()
             # now handle the finished command.
             runningCmdList=serverState.getRunningCmdList()
-            runningCmdList.handleFinished(cmdID, returncode, cputime, runfile)
+            # commands that were running before a restart are only known
+            # once their project's state has been read.
+            runningCmdList.waitForRestore(cmdID)
+            with serverState.getRequestPool().bulk():
+                return runningCmdList.handleFinished(cmdID, returncode,
+                                                     cputime, runfile)
 
 class SCCommandFinishedForward(CommandFinishedBase):
     """Handle forwarded finished command. The command output is not sent in
@@ -330,84 +610,138 @@ class SCCommandFailed(CommandFinishedBase):
         self.runLocal(serverState, request, response)
         log.info("Run failure reported on %s"%cmdID)
 
+class SCCommandsFinished(CommandFinishedBase):
+    """Get the finished command data of a batch of commands, and optionally
+       the worker's heartbeat signal, in a single request. The reply
+       contains the status of each command."""
+    def __init__(self):
+        CommandFinishedBase.__init__(self, "commands-finished", False)
+
+    def run(self, serverState, request, response):
+        cmds=json.loads(request.getParam('commands'))
+        selfName=Node.getSelfNode(serverState.conf).getId()
+        results=[]
+        taskQueues=set()
+        for i in range(len(cmds)):
+            cmd=cmds[i]
+            cmdID=cmd['cmd_id']
+            runfile=None
+            if request.haveFile('run_data_%d'%i):
+                runfile=request.getFile('run_data_%d'%i)
+            returncode=None
+            if cmd.get('return_code') is not None:
+                returncode=int(cmd['return_code'])
+            # one failing command shouldn't keep the others from finishing
+            try:
+                taskQueue=self.finishCommand(serverState, cmdID, selfName,
+                                             cmd['project_server'], returncode,
+                                             float(cmd.get('used_cpu_time', 0)),
+                                             runfile, False)
+                if taskQueue is not None:
+                    taskQueues.add(taskQueue)
+                results.append( { 'cmd_id' : cmdID, 'status' : 'OK' } )
+                log.info("Finished command %s"%cmdID)
+            except Exception as e:
+                log.error("Error finishing command %s: %s"%(cmdID, str(e)))
+                results.append( { 'cmd_id' : cmdID, 'status' : 'ERROR',
+                                  'message' : str(e) } )
+        # apply backpressure once for the whole batch.
+        for taskQueue in taskQueues:
+            taskQueue.throttle()
+        retData={ 'commands' : results }
+        if request.hasParam('heartbeat_items'):
+            hbData, faultyItems=handleWorkerHeartbeat(serverState, request, 2)
+            if len(faultyItems)==0:
+                retData['heartbeat']={ 'status' : 'OK', 'data' : hbData }
+            else:
+                hbData['faulty']=faultyItems
+                retData['heartbeat']={ 'status' : 'ERROR', 'data' : hbData }
+        response.add('', data=retData)
+
+
+def handleWorkerHeartbeat(serverState, request, version):
+    """Handle the heartbeat items of a worker's heartbeat signal.
+       version = the heartbeat request version
+       Returns a tuple of the data to return to the worker, and the list of
+       faulty heartbeat items."""
+    workerID=request.getParam('worker_id')
+    workerDir=request.getParam('worker_dir')
+    iteration=request.getParam('iteration')
+    itemsXML=request.getParam('heartbeat_items')
+    hwr=cpc.command.heartbeat.HeartbeatItemReader()
+    hwr.readString(itemsXML, "worker heartbeat items")
+    heartbeatItems=hwr.getItems()
+    # The worker data list
+    workerDataList=serverState.getWorkerDataList()
+    haveADir=False
+    # Order the heartbeat items by destination server
+    destList={}
+    Nhandled=0
+    for item in heartbeatItems:
+        dest=item.getServerName()
+        item.checkRunDir()
+        if item.getHaveRunDir():
+            haveADir=True
+        if dest in destList:
+            destList[dest].append(item)
+        else:
+            destList[dest]=[item]
+        Nhandled+=1
+    if haveADir:
+        if iteration!="final":
+            workerDataList.add(workerDir)
+    if iteration=="final":
+        workerDataList.remove(workerDir)
+    # get my own name to compare
+    selfNode= Node.getSelfNode(serverState.conf)
+    selfName = selfNode.getId()
+
+    #updating the status at every hearbeat. This is how we knwo that the worker
+    # is still talking to the server
+    serverState.setWorkerState(WorkerStatus.WORKER_STATUS_CONNECTED,workerID,
+                               request.headers['originating-client'])
+    # now iterate over the destinations, and send them their heartbeat
+    # items. The forwarder pools the items of all our workers per
+    # destination.
+    faultyItems=[]
+    for dest, items in destList.iteritems():
+        if dest == selfName:
+            ret=serverState.getRunningCmdList().ping(workerID, workerDir,
+                                                     iteration, items, True,
+                                                     faultyItems)
+        else:
+            co=StringIO()
+            co.write('<heartbeat worker_id="%s" worker_server_id="%s">'%
+                     (workerID, selfName))
+            for item in items:
+                item.writeXML(co)
+            co.write('</heartbeat>')
+            retitems=serverState.getHeartbeatForwarder().forward(dest,
+                                                         selfName, workerID,
+                                                         workerDir, iteration,
+                                                         co.getvalue())
+            faultyItems.extend(retitems)
+    if version > 1:
+        retData = { 'heartbeat-time' : serverState.conf.
+                                            getHeartbeatTime(),
+                    'random-file': workerDataList.getRnd(workerDir) }
+    else:
+        retData=serverState.conf.getHeartbeatTime()
+    log.info("Handled %d heartbeat signal items."%(Nhandled))
+    return (retData, faultyItems)
+
+
 class SCWorkerHeartbeat(ServerCommand):
     """Handle a worker's heartbeat signal."""
     def __init__(self):
         ServerCommand.__init__(self, "worker-heartbeat")
 
     def run(self, serverState, request, response):
-        workerID=request.getParam('worker_id')
-        workerDir=request.getParam('worker_dir')
-        iteration=request.getParam('iteration')
-        itemsXML=request.getParam('heartbeat_items')
         version=0
         if request.hasParam('version'):
             version=int(request.getParam('version'))
-        hwr=cpc.command.heartbeat.HeartbeatItemReader()
-        hwr.readString(itemsXML, "worker heartbeat items")
-        heartbeatItems=hwr.getItems()
-        # The worker data list
-        workerDataList=serverState.getWorkerDataList()
-        haveADir=False
-        # Order the heartbeat items by destination server
-        destList={}
-        Nhandled=0
-        for item in heartbeatItems:
-            dest=item.getServerName()
-            item.checkRunDir()
-            if item.getHaveRunDir():
-                haveADir=True
-            if dest in destList:
-                destList[dest].append(item)
-            else:
-                destList[dest]=[item]
-            Nhandled+=1
-        if haveADir:
-            if iteration!="final":
-                workerDataList.add(workerDir)
-        if iteration=="final":
-            workerDataList.remove(workerDir)
-        # get my own name to compare
-        selfNode= Node.getSelfNode(serverState.conf)
-        selfName = selfNode.getId()
-
-        #updating the status at every hearbeat. This is how we knwo that the worker
-        # is still talking to the server
-        serverState.setWorkerState(WorkerStatus.WORKER_STATUS_CONNECTED,workerID,
-                                   request.headers['originating-client'])
-        # now iterate over the destinations, and send them their heartbeat
-        # items.
-        # Once we have many workers, this would be a place to pool heartbeat
-        # items and send them as one big request.
-        faultyItems=[]
-        for dest, items in destList.iteritems():
-            if dest == selfName:
-                ret=serverState.getRunningCmdList().ping(workerID, workerDir,
-                                                         iteration, items, True,
-                                                         faultyItems)
-            else:
-                msg=ServerMessage(dest)
-                co=StringIO()
-                co.write('<heartbeat worker_id="%s" worker_server_id="%s">'%
-                         (workerID, selfName))
-                for item in items:
-                    item.writeXML(co)
-                co.write('</heartbeat>')
-                resp = msg.heartbeatForwardedRequest(workerID, workerDir,
-                                                     selfName, iteration,
-                                                     co.getvalue())
-                presp=ProcessedResponse(resp)
-                if presp.getStatus() != "OK":
-                    log.info("Heartbeat response from %s not OK"%dest)
-                    retitems=presp.getData()
-                    for item in retitems:
-                        faultyItems.append(item)
-        if version > 1:
-            retData = { 'heartbeat-time' : serverState.conf.
-                                                getHeartbeatTime(),
-                        'random-file': workerDataList.getRnd(workerDir) }
-        else:
-            retData=serverState.conf.getHeartbeatTime()
+        retData, faultyItems=handleWorkerHeartbeat(serverState, request,
+                                                   version)
         if len(faultyItems)==0:
             response.add('', data=retData)
         else:
@@ -415,7 +749,6 @@ class SCWorkerHeartbeat(ServerCommand):
                 retData['faulty']=faultyItems
             # TODO: per-workload error reporting
             response.add('Heatbeat NOT OK', status="ERROR", data=retData)
-        log.info("Handled %d heartbeat signal items."%(Nhandled))
 
 
 class SCHeartbeatForwarded(ServerCommand):
@@ -442,6 +775,34 @@ class SCHeartbeatForwarded(ServerCommand):
             response.add('Heatbeat NOT OK', status="ERROR", data=faultyItems)
         log.info("Handled %d forwarded heartbeat signal items."%(Nhandled))
 
+class SCHeartbeatForwardedBatch(ServerCommand):
+    """Handle the heartbeat signals of several workers, forwarded by their
+       server in one request. The reply contains the faulty items of each
+       signal."""
+    def __init__(self):
+        ServerCommand.__init__(self, "heartbeat-forward-batch")
+
+    def run(self, serverState, request, response):
+        heartbeats=json.loads(request.getParam('heartbeats'))
+        ret=[]
+        Nhandled=0
+        for heartbeat in heartbeats:
+            itemsXML=heartbeat['heartbeat_items']
+            log.log(cpc.util.log.TRACE, 'items: %s'%itemsXML)
+            hwr=cpc.command.heartbeat.HeartbeatItemReader()
+            hwr.readString(itemsXML, "worker heartbeat items")
+            faultyItems=[]
+            Nhandled+=len(hwr.getItems())
+            serverState.getRunningCmdList().ping(heartbeat['worker_id'],
+                                                 heartbeat['worker_dir'],
+                                                 heartbeat['iteration'],
+                                                 hwr.getItems(), False,
+                                                 faultyItems)
+            ret.append(faultyItems)
+        response.add('', data=ret)
+        log.info("Handled %d forwarded heartbeat signal items from %d workers."%
+                 (Nhandled, len(heartbeats)))
+
 class SCDeadWorkerFetch(ServerCommand):
     """Attempt to fetch the data from a dead worker."""
     def __init__(self):
@@ -457,13 +818,24 @@ class SCDeadWorkerFetch(ServerCommand):
         if workerDataList.checkDirectory(workerDir, [runDir]):
             # first check whether we have any of these files
             if os.path.isdir(runDir):
-                tff=tempfile.TemporaryFile()
-                tf=tarfile.open(fileobj=tff, mode="w:gz")
-                tf.add(runDir, arcname=".", recursive=True)
-                tf.close()
-                del(tf)
-                tff.seek(0)
-                response.setFile(tff,'application/x-tar')
+                codec=cpc.util.transfer.chooseCodec(
+                        request.headers.get(cpc.util.transfer.acceptHeader),
+                        serverState.conf.getTransferCodec())
+                requestPool=serverState.getRequestPool()
+                def writeArchive(outf):
+                    tf=cpc.util.transfer.TarWriter(outf, codec)
+                    with requestPool.bulk():
+                        tf.add(runDir, arcname=".", recursive=True)
+                        tf.close()
+                if request.headers.has_key(
+                                    cpc.util.transfer.acceptStreamHeader):
+                    response.setStream(writeArchive, 'application/x-tar')
+                else:
+                    tff=tempfile.TemporaryFile()
+                    writeArchive(tff)
+                    tff.seek(0)
+                    response.setFile(tff,'application/x-tar')
+                response.headers[cpc.util.transfer.codecHeader]=codec
                 request.setFlag('remove', True)
             response.add('Returning data')
             log.info("Fetched data from dead worker")
@@ -17,9 +17,14 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
-from collections import deque
-from threading import Lock
+try:
+    from collections import OrderedDict
+except ImportError:
+    from cpc.util.ordered_dict import OrderedDict
+from threading import Lock, Condition
+import heapq
 import logging
+import time
 
 log=logging.getLogger(__name__)
 
@@ -32,7 +37,20 @@ class QueueableItem(object):
     """A single queueable item; can be activated/deactivated."""
     def __init__(self):
         self.active=True
+        self.cmdQueue=None
         self.queue=None
+        self.bucket=None
+        # the time the item was last queued as active
+        self.queuedTime=None
+        # the queue's sequence number for the item: the order in which 
+        # items were put in their current priority bucket.
+        self.queueSeqNr=None
+
+    def getExecutableKey(self):
+        """Get the executable the item needs to run, as a hashable tuple of
+           (executable name, minimum version string, maximum version string).
+           Items with no version requirements return None for those."""
+        return (getattr(self, 'executable', None), None, None)
 
     def deactivate(self):
         self.active=False
@@ -42,46 +60,190 @@ class QueueableItem(object):
         if self.cmdQueue is not None:
             self.cmdQueue._activateCommand(self)
 
-    def setQueue(self, cmdQueue, queue):
-        """Set the item to be part of a specific queue."""
+    def setQueue(self, cmdQueue, queue, bucket=None):
+        """Set the item to be part of a specific queue.
+           cmdQueue = the command queue object
+           queue = the priority queue within the command queue
+           bucket = the matching bucket's priority queue (or None)."""
         self.cmdQueue=cmdQueue
         self.queue=queue
+        self.bucket=bucket
 
 
 class CmdQueue(object):
+    """The command queue. 
+
+       Commands are kept in one bucket per priority; each bucket is an 
+       ordered dict keyed by command ID, so that items keep their FIFO order 
+       within a priority but can be unlinked in O(1). Next to the buckets,
+       the queue keeps an index of all queued items by ID, and secondary 
+       indices by project and by executable name.
+
+       Active items are also sorted into matching buckets: one set of 
+       priority queues per (executable name, version range, project) 
+       combination, so that a worker only needs to look at the commands 
+       it could run (see getUntilBuckets())."""
     PRIO_LOW_BOUND = -30 #Constant
     PRIO_HIGH_BOUND = 30 #Constant
 
     def __init__(self):
-        self.data = []
-        # this is a list of deques with the highest priority queue first.
-        self.queue = [ deque() for x in xrange(CmdQueue.PRIO_LOW_BOUND-1,
-                                               CmdQueue.PRIO_HIGH_BOUND)]
+        # this is a list of buckets with the highest priority bucket first.
+        self.queue = [ OrderedDict() for x in 
+                       xrange(CmdQueue.PRIO_LOW_BOUND-1,
+                              CmdQueue.PRIO_HIGH_BOUND) ]
         # TODO: finer grained locks. For now we have a single global lock.
         self.lock=Lock()
+        # notified when active commands are added. See waitForAdd()
+        self.addCond=Condition(self.lock)
+        # the number of times an active command has been added
+        self.nAdded=0
+        # the last item sequence number handed out. See getUntilBuckets()
+        self.seqNr=0
         # The set of items popped from the queue that were inactive.
-        self.inactiveItems = deque()
+        self.inactiveItems = OrderedDict()
+        # all queued items (active and inactive) by command ID
+        self.items = dict()
+        # dict of project -> dict of command ID -> queued item
+        self.projectIndex = dict()
+        # dict of executable name -> dict of command ID -> queued item
+        self.executableIndex = dict()
+        # dict of bucket key -> list of priority buckets, highest first.
+        # See getBucketKey()
+        self.buckets = dict()
 
     def getSize(self):
         """Count the number of elements in the queue."""
-        size=0
         with self.lock:
-            for dq in self.queue:
-                size+=len(dq)
-        return size
+            return len(self.items) - len(self.inactiveItems)
 
-    def _getDeque(self, prio):
-        """Low-level function that gets the deque associated with a priority
+    @staticmethod
+    def _getPrioIndex(prio):
+        """Get the index into the list of priority queues for a priority.
            prio = the priority (out-of-bound priorities are mapped onto maximum
-                                and minimum priorities).
-           returns: a deque. """
+                                and minimum priorities)."""
         if prio < CmdQueue.PRIO_LOW_BOUND:
             prio = CmdQueue.PRIO_LOW_BOUND
         if prio > CmdQueue.PRIO_HIGH_BOUND:
             prio = CmdQueue.PRIO_HIGH_BOUND
         # the highest priority queue is first
-        p= (CmdQueue.PRIO_HIGH_BOUND - prio)
-        return self.queue[p]
+        return (CmdQueue.PRIO_HIGH_BOUND - prio)
+
+    def _getDeque(self, prio):
+        """Low-level function that gets the bucket associated with a priority
+           prio = the priority (out-of-bound priorities are mapped onto maximum
+                                and minimum priorities).
+           returns: an ordered dict of command ID -> item. """
+        return self.queue[self._getPrioIndex(prio)]
+
+    @staticmethod
+    def _getProject(item):
+        """Get the project associated with an item (or None)."""
+        task=getattr(item, 'task', None)
+        if task is None:
+            return None
+        return task.project
+
+    @staticmethod
+    def getBucketKey(item):
+        """Get the matching bucket key for an item: a tuple of 
+           (executable name, minimum version string, maximum version string,
+            project). The first three elements are the item's 
+           getExecutableKey()."""
+        return item.getExecutableKey() + (CmdQueue._getProject(item),)
+
+    def _getBucket(self, item, prio):
+        """Get the matching bucket's priority queue for an item, creating it
+           if it doesn't exist. Must be called with the lock held."""
+        key=self.getBucketKey(item)
+        if key not in self.buckets:
+            self.buckets[key]=[ OrderedDict() for x in 
+                                xrange(len(self.queue)) ]
+        return self.buckets[key][self._getPrioIndex(prio)]
+
+    def _index(self, item):
+        """Add an item to the ID index and the secondary indices. 
+           Must be called with the lock held."""
+        self.items[item.id]=item
+        project=self._getProject(item)
+        self.projectIndex.setdefault(project, dict())[item.id]=item
+        executable=getattr(item, 'executable', None)
+        self.executableIndex.setdefault(executable, dict())[item.id]=item
+
+    def _unindex(self, item):
+        """Remove an item from the ID index and the secondary indices.
+           Must be called with the lock held."""
+        del self.items[item.id]
+        project=self._getProject(item)
+        pdict=self.projectIndex[project]
+        del pdict[item.id]
+        if len(pdict) == 0:
+            del self.projectIndex[project]
+        executable=getattr(item, 'executable', None)
+        edict=self.executableIndex[executable]
+        del edict[item.id]
+        if len(edict) == 0:
+            del self.executableIndex[executable]
+
+    def _unbucket(self, item):
+        """Remove an item from its matching bucket. Must be called with the 
+           lock held."""
+        if item.bucket is None:
+            return
+        del item.bucket[item.id]
+        if len(item.bucket) == 0:
+            key=self.getBucketKey(item)
+            empty=True
+            for dq in self.buckets[key]:
+                if len(dq) > 0:
+                    empty=False
+                    break
+            if empty:
+                del self.buckets[key]
+        item.bucket=None
+
+    def _unlink(self, item):
+        """Remove an item from its bucket and from all indices. 
+           Must be called with the lock held."""
+        del item.queue[item.id]
+        self._unbucket(item)
+        self._unindex(item)
+        item.setQueue(None, None)
+
+    def _moveInactive(self, dq, item):
+        """Move an item from a priority bucket to the inactive items.
+           Must be called with the lock held."""
+        del dq[item.id]
+        self._unbucket(item)
+        self.inactiveItems[item.id]=item
+        item.setQueue(self, self.inactiveItems)
+
+    def _add(self, command):
+        """Non-locking version of add(). Returns whether the command was
+           put in a priority bucket (i.e. whether it is active)."""
+        wasActive=( command.cmdQueue is self and
+                    command.queue is not None and
+                    command.queue is not self.inactiveItems )
+        if command.cmdQueue is self and command.queue is not None:
+            # it's already queued: take it out of its old place first
+            self._unlink(command)
+        bucket=None
+        if command.active:
+            if not wasActive:
+                command.queuedTime=time.time()
+            self.seqNr+=1
+            command.queueSeqNr=self.seqNr
+            prio=command.getFullPriority()
+            dq=self._getDeque(prio)
+            bucket=self._getBucket(command, prio)
+            bucket[command.id]=command
+            ret=True
+        else:
+            dq=self.inactiveItems
+            ret=False
+        dq[command.id]=command
+        command.setQueue(self, dq, bucket)
+        self._index(command)
+        return ret
 
     def add(self,command):
         """
@@ -90,42 +252,43 @@ class CmdQueue(object):
             result : command put in queue, queue sorted in priority order of
                      commands, return true
         """
-        ret=False
         # an ID lives for as long as a command is queued/running
         command.tryGenID()
         with self.lock:
-            if command.active:
-                prio=command.getFullPriority()
-                dq=self._getDeque(prio)
-                dq.append(command)
-                command.setQueue(self, dq)
-                ret=True
-            else:
-                self.inactiveItems.append(command)
-                command.setQueue(self, self.inactiveItems)
-                ret=False
+            if self._add(command):
+                self._notifyAdd()
         return True
 
+    def _notifyAdd(self):
+        """Wake up the threads waiting for new commands. Must be called with
+           the lock held."""
+        self.nAdded+=1
+        self.addCond.notifyAll()
+
+    def getAddCount(self):
+        """Get the number of times an active command has been added (or
+           activated). Use with waitForAdd()."""
+        with self.lock:
+            return self.nAdded
+
+    def waitForAdd(self, addCount, timeout):
+        """Wait until an active command is added, unless one has already
+           been added since getAddCount() returned addCount.
+           addCount = the add count from getAddCount() or waitForAdd()
+           timeout = the maximum time to wait in seconds
+           returns: the new add count (equal to addCount on a time-out)."""
+        with self.lock:
+            if self.nAdded == addCount:
+                self.addCond.wait(timeout)
+            return self.nAdded
+
 
     def remove(self, cmd):
-        """Remove a specific command.
-           NOTE: this is an O(N) operation for N=number of items in the queue"""
-        nremoved=0
+        """Remove a specific command. This is an O(1) operation."""
         with self.lock:
-            dq=cmd.queue
-            if not dq in self.queue:
+            if cmd.cmdQueue is not self or cmd.queue is None:
                 raise QueueError("Tried to remove item from wrong queue.")
-            #for dq in self.queue:
-            n=len(dq)
-            for i in xrange(n):
-                if dq[0] == cmd:
-                    nremoved+=1
-                    dq[0].setQueue(None, None)
-                    dq.popleft()
-                else:
-                    dq.rotate(-1)
-            #if nremoved > 0:
-            #    return
+            self._unlink(cmd)
 
     def get(self):
         """ description: gets a single element with the highest priority from
@@ -138,12 +301,15 @@ class CmdQueue(object):
         with self.lock:
             for dq in self.queue:
                 while len(dq)>0:
-                    item=dq.popleft()
+                    cmdID, item=dq.popitem(last=False)
+                    self._unbucket(item)
                     if item.active:
+                        self._unindex(item)
+                        item.setQueue(None, None)
                         return item
                     else:
                         item.setQueue(self, self.inactiveItems)
-                        self.inactiveItems.append(item)
+                        self.inactiveItems[cmdID]=item
             return None
 
     def getUntil(self, fn, parm):
@@ -161,99 +327,154 @@ class CmdQueue(object):
         cont=True
         with self.lock:
             for dq in self.queue:
-                n=len(dq)
-                nback=0
-                for i in xrange(n):
-                    if dq[0].active:
-                        cont, doPop=fn(parm, dq[0])
+                if len(dq) == 0:
+                    continue
+                inactive=[]
+                for item in dq.itervalues():
+                    if item.active:
+                        cont, doPop=fn(parm, item)
+                        if doPop:
+                            ret.append(item)
+                        if not cont:
+                            break
+                    else:
+                        inactive.append(item)
+                # the bucket can't be modified while iterating over it.
+                for item in inactive:
+                    self._moveInactive(dq, item)
+                if not cont:
+                    break
+            for item in ret:
+                self._unlink(item)
+        return ret
+
+    def getUntilBuckets(self, bucketFn, fn, parm):
+        """Get a number of items from the queue, like getUntil(), but only 
+           looking at the matching buckets selected by a function. 
+           bucketFn = the function to select buckets with. It will be called
+                      as bucketFn(parm, key) with key a bucket key (see 
+                      getBucketKey()), and should return whether the items
+                      in that bucket should be considered.
+           fn = the function to test each item with (see getUntil()).
+           parm = a parameter for the functions bucketFn and fn.
+           returns: the list of items removed from the queue. Items are 
+                    considered in the same order as with getUntil(): by
+                    priority, and in queued order within a priority."""
+        ret=[]
+        cont=True
+        with self.lock:
+            keys=[ key for key in self.buckets.iterkeys() 
+                   if bucketFn(parm, key) ]
+            for i in xrange(len(self.queue)):
+                dqs=[ self.buckets[key][i] for key in keys 
+                      if key in self.buckets and 
+                         len(self.buckets[key][i]) > 0 ]
+                if len(dqs) == 0:
+                    continue
+                # merge the buckets by sequence number to get the items in
+                # the order of the priority's bucket.
+                inactive=[]
+                for seqNr, item in heapq.merge(*[ 
+                            ( (item.queueSeqNr, item) for item in 
+                              dq.itervalues() ) for dq in dqs ]):
+                    if item.active:
+                        cont, doPop=fn(parm, item)
                         if doPop:
-                            dq[0].setQueue(None, None)
-                            ret.append(dq.popleft())
-                        else:
-                            dq.rotate(-1)
-                            nback+=1
+                            ret.append(item)
                         if not cont:
                             break
                     else:
-                        # append the inactive item to the inactiveItems queue
-                        dq[0].setQueue(self, self.inactiveItems)
-                        self.inactiveItems.append(dq.popleft())
-                dq.rotate(nback)
+                        inactive.append(item)
+                # the buckets can't be modified while iterating over them.
+                for item in inactive:
+                    self._moveInactive(item.queue, item)
                 if not cont:
                     break
+            for item in ret:
+                self._unlink(item)
         return ret
 
+    def hasBuckets(self, bucketFn, parm):
+        """Check whether any of the matching buckets selected by a function
+           (see getUntilBuckets()) holds an active item, without removing
+           anything from the queue.
+           bucketFn = the function to select buckets with
+           parm = a parameter for bucketFn
+           returns: True if there is such an item."""
+        with self.lock:
+            for key, dqs in self.buckets.iteritems():
+                if not bucketFn(parm, key):
+                    continue
+                for dq in dqs:
+                    for item in dq.itervalues():
+                        if item.active:
+                            return True
+        return False
+
     def _exists(self, commandID):
         # non-locking version of public exists()
-        #NOTE could be slow
-        for value in self.queue.itervalues():
-            for it in value:
-                if(it.id == commandID):
-                    return True
-        # check the inactive items
-        for it in self.inactiveItems:
-            if(it.id == commandID):
-                return True
-        return False
+        return commandID in self.items
 
     def exists(self,commandID):
-        """Check whether commandID exists in the queue.
-           NOTE: this is an O(N) operation for N=number of items in the queue"""
+        """Check whether commandID exists in the queue (either active or
+           inactive). This is an O(1) operation."""
         with self.lock:
             return self._exists(commandID)
 
+    def find(self, commandID):
+        """Get the queued command (either active or inactive) with the given
+           ID, or None if there is none. This is an O(1) operation."""
+        with self.lock:
+            return self.items.get(commandID)
+
     def list(self):
         """Return a list with all active queued items."""
         ret=[]
         with self.lock:
             for dq in self.queue:
-                for item in dq:
+                for item in dq.itervalues():
                     if item.active:
                         ret.append(item)
         return ret
 
+    def listByProject(self, project):
+        """Return a list with all queued items (active and inactive) 
+           belonging to a project."""
+        with self.lock:
+            return self.projectIndex.get(project, dict()).values()
 
-    def _purgeQueueProject(self, queue, project):
-        """Purge a single queue from a project."""
-        n=len(queue)
-        nremoved=0
-        for i in xrange(n):
-            if queue[0].task.project == project:
-                nremoved+=1
-                queue[0].setQueue(None, None)
-                queue.popleft()
-            else:
-                queue.rotate(-1)
-        return nremoved
+    def listByExecutable(self, executable):
+        """Return a list with all queued items (active and inactive) with
+           a specific executable name."""
+        with self.lock:
+            return self.executableIndex.get(executable, dict()).values()
 
     def deleteByProject(self, project):
         """Delete all commands related to a project. Returns number of commands
            deleted.
 
-           NOTE: this is an O(N) operation for N=number of items in the queue"""
-        nremoved=0
+           This is an O(k) operation for k=number of items of the project."""
         with self.lock:
-            for dq in self.queue:
-                nremoved+=self._purgeQueueProject(dq, project)
-            nremoved+=self._purgeQueueProject(self.inactiveItems, project)
-        return nremoved
+            items=self.projectIndex.get(project, dict()).values()
+            for item in items:
+                self._unlink(item)
+        return len(items)
 
     def _activateCommand(self, command):
         """Activate the command."""
-        if command.queue == self.inactiveItems:
-            with self.lock:
-                self.inactiveItems.remove(command)
-            self.add(command)
+        with self.lock:
+            if (command.cmdQueue is self and 
+                command.queue is self.inactiveItems):
+                if self._add(command):
+                    self._notifyAdd()
 
     #Helper function for unit tests
     def indexOfCommand(self,command):
         i=0
         with self.lock:
             for dq in self.queue:
-                for item in dq:
+                for item in dq.itervalues():
                     if(item == command):
                         return i
                     i+=1
         return None
-
-
@@ -23,6 +23,9 @@ import shutil
 import os
 import sys
 import traceback
+import xml.sax
+import xml.sax.handler
+import xml.sax.saxutils
 try:
     from cStringIO import StringIO
 except ImportError:
@@ -31,6 +34,7 @@ except ImportError:
 
 
 import cpc.util
+import cpc.util.transfer
 import cpc.command.heartbeat
 #from cpc.util.conf.server_conf import ServerConf
 from cpc.server.message.server_message import ServerMessage
@@ -126,6 +130,97 @@ class RunningCommand(object):
         ret['data_accessible']=self.haveData
         return ret
 
+    def writeXML(self, outf):
+        """Write the data needed to restore this running command as XML."""
+        outf.write('<running-command cmd_id=%s server=%s'%
+                   (xml.sax.saxutils.quoteattr(self.cmd.id),
+                    xml.sax.saxutils.quoteattr(self.workerServer)))
+        outf.write(' heartbeat_interval="%d" last_heard="%.3f"'%
+                   (self.heartbeatInterval, self.lastHeard))
+        if self.workerID is not None:
+            outf.write(' worker_id=%s'%
+                       xml.sax.saxutils.quoteattr(self.workerID))
+        if self.workerDir is not None:
+            outf.write(' worker_dir=%s'%
+                       xml.sax.saxutils.quoteattr(self.workerDir))
+        if self.runDir is not None:
+            outf.write(' run_dir=%s'%xml.sax.saxutils.quoteattr(self.runDir))
+        outf.write(' is_local="%s" have_data="%s"/>\n'%
+                   (str(self.isLocal).lower(), str(self.haveData).lower()))
+
+class RunningCmdListReader(xml.sax.handler.ContentHandler):
+    """XML reader for the running command list and its journal."""
+    def __init__(self):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.commands=dict()
+        self.loc=None
+
+    def getCommands(self):
+        """Get the running command data as a dict of command IDs to dicts
+           with the running command's properties."""
+        return self.commands
+
+    def read(self, filename):
+        """Read the running command list snapshot."""
+        parser=xml.sax.make_parser()
+        parser.setContentHandler(self)
+        parser.parse(filename)
+
+    def readJournal(self, filename):
+        """Read the running command list journal. Only complete lines are
+           read: the last one may have been cut off by a crash."""
+        inf=open(filename, 'r')
+        try:
+            data=inf.read()
+        finally:
+            inf.close()
+        end=data.rfind('\n')
+        if end < 0:
+            return
+        if end+1 < len(data):
+            log.warning("Ignoring incomplete last entry of %s"%filename)
+        parser=xml.sax.make_parser()
+        parser.setContentHandler(self)
+        try:
+            parser.feed('<running-command-journal>')
+            parser.feed(data[:end+1])
+            parser.feed('</running-command-journal>')
+            parser.close()
+        except xml.sax.SAXParseException as e:
+            log.error("Can't read running command journal %s: %s"%
+                      (filename, str(e)))
+
+    def setDocumentLocator(self, locator):
+        self.loc=locator
+
+    def startElement(self, name, attrs):
+        if name == "running-command":
+            for attr in [ 'cmd_id', 'server', 'heartbeat_interval' ]:
+                if not attrs.has_key(attr):
+                    raise cpc.util.CpcXMLError(
+                                    "running-command has no %s"%attr, self.loc)
+            cmd=dict()
+            cmd['server']=attrs.getValue('server')
+            cmd['heartbeat_interval']=int(attrs.getValue('heartbeat_interval'))
+            for attr in [ 'worker_id', 'worker_dir', 'run_dir' ]:
+                if attrs.has_key(attr):
+                    cmd[attr]=attrs.getValue(attr)
+                else:
+                    cmd[attr]=None
+            if attrs.has_key('last_heard'):
+                cmd['last_heard']=float(attrs.getValue('last_heard'))
+            cmd['is_local']=cpc.util.getBooleanAttribute(attrs, 'is_local')
+            cmd['have_data']=cpc.util.getBooleanAttribute(attrs, 'have_data')
+            self.commands[attrs.getValue('cmd_id')]=cmd
+        elif name == "removed-command":
+            if not attrs.has_key('cmd_id'):
+                raise cpc.util.CpcXMLError("removed-command has no cmd_id",
+                                           self.loc)
+            cmdID=attrs.getValue('cmd_id')
+            if cmdID in self.commands:
+                del self.commands[cmdID]
+
+
 class WorkerDataList(object):
     """Maintains a list of directories used by workers connected to this
        server. Only these directories are fetchable with dead-worker-fetch.
@@ -208,7 +303,28 @@ class RunningCmdList(object):
         self.runningCommands=dict()
         self.workerData=workerData
         self.lock=threading.Lock()
+        # notified when restored commands are restored or dropped.
+        self.restoreCond=threading.Condition(self.lock)
         self.thread=None
+        # the running command list is written out in full with writeState();
+        # changes in between are appended to a journal file.
+        self.filename=conf.getHeartbeatFile()
+        self.journalFilename="%s.journal"%self.filename
+        # the journal entries rendered with _journal(), in order, that
+        # haven't been appended to the journal file yet. See _writeJournal()
+        self.journalEntries=[]
+        # serializes writes to the journal file. Must be locked before 
+        # self.lock if both are needed.
+        self.journalLock=threading.Lock()
+        # the data of the running commands that were read in, but whose
+        # commands haven't been restored yet. None if no restore is going on.
+        self.restoreData=None
+        # statistics of the time between queuing commands and sending them
+        # to workers.
+        self.dispatchStats = { 'commands' : 0,
+                               'total_latency' : 0.,
+                               'max_latency' : 0.,
+                               'last_latency' : 0. }
 
 
     def startHeartbeatThread(self):
@@ -221,8 +337,11 @@ class RunningCmdList(object):
 
     def add(self, cmds, workerServer, heartbeatInterval):
         """Add a set of commands sent to a specific worker."""
+        now=time.time()
         with self.lock:
             for cmd in cmds:
+                if cmd.queuedTime is not None:
+                    self._addDispatchLatency(now-cmd.queuedTime)
                 if cmd.id in self.runningCommands:
                     raise RunningCmdListError("Duplicate command ID")
                 # the worker ID and directory will be set when the first
@@ -231,6 +350,8 @@ class RunningCmdList(object):
                                   heartbeatInterval)
                 self.runningCommands[cmd.id] = rc
                 cmd.setRunning(True, workerServer)
+            self._journal(cmds=cmds)
+        self._writeJournal()
 
     def remove(self, cmd):
         """Remove a command from the list, or throw a HeartbeatListError
@@ -241,6 +362,8 @@ class RunningCmdList(object):
                 raise RunningCmdListNotFoundError(cmd.id)
             del self.runningCommands[cmd.id]
             cmd.setRunning(False)
+            self._journal(removedIDs=[cmd.id])
+        self._writeJournal()
 
     def handleFinished(self, cmdID, returncode, cputime, runfile):
         """Handle a finished command (successful or otherwise), with optional
@@ -248,29 +371,50 @@ class RunningCmdList(object):
            cmd = the command to remove
            returncode = the return code
            runfile = None or a file handle to the tarfile containing run data
+           Returns the task queue of the command's project, which the
+           caller should throttle() once it holds no more resources, or
+           None.
            """
         task=None
         with self.lock:
+            self._waitForRestore(cmdID)
             # remove it from the list
             if cmdID not in self.runningCommands:
                 raise RunningCmdListNotFoundError(cmdID)
             cmd=self.runningCommands[cmdID].cmd
             del self.runningCommands[cmdID]
             cmd.setRunning(False)
+            self._journal(removedIDs=[cmdID])
         # the command is now removed from the list so we can stop locking.
+        self._writeJournal()
         if runfile is not None:
             log.debug("extracting file for %s to dir %s"%(cmd.id,cmd.getDir()))
-            cpc.util.file.extractSafely(cmd.getDir(), fileobj=runfile)
-            self._handleFinishedCmd(cmd, returncode, cputime)
+            cpc.util.transfer.extractResults(cmd.getDir(), runfile)
+            return self._handleFinishedCmd(cmd, returncode, cputime)
         else:
             # there was no output. Try again
             cmd.addCputime(cputime)
             self.cmdQueue.add(cmd)
+            return None
+
+    def waitForRestore(self, cmdID):
+        """Wait until a command that was running before a restart is
+           restored, if it hasn't been yet."""
+        with self.lock:
+            self._waitForRestore(cmdID)
+
+    def _waitForRestore(self, cmdID):
+        """Wait until a command is restored. Must be called with self.lock
+           locked."""
+        while self.restoreData is not None and cmdID in self.restoreData:
+            log.debug("Waiting for running command %s to be restored"%cmdID)
+            self.restoreCond.wait()
 
     def _handleFinishedCmd(self, cmd, returncode, cputime):
         """Handle the command finishing itself. The command must be removed
            from the list first using self.lock, so no two threads own this
-           command first."""
+           command first.
+           Returns the task queue of the command's project, or None."""
         # handle the associated status
         task=cmd.getTask()
         cmd.setReturncode(returncode)
@@ -289,6 +433,9 @@ class RunningCmdList(object):
                 self.cmdQueue.add(ncmd)
         if finished:
             task.handleOutput()
+        if task is not None:
+            return task.getProject().getQueue()
+        return None
 
     def getCmdList(self):
         """Return a list with all running commands as command objects."""
@@ -316,7 +463,31 @@ class RunningCmdList(object):
             with self.lock:
                 cmdid=item.getCmdID()
                 log.debug("Heartbeat signal for command %s"%cmdid)
-                if cmdid not in self.runningCommands:
+                if ( cmdid not in self.runningCommands and
+                     self.restoreData is not None and
+                     cmdid in self.restoreData ):
+                    # the command's project hasn't been read yet: it will
+                    # be restored with the worker data from this heartbeat.
+                    attrs=self.restoreData[cmdid]
+                    cwid=attrs['worker_id']
+                    if (cwid is not None) and (cwid != workerID):
+                        item.setState(item.stateWrongWorker)
+                        log.info("Worker ID for %s not found"%cmdid)
+                        OK=False
+                        faultyItems.append(item.cmdID)
+                    else:
+                        item.setState(item.stateOK)
+                        haveData=item.getHaveRunDir()
+                        if haveData is None:
+                            haveData=False
+                        attrs['worker_id']=workerID
+                        attrs['worker_dir']=workerDir
+                        attrs['run_dir']=item.getRunDir()
+                        attrs['is_local']=isLocal
+                        attrs['have_data']=haveData
+                        attrs['last_heard']=time.time()
+                        attrs['changed']=True
+                elif cmdid not in self.runningCommands:
                     item.setState(item.stateNotFound)
                     log.info("Heartbeat item %s not found"%cmdid)
                     faultyItems.append(item.cmdID)
@@ -331,16 +502,24 @@ class RunningCmdList(object):
                     else:
                         item.setState(item.stateOK)
                         rc=self.runningCommands[cmdid]
+                        haveData=item.getHaveRunDir()
+                        if haveData is None:
+                            haveData=False
+                        changed=( cwid is None or
+                                  rc.getWorkerDir() != workerDir or
+                                  rc.getRunDir() != item.getRunDir() or
+                                  rc.getIsLocal() != isLocal or
+                                  rc.getHaveData() != haveData )
                         if cwid is None:
                             rc.setWorkerID(workerID)
                         rc.setWorkerDir(workerDir)
                         rc.setRunDir(item.getRunDir())
                         rc.setIsLocal(isLocal)
-                        haveData=item.getHaveRunDir()
-                        if haveData is None:
-                            haveData=False
                         rc.setHaveData(haveData)
                         rc.ping()
+                        if changed:
+                            self._journal(cmds=[rc.cmd])
+        self._writeJournal()
         return OK
 
     def toJSON(self):
@@ -352,10 +531,144 @@ class RunningCmdList(object):
         ret['heartbeat_items']=retlist
         return ret
 
-    def readState(self):
-        pass
+    def _addDispatchLatency(self, latency):
+        """Record the time between queuing and dispatching a command. Must
+           be called with self.lock locked."""
+        self.dispatchStats['commands'] += 1
+        self.dispatchStats['total_latency'] += latency
+        self.dispatchStats['last_latency'] = latency
+        if latency > self.dispatchStats['max_latency']:
+            self.dispatchStats['max_latency'] = latency
+
+    def getDispatchStats(self):
+        """Get a dict with the number of commands sent to workers, and the
+           total, mean, maximum and last time between queuing and sending
+           them."""
+        with self.lock:
+            ret=dict(self.dispatchStats)
+        if ret['commands'] > 0:
+            ret['mean_latency'] = ret['total_latency']/ret['commands']
+        else:
+            ret['mean_latency'] = 0.
+        return ret
+
+    def _journal(self, cmds=None, removedIDs=None):
+        """Render changes to the running command list as a journal entry.
+           Must be called with self.lock locked, and followed by a call to
+           _writeJournal() once the lock is released.
+           cmds = a list of added or updated commands
+           removedIDs = a list of IDs of removed commands"""
+        co=StringIO()
+        if cmds is not None:
+            for cmd in cmds:
+                self.runningCommands[cmd.id].writeXML(co)
+        if removedIDs is not None:
+            for cmdID in removedIDs:
+                co.write('<removed-command cmd_id=%s/>\n'%
+                         xml.sax.saxutils.quoteattr(cmdID))
+        self.journalEntries.append(co.getvalue())
+
+    def _writeJournal(self):
+        """Append the journal entries rendered with _journal() to the 
+           journal file, in the order in which they were rendered. Must be
+           called with self.lock unlocked."""
+        with self.journalLock:
+            with self.lock:
+                data=''.join(self.journalEntries)
+                self.journalEntries=[]
+            if len(data) == 0:
+                return
+            try:
+                outf=open(self.journalFilename, 'a')
+                try:
+                    outf.write(data)
+                finally:
+                    outf.close()
+            except EnvironmentError as e:
+                log.error("Can't write running command journal %s: %s"%
+                          (self.journalFilename, str(e)))
+
     def writeState(self):
-        pass
+        """Write out the full running command list, and clear the journal."""
+        with self.journalLock:
+            with self.lock:
+                if self.restoreData is not None:
+                    # the commands that haven't been restored yet are only
+                    # in the current files: keep appending to the journal.
+                    return
+                nfilename="%s.new"%self.filename
+                outf=open(nfilename, 'w')
+                try:
+                    outf.write('<?xml version="1.0"?>\n')
+                    outf.write('<running-command-list>\n')
+                    for rc in self.runningCommands.itervalues():
+                        rc.writeXML(outf)
+                    outf.write('</running-command-list>\n')
+                finally:
+                    outf.close()
+                # the unwritten journal entries are part of the new list.
+                self.journalEntries=[]
+            os.rename(nfilename, self.filename)
+            open(self.journalFilename, 'w').close()
+
+    def readState(self):
+        """Read the running command list and its journal. The commands
+           themselves are restored with restore() while the project states
+           are read, and finishRestore() must be called after that."""
+        rd=RunningCmdListReader()
+        if os.path.exists(self.filename):
+            try:
+                rd.read(self.filename)
+            except (EnvironmentError, xml.sax.SAXParseException,
+                    cpc.util.CpcError) as e:
+                log.error("Can't read running command list %s: %s"%
+                          (self.filename, str(e)))
+        if os.path.exists(self.journalFilename):
+            rd.readJournal(self.journalFilename)
+        with self.lock:
+            self.restoreData=rd.getCommands()
+
+    def restore(self, cmd):
+        """Restore a command that was read in with a project state as
+           running, if it was running when the state was saved.
+           Returns True if the command was restored, False if it should be
+           queued."""
+        with self.lock:
+            if self.restoreData is None or cmd.id not in self.restoreData:
+                return False
+            attrs=self.restoreData.pop(cmd.id)
+            rc=RunningCommand(cmd, attrs['worker_id'], attrs['worker_dir'],
+                              attrs['run_dir'], attrs['server'],
+                              attrs['heartbeat_interval'])
+            rc.setIsLocal(attrs['is_local'])
+            rc.setHaveData(attrs['have_data'])
+            # the server has been down: give the worker a full heartbeat
+            # interval to report back.
+            rc.ping()
+            if 'last_heard' in attrs:
+                log.debug("Restored running command %s (last heartbeat %d s ago)"%
+                          (cmd.id, int(time.time()-attrs['last_heard'])))
+            self.runningCommands[cmd.id]=rc
+            cmd.setRunning(True, rc.getWorkerServer())
+            if attrs.get('changed'):
+                # heartbeats came in before the command was restored.
+                self._journal(cmds=[cmd])
+            self.restoreCond.notify_all()
+        self._writeJournal()
+        return True
+
+    def finishRestore(self):
+        """Finish restoring running commands after all project states that
+           can have running commands have been read."""
+        with self.lock:
+            if self.restoreData is None:
+                return
+            for cmdID in self.restoreData.iterkeys():
+                log.info("Running command %s no longer exists"%cmdID)
+            self._journal(removedIDs=self.restoreData.keys())
+            self.restoreData=None
+            self.restoreCond.notify_all()
+        self._writeJournal()
 
     def _fetchRemoteRunFiles(self, rc):
         """Get the result files from a remote run directory to a local
@@ -452,6 +765,9 @@ class RunningCmdList(object):
             for rc in todelete:
                 del self.runningCommands[rc.cmd.id]
                 rc.cmd.setRunning(False)
+            if len(todelete)>0:
+                self._journal(removedIDs=[rc.cmd.id for rc in todelete])
+        self._writeJournal()
         # then handle their failure
         if len(todelete)>0:
             # first try to get the data
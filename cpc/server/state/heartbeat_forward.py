@@ -0,0 +1,162 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import threading
+import time
+import logging
+
+import cpc.util
+from cpc.network.com.client_response import ProcessedResponse
+from cpc.server.message.server_message import ServerMessage
+
+log=logging.getLogger(__name__)
+
+
+class HeartbeatForwardError(cpc.util.CpcError):
+    pass
+
+
+class ForwardBatch(object):
+    """The heartbeat signals waiting to be forwarded to one server."""
+    def __init__(self):
+        # list of dicts with worker_id, worker_dir, iteration and
+        # heartbeat_items
+        self.heartbeats=[]
+        # the list of faulty command IDs for each heartbeat, once sent.
+        self.faulty=None
+        self.error=None
+        self.done=False
+
+
+class HeartbeatForwarder(object):
+    """Forwards the heartbeat signals of this server's workers to the
+       project servers of their commands. Signals for the same server that
+       arrive within a short window are sent as one request.
+
+       The first signal for a server waits for the window to pass and sends
+       the batch; the others wait for its response. This way, no extra
+       thread is needed, and every worker gets its own faulty items back."""
+    def __init__(self, conf):
+        self.conf=conf
+        self.lock=threading.Lock()
+        self.cond=threading.Condition(self.lock)
+        # dict of server name -> ForwardBatch being collected.
+        self.pending=dict()
+        self.stats = { 'heartbeats' : 0,
+                       'requests' : 0 }
+
+    def forward(self, dest, workerServer, workerID, workerDir, iteration,
+                itemsXML):
+        """Forward a worker's heartbeat items to a server.
+           dest = the server to send the items to
+           workerServer = the name of this server
+           workerID = the worker's ID
+           workerDir = the worker's run directory
+           iteration = the worker's heartbeat iteration
+           itemsXML = the heartbeat items for dest as XML
+           Returns the list of IDs of the faulty commands."""
+        heartbeat={ 'worker_id' : workerID,
+                    'worker_dir' : workerDir,
+                    'iteration' : iteration,
+                    'heartbeat_items' : itemsXML }
+        window=self.conf.getHeartbeatForwardWindow()
+        if window <= 0:
+            return self._send(dest, workerServer, [heartbeat])[0]
+        with self.cond:
+            batch=self.pending.get(dest)
+            first=( batch is None )
+            if first:
+                batch=ForwardBatch()
+                self.pending[dest]=batch
+            index=len(batch.heartbeats)
+            batch.heartbeats.append(heartbeat)
+        if first:
+            time.sleep(window)
+            with self.cond:
+                del self.pending[dest]
+            faulty=None
+            error=None
+            try:
+                faulty=self._send(dest, workerServer, batch.heartbeats)
+            except Exception as e:
+                error=e
+            with self.cond:
+                batch.faulty=faulty
+                batch.error=error
+                batch.done=True
+                self.cond.notifyAll()
+        else:
+            with self.cond:
+                while not batch.done:
+                    self.cond.wait()
+        if batch.error is not None:
+            raise HeartbeatForwardError(
+                            "Error forwarding heartbeat to %s: %s"%
+                            (dest, str(batch.error)))
+        return batch.faulty[index]
+
+    def getStats(self):
+        """Get a dict with the number of forwarded heartbeat signals and the
+           number of requests they took."""
+        with self.lock:
+            return dict(self.stats)
+
+    def _send(self, dest, workerServer, heartbeats):
+        """Send a list of heartbeat signals to a server, as one request if
+           there is more than one. Returns the list of faulty command IDs
+           for each heartbeat."""
+        if len(heartbeats) > 1:
+            resp=self._batchRequest(dest, workerServer, heartbeats)
+            presp=ProcessedResponse(resp)
+            if presp.getStatus() == "OK":
+                self._addStats(len(heartbeats), 1)
+                log.debug("Forwarded %d heartbeat signals to %s"%
+                          (len(heartbeats), dest))
+                return presp.getData()
+            # older servers don't know the batch request.
+            log.debug("Batched heartbeat to %s failed: %s"%
+                      (dest, presp.getMessage()))
+        ret=[]
+        for heartbeat in heartbeats:
+            resp=self._singleRequest(dest, workerServer, heartbeat)
+            presp=ProcessedResponse(resp)
+            if presp.getStatus() != "OK":
+                log.info("Heartbeat response from %s not OK"%dest)
+                ret.append(presp.getData())
+            else:
+                ret.append([])
+        self._addStats(len(heartbeats), len(heartbeats))
+        return ret
+
+    def _addStats(self, nHeartbeats, nRequests):
+        with self.lock:
+            self.stats['heartbeats'] += nHeartbeats
+            self.stats['requests'] += nRequests
+
+    def _batchRequest(self, dest, workerServer, heartbeats):
+        msg=ServerMessage(dest)
+        return msg.heartbeatForwardedBatchRequest(workerServer, heartbeats)
+
+    def _singleRequest(self, dest, workerServer, heartbeat):
+        msg=ServerMessage(dest)
+        return msg.heartbeatForwardedRequest(heartbeat['worker_id'],
+                                             heartbeat['worker_dir'],
+                                             workerServer,
+                                             heartbeat['iteration'],
+                                             heartbeat['heartbeat_items'])
@@ -19,6 +19,7 @@
 
 import logging
 import os.path
+import shutil
 
 from cpc.util.conf.server_conf import ServerConf
 from cpc.server.state.asset import Asset
@@ -57,7 +58,7 @@ class LocalAsset(Asset):
             os.makedirs(outputFilePath) 
 
         self.__data = open(filename, "w+")
-        self.__data.write(data.read())
+        shutil.copyfileobj(data, self.__data)
         self.__data.flush()
         self.__data.seek(0)
         
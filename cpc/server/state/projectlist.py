@@ -22,6 +22,8 @@ import xml.sax
 import logging
 import os
 import shutil
+import time
+import Queue
 
 #import cpc.server.project
 import cpc.dataflow.project
@@ -51,7 +53,11 @@ class ProjectListNotFoundError(ProjectListError):
         return "Project '%s' not found in project list" % self.name
 
 class ProjectList(object):
-    """Synchronized project list."""
+    """Synchronized project list.
+
+       Project states are read lazily: projects without tasks (according to
+       the project list file) are read when they are first requested with
+       get(); the others are read in the background with loadActive()."""
 
     def __init__(self, conf, cmdQueue):
         self.lock = threading.RLock()
@@ -60,14 +66,127 @@ class ProjectList(object):
         # the shared task queue.
         self.taskQueue = cpc.dataflow.TaskQueue(cmdQueue)
         self.conf = conf
+        # the locks of the projects whose state hasn't been read yet.
+        self.loadLocks = dict()
+        # the names of the projects with tasks whose state hasn't been read
+        # yet.
+        self.activeUnloaded = set()
+        # the running command list to restore running commands to
+        self.runningCmdList = None
+        # the load times of the projects that have been read, and the total
+        # time it took to read the active projects.
+        self.loadTimes = dict()
+        self.activeLoadTime = None
 
     def get(self, name):
-        """get a project by its name"""
+        """get a project by its name, reading its state if that hasn't
+           happened yet."""
         with self.lock:
             try:
-                return self.projects[name]
+                prj = self.projects[name]
             except KeyError:
                 raise ProjectListNotFoundError(name)
+            loaded = name not in self.loadLocks
+        if not loaded:
+            self._load(name)
+        return prj
+
+    def _load(self, name):
+        """Read the state of a project if that hasn't happened yet."""
+        with self.lock:
+            loadLock = self.loadLocks.get(name)
+        if loadLock is None:
+            return
+        with loadLock:
+            with self.lock:
+                if name not in self.loadLocks:
+                    # another thread got here first
+                    return
+                prj = self.projects[name]
+            times = dict()
+            startTime = time.time()
+            try:
+                prj.readState(runningCmdList=self.runningCmdList)
+            except cpc.util.CpcError as e:
+                raise ProjectListError("Error reading state of project %s: %s"%
+                                       (name, str(e)))
+            times['read_time'] = time.time() - startTime
+            log.info("Read state of project %s in %.3f s" %
+                     (name, times['read_time']))
+            with self.lock:
+                del self.loadLocks[name]
+                self.activeUnloaded.discard(name)
+                self.loadTimes[name] = times
+
+    def loadActive(self, nThreads, doneFn=None):
+        """Read the states of all projects with tasks in background threads.
+
+           nThreads = the number of threads to read with. If 0, the states
+                      are read in the calling thread.
+           doneFn = an optional function to call when all have been read."""
+        with self.lock:
+            names = list(self.activeUnloaded)
+        if nThreads < 1:
+            self._loadActive(names, 0, doneFn)
+        else:
+            th = threading.Thread(target=self._loadActive,
+                                  args=(names, nThreads, doneFn),
+                                  name="ProjectLoadThread")
+            th.daemon = True
+            th.start()
+
+    def _loadActive(self, names, nThreads, doneFn):
+        startTime = time.time()
+        work = Queue.Queue()
+        for name in names:
+            work.put(name)
+        if nThreads < 1:
+            self._loadWorker(work)
+        else:
+            threads = []
+            for i in range(min(nThreads, len(names))):
+                th = threading.Thread(target=self._loadWorker, args=(work,))
+                th.daemon = True
+                th.start()
+                threads.append(th)
+            for th in threads:
+                th.join()
+        loadTime = time.time() - startTime
+        with self.lock:
+            self.activeLoadTime = loadTime
+        log.info("Read states of %d active projects in %.3f s" %
+                 (len(names), loadTime))
+        if doneFn is not None:
+            doneFn()
+
+    def _loadWorker(self, work):
+        while True:
+            try:
+                name = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self._load(name)
+            except ProjectListError as e:
+                log.error(str(e))
+
+    def getLoadStats(self):
+        """Get a dict with project state loading statistics: the number of
+           projects whose states haven't been read yet, the time it took to
+           read the states of the active projects, and the read times per
+           project."""
+        with self.lock:
+            ret = dict()
+            ret['unloaded'] = len(self.loadLocks)
+            ret['active_load_time'] = self.activeLoadTime
+            ret['projects'] = dict( (name, dict(times)) for name, times in
+                                    self.loadTimes.iteritems() )
+        return ret
+
+    def isLoaded(self, name):
+        """Whether the state of a project has been read."""
+        with self.lock:
+            return name not in self.loadLocks
 
     def add(self, name):
         """add a project with a specific name"""
@@ -104,20 +223,32 @@ class ProjectList(object):
         with self.lock:
             project.cancel()
             del self.projects[project.getName()]
+            self.loadLocks.pop(project.getName(), None)
+            self.activeUnloaded.discard(project.getName())
             dirname = project.getBasedir()
         if delDir and (dirname is not None):
             shutil.rmtree(dirname)
 
+    def _isActive(self, proj):
+        """Whether a project has tasks, or unsaved changes that might
+           create them."""
+        name = proj.getName()
+        if name in self.loadLocks:
+            return name in self.activeUnloaded
+        return proj.getTaskCount() > 0 or proj.isChanged()
+
     def _writeState(self, filename):
-        """Write the project list out."""
+        """Write the project list out. It also serves as the index of which
+           projects need to be read at startup: those that have tasks."""
         cpc.util.file.backupFile(filename)
         outf = open(filename, "w")
         outf.write(u'<?xml version="1.0"?>\n')
         outf.write(u'<project-list>\n')
         for proj in self.projects.itervalues():
             name = proj.getName()
-            outf.write(u'<project id="%s" dir="%s"/>\n' % (name,
-                                                           proj.getBasedir()))
+            outf.write(u'<project id="%s" dir="%s" active="%s"/>\n' %
+                       (name, proj.getBasedir(),
+                        str(self._isActive(proj)).lower()))
         outf.write(u'</project-list>\n')
         outf.close()
 
@@ -127,11 +258,38 @@ class ProjectList(object):
             self._writeState(filename)
 
     def writeFullState(self, projectListFilename):
-        """Write out each project's state."""
+        """Write out the full state of each project whose last state snapshot
+           is out of date.
+           Returns a tuple of the number of projects and bytes written."""
+        nProjects=0
+        nBytes=0
+        with self.lock:
+            for name, proj in self.projects.iteritems():
+                if name in self.loadLocks:
+                    continue
+                if not proj.isSnapshotCurrent():
+                    nBytes+=proj.writeState()
+                    nProjects+=1
+            # the project list is written last, so that it lists at least
+            # the projects with tasks in their saved states.
+            self._writeState(projectListFilename)
+        return (nProjects, nBytes)
+
+    def saveState(self, projectListFilename):
+        """Save the changes to each project's state since the last save.
+           Returns a tuple of the number of projects and bytes written."""
+        nProjects=0
+        nBytes=0
+        with self.lock:
+            projects=[ proj for name, proj in self.projects.iteritems()
+                       if name not in self.loadLocks ]
+        for proj in projects:
+            if proj.isChanged():
+                nBytes+=proj.saveState()
+                nProjects+=1
         with self.lock:
             self._writeState(projectListFilename)
-            for proj in self.projects.itervalues():
-                proj.writeState()
+        return (nProjects, nBytes)
 
     #def writeProjectTasks(self, serverState):
     #    with self.lock:
@@ -148,8 +306,8 @@ class ProjectList(object):
     #                serverState.queue.deleteByProject(prj)
 
     def readState(self, serverState, filename):
-        """Read the full state of the project list by reading the project.xml
-           file and the individual tasks files."""
+        """Read the project list from the project.xml file. The project
+           states themselves are read lazily (see get() and loadActive())."""
         # first read project list
         write = False
         try:
@@ -160,13 +318,35 @@ class ProjectList(object):
             log.info("Can't read project list from %s: %s" % (filename, str(e)))
         except xml.sax._exceptions.SAXParseException:
             log.debug("project list xml error (%s):" % filename)
-        for prj in rd.getProjects():
-            self.projects[prj.getName()] = prj
-            prj.readState()
+        if os.path.exists(filename):
+            listTime = os.path.getmtime(filename)
+        else:
+            listTime = 0
+        with self.lock:
+            self.runningCmdList = serverState.getRunningCmdList()
+            for prj in rd.getProjects():
+                name = prj.getName()
+                self.projects[name] = prj
+                self.loadLocks[name] = threading.Lock()
+                # a project state that was saved after the project list
+                # might have tasks that the list doesn't know about.
+                if ( rd.isActive(name) or
+                     self._isNewer(prj.getStateFilename(), listTime) or
+                     self._isNewer(prj.getJournal().getFilename(),
+                                   listTime) ):
+                    self.activeUnloaded.add(name)
+        log.info("%d projects, %d with tasks" % (len(self.projects),
+                                                 len(self.activeUnloaded)))
+
+    @staticmethod
+    def _isNewer(filename, mtime):
+        """Whether a file exists and is modified after mtime."""
+        return (filename is not None and os.path.exists(filename) and
+                os.path.getmtime(filename) >= mtime)
 
     #reads in the project state of a project state that has been restored from backup
     def readProjectState(self, projectName):
-        prj = self.projects[projectName]
+        prj = self.get(projectName)
 
         conf = ServerConf()
         projectBaseDir= "%s/%s"%(conf.getRunDir(),projectName)
@@ -205,11 +385,16 @@ class ProjectListReader(xml.sax.handler.ContentHandler):
         self.projectList = projectList
         self.serverState = serverState
         self.projects = []
+        self.active = set()
 
 
     def getProjects(self):
         return self.projects
 
+    def isActive(self, name):
+        """Whether the project list marks a project as having tasks."""
+        return name in self.active
+
     def read(self, filename):
         self.filename = filename
         prs = xml.sax.make_parser()
@@ -240,6 +425,11 @@ class ProjectListReader(xml.sax.handler.ContentHandler):
                 self.projectList.getTaskQueue(),
                 self.projectList.getCmdQueue())
             self.projects.append(p)
+            # project lists without the active attribute predate it: then
+            # all projects must be read.
+            if ( not attrs.has_key("active") or
+                 cpc.util.getBooleanAttribute(attrs, "active") ):
+                self.active.add(id)
 
     def endElement(self, name):
         pass
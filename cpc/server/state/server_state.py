@@ -16,7 +16,6 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 import shutil
-import tarfile
 import tempfile
 import threading
 import time
@@ -34,13 +33,16 @@ from cpc.util.conf.server_conf import ServerConf
 import projectlist
 import cpc.server.queue
 import heartbeat
+import heartbeat_forward
 import cpc.server.queue
 import cpc.util.plugin
+import cpc.util.transfer
 import localassets
 import remoteassets
 from cpc.util.worker_state import WorkerState
 from cpc.server.state.session import SessionHandler
 from cpc.network.broadcast_message import BroadcastMessage
+from cpc.network.request_pool import RequestPool
 
 log=logging.getLogger(__name__)
 
@@ -63,6 +65,10 @@ class ServerState:
         self.workerDataList=heartbeat.WorkerDataList()
         self.runningCmdList=heartbeat.RunningCmdList(conf, self.cmdQueue,
                                                      self.workerDataList)
+        self.heartbeatForwarder=heartbeat_forward.HeartbeatForwarder(conf)
+        self.requestPool=RequestPool(conf.getServerRequestThreads(),
+                                     conf.getServerRequestQueueSize(),
+                                     conf.getServerBulkRequests())
         self.localAssets=localassets.LocalAssets()
         self.remoteAssets=remoteassets.RemoteAssets()
         self.sessionHandler=SessionHandler()
@@ -75,6 +81,20 @@ class ServerState:
         self.readableSocketLock = threading.Lock()
         self.readableSockets = []
 
+        # the number of accepted connections and the requests they carried
+        self.connectionStatsLock = threading.Lock()
+        self.connectionStats = { 'connections' : 0,
+                                 'requests' : 0 }
+
+        # state save statistics
+        self.stateSaveLock = threading.Lock()
+        self.stateSaveStats = { 'saves' : 0,
+                                'projects_written' : 0,
+                                'bytes_written' : 0,
+                                'last_projects_written' : 0,
+                                'last_bytes_written' : 0,
+                                'last_save_time' : 0. }
+
 
     def startExecThreads(self):
         """Start the exec threads."""
@@ -87,6 +107,10 @@ class ServerState:
         self.stateSaveThread.start()
         log.debug("Starting state save thread.")
         self.runningCmdList.startHeartbeatThread()
+        self.requestPool.start()
+        # the running commands are restored as their projects are read.
+        self.projectlist.loadActive(self.conf.getProjectLoadThreads(),
+                                    self.runningCmdList.finishRestore)
 
 
     def startConnectServerThread(self):
@@ -160,25 +184,64 @@ class ServerState:
         """Get the running command list."""
         return self.runningCmdList
 
+    def getRequestPool(self):
+        """Get the thread pool that handles the server's connections."""
+        return self.requestPool
+
+    def getHeartbeatForwarder(self):
+        """Get the forwarder of worker heartbeat signals to other servers."""
+        return self.heartbeatForwarder
+
     def getWorkerDataList(self):
         """Get the worker directory list."""
         return self.workerDataList
 
+    def getStats(self):
+        """Get a dict with performance statistics of the server's 
+           components."""
+        ret=dict()
+        ret['task_queue'] = self.projectlist.getTaskQueue().getStats()
+        ret['project_load'] = self.projectlist.getLoadStats()
+        ret['dispatch'] = self.runningCmdList.getDispatchStats()
+        ret['heartbeat_forward'] = self.heartbeatForwarder.getStats()
+        with self.stateSaveLock:
+            ret['state_save'] = dict(self.stateSaveStats)
+        with self.connectionStatsLock:
+            ret['connections'] = dict(self.connectionStats)
+        ret['request_pool'] = self.requestPool.getStats()
+        return ret
+
+    def addConnectionStats(self, nConnections, nRequests):
+        """Count accepted connections and handled requests."""
+        with self.connectionStatsLock:
+            self.connectionStats['connections'] += nConnections
+            self.connectionStats['requests'] += nRequests
+
+    def _addStateSaveStats(self, nProjects, nBytes, saveTime):
+        """Record the statistics of a single state save."""
+        with self.stateSaveLock:
+            self.stateSaveStats['saves'] += 1
+            self.stateSaveStats['projects_written'] += nProjects
+            self.stateSaveStats['bytes_written'] += nBytes
+            self.stateSaveStats['last_projects_written'] = nProjects
+            self.stateSaveStats['last_bytes_written'] = nBytes
+            self.stateSaveStats['last_save_time'] = saveTime
+
     def getCmdLocation(self, cmdID):
         """Get the argument command location."""
         return  self.runningCmdList.getLocation(cmdID)
 
     def write(self):
-        """Write the full server state out to all appropriate files."""
-        # we go through all these motions to make sure that nothing prevents
-        # the server from starting up again.
-        self.taskExecThreads.acquire()
-        try:
-            self.taskExecThreads.pause()
-            self._write()
-            self.taskExecThreads.cont()
-        finally:
-            self.taskExecThreads.release()
+        """Write the changes to the server state since the last write out to
+           all appropriate files. Projects append their changes to their
+           state journals, so the task execution threads can keep running.
+           Returns a tuple of the number of projects and bytes written."""
+        startTime=time.time()
+        (nProjects, nBytes)=self.projectlist.saveState(
+                                                self.conf.getProjectFile())
+        self.runningCmdList.writeState()
+        self._addStateSaveStats(nProjects, nBytes, time.time()-startTime)
+        return (nProjects, nBytes)
 
     def saveProject(self,project):
         self.taskExecThreads.acquire()
@@ -193,8 +256,15 @@ class ServerState:
                 #copy _state.xml to _state.bak.xml
                 stateBackupFile = "%s/_state.bak.xml"%projectFolder
                 shutil.copyfile("%s/_state.xml"%projectFolder,stateBackupFile)
+                # the receiver doesn't tell us what it can read, so the
+                # bundle is always gzip-compressed.
+                codec=cpc.util.transfer.chooseCodec(None,
+                                                    conf.getTransferCodec())
+                # the archive is spooled to a file, not streamed: the task
+                # execution threads are paused until it is complete, and
+                # they shouldn't wait for the client to receive it.
                 tff=tempfile.TemporaryFile()
-                tf=tarfile.open(fileobj=tff, mode="w:gz")
+                tf=cpc.util.transfer.TarWriter(tff, codec)
                 tf.add(projectFolder, arcname=".", recursive=True)
                 tf.close()
                 del(tf)
@@ -210,14 +280,20 @@ class ServerState:
         return tff
 
     def _write(self):
-        self.projectlist.writeFullState(self.conf.getProjectFile())
+        startTime=time.time()
+        (nProjects, nBytes)=self.projectlist.writeFullState(
+                                                self.conf.getProjectFile())
         #self.taskQueue.writeFullState(self.conf.getTaskFile())
         #self.projectlist.writeState(self.conf.getProjectFile())
         self.runningCmdList.writeState()
+        self._addStateSaveStats(nProjects, nBytes, time.time()-startTime)
 
     def read(self):
-        self.projectlist.readState(self, self.conf.getProjectFile())
+        """Read the project list and running command list. The states of
+           projects with tasks are read in the background once the exec
+           threads are started; the others when they are first needed."""
         self.runningCmdList.readState()
+        self.projectlist.readState(self, self.conf.getProjectFile())
 
     #rereads the project state for one specific project
     def readProjectState(self,projectName):
@@ -254,7 +330,9 @@ def stateSaveLoop(serverState, conf):
         time.sleep(conf.getStateSaveInterval())
         if not serverState.getQuit():
             log.debug("Saving server state.")
-            serverState.write()
+            (nProjects, nBytes)=serverState.write()
+            log.debug("Saved state of %d changed projects (%d bytes)."%
+                      (nProjects, nBytes))
 
 
 def establishConnections(serverState):
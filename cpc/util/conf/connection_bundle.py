@@ -148,6 +148,9 @@ class ConnectionBundle(Conf):
             "cpc-worker-workload",
             "The run directory for the run client",
             True, writable=False)
+        self._add('worker_file_cache_size', 2048,
+            "Maximum size in MB of the worker's cache of input files. 0 disables the cache",
+            True, None, '\d+')
 
 
     def getClientHost(self):
@@ -171,6 +174,10 @@ class ConnectionBundle(Conf):
     def getRunDir(self):
         return self.get("run_dir")
 
+    def getWorkerFileCacheSize(self):
+        '''The maximum size of the worker's input file cache in bytes'''
+        return int(self.get('worker_file_cache_size'))*1024*1024
+
     def getHostName(self):
         ''' The fully qualified domain name of the client  '''
         return socket.getfqdn()
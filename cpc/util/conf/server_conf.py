@@ -153,6 +153,31 @@ class ServerConf(conf_base.Conf):
                   "Port number the server listens on for communication from clients",
                   True,None,'\d+')
 
+        self._add('keep_alive_timeout', 30,
+                  "Time in seconds after which idle keep-alive connections of clients and workers are closed",
+                  True, validation='\d+')
+        self._add('server_request_threads', 32,
+                  "Number of threads that handle requests",
+                  True, validation='\d+')
+        self._add('server_request_queue_size', 256,
+                  "Maximum number of accepted connections waiting for a request thread; connections beyond this are closed",
+                  True, validation='\d+')
+        self._add('server_bulk_requests', 8,
+                  "Maximum number of request threads building or unpacking tar files at the same time",
+                  True, validation='\d+')
+        self._add('worker_ready_forward', "probe",
+                  "How a worker-ready request is forwarded when there are no commands here: probe (ask all servers at once whether they have commands, and forward to the first that has) or serial (forward to one server after the other)",
+                  True, allowedValues=['probe', 'serial'])
+        self._add('broadcast_timeout', 30,
+                  "Time in seconds to wait for the nodes' responses to a broadcast message",
+                  True, validation='\d+')
+        self._add('broadcast_fan_out', 0,
+                  "Maximum number of nodes a broadcast message is sent to directly; the others get it relayed through these. 0 sends to all nodes directly",
+                  True, validation='\d+')
+        self._add('server_front_end', "threads",
+                  "Network front end: threads (connections are read in the request threads) or reactor (connections are read in a single event loop, for many idle connections)",
+                  True, allowedValues=['threads', 'reactor'])
+
         self._add( 'nodes', Nodes(),
                   "List of nodes connected to this server", False)
 
@@ -169,6 +194,12 @@ class ServerConf(conf_base.Conf):
         self._add('state_save_interval', 240,
                   "Time in seconds between state saves",
                   True, validation='\d+')
+        self._add('state_journal_max_size', 16777216,
+                  "Maximum size in bytes of a project's state journal before it is compacted into a new state snapshot",
+                  True, validation='\d+')
+        self._add('project_load_threads', 4,
+                  "Number of threads that load the states of active projects at server startup",
+                  True, validation='\d+')
 
         self._add('import_path', "",
                   "Colon-separated list of directories to search for imports, in addition to cpc/lib, .copernicus/lib and .copernicus/<hostname>/lib",
@@ -203,15 +234,40 @@ class ServerConf(conf_base.Conf):
         self._add('heartbeat_time', 120,
                   "Time in seconds between heartbeats",
                   True, validation='\d+')
+        self._add('worker_ready_wait', 5,
+                  "Maximum time in seconds a worker-ready request waits for matching commands to be queued",
+                  True, validation='\d+')
+        self._add('worker_ready_max_wait', 60,
+                  "Maximum time in seconds a worker-ready request waits for matching commands when the worker asks for a longer wait",
+                  True, validation='\d+')
+        self._add('heartbeat_forward_window', 200,
+                  "Time in milliseconds to collect worker heartbeats for the same server before forwarding them in one request (0 to forward each heartbeat separately)",
+                  True, validation='\d+')
+        self._add('transfer_codec', "auto",
+                  "Codec for archives with command and run directories sent to workers: gzip, gzip-fast, tar or auto (fast compression, no compression for already-compressed files)",
+                  True, allowedValues=['gzip', 'gzip-fast', 'tar', 'auto'])
         self._add('heartbeat_file', "heartbeatlist.xml",
                   "Heartbeat monitor list", False,
                   relTo='conf_dir')
 
-        # Task exec queue size. If it exceeds this size, the dataflow
-        # propagation blocks.
+        # Task exec queue size. If it exceeds this size, new tasks are 
+        # still queued (spilled), but sources of new tasks such as finished 
+        # commands are throttled.
         self._add('task_queue_size', 1024,
                   "Dataflow execution task queue size",
                   True, validation='\d+')
+        self._add('task_queue_throttle_time', 15,
+                  "Maximum time in seconds to throttle new task generation when the task queue is full",
+                  True, validation='\d+')
+        # Tasks of higher-precedence classes go first, but a waiting 
+        # lower-precedence class is served after this many tasks of 
+        # higher classes, or once its next task has waited this long.
+        self._add('task_queue_class_burst', 16,
+                  "Maximum number of tasks taken from higher-precedence task classes while a lower-precedence task class waits",
+                  True, validation='\d+')
+        self._add('task_queue_class_max_wait', 5,
+                  "Maximum time in seconds a task of a lower-precedence task class waits before it goes ahead of higher-precedence tasks",
+                  True, validation='\d+')
 
                 #static configuration
         self._add('web_root', 'web',
@@ -358,9 +414,55 @@ class ServerConf(conf_base.Conf):
         with self.lock:
             return int(self.conf['state_save_interval'].get())
 
+    def getStateJournalMaxSize(self):
+        with self.lock:
+            return int(self.conf['state_journal_max_size'].get())
+
+    def getProjectLoadThreads(self):
+        with self.lock:
+            return int(self.conf['project_load_threads'].get())
+
     def getHeartbeatTime(self):
         with self.lock:
             return int(self.conf['heartbeat_time'].get())
+
+    def getWorkerReadyWait(self):
+        with self.lock:
+            return int(self.conf['worker_ready_wait'].get())
+
+    def getWorkerReadyMaxWait(self):
+        with self.lock:
+            return int(self.conf['worker_ready_max_wait'].get())
+    def getKeepAliveTimeout(self):
+        with self.lock:
+            return int(self.conf['keep_alive_timeout'].get())
+    def getServerRequestThreads(self):
+        with self.lock:
+            return int(self.conf['server_request_threads'].get())
+    def getServerRequestQueueSize(self):
+        with self.lock:
+            return int(self.conf['server_request_queue_size'].get())
+    def getServerBulkRequests(self):
+        with self.lock:
+            return int(self.conf['server_bulk_requests'].get())
+    def getWorkerReadyForward(self):
+        with self.lock:
+            return self.conf['worker_ready_forward'].get()
+    def getBroadcastTimeout(self):
+        with self.lock:
+            return int(self.conf['broadcast_timeout'].get())
+    def getBroadcastFanOut(self):
+        with self.lock:
+            return int(self.conf['broadcast_fan_out'].get())
+    def getServerFrontEnd(self):
+        with self.lock:
+            return self.conf['server_front_end'].get()
+    def getHeartbeatForwardWindow(self):
+        with self.lock:
+            return int(self.conf['heartbeat_forward_window'].get())/1000.
+    def getTransferCodec(self):
+        with self.lock:
+            return self.conf['transfer_codec'].get()
     def getHeartbeatFile(self):
         return self.getFile('heartbeat_file')
 
@@ -452,6 +554,18 @@ class ServerConf(conf_base.Conf):
         with self.lock:
             return self.conf['task_queue_size'].get()
 
+    def getTaskQueueThrottleTime(self):
+        with self.lock:
+            return self.conf['task_queue_throttle_time'].get()
+
+    def getTaskQueueClassBurst(self):
+        with self.lock:
+            return self.conf['task_queue_class_burst'].get()
+
+    def getTaskQueueClassMaxWait(self):
+        with self.lock:
+            return self.conf['task_queue_class_max_wait'].get()
+
     def getWebRootPath(self):
         return os.path.join(self.execBasedir,self.get('web_root'))
 
@@ -18,6 +18,8 @@
 
 
 import os
+import copy
+import gzip
 import tarfile
 import logging
 
@@ -29,28 +31,82 @@ log=logging.getLogger(__name__)
 class TarfileError(exception.CpcError):
     pass
 
-def extractSafely(destdir, filename=None, fileobj=None):
-    
+def isSafeName(name):
+    """Check whether a file name from an archive stays inside the
+       directory it is extracted to."""
+    return ( not os.path.isabs(name) and
+             not os.path.normpath(name).startswith("..") )
+
+def extractSafely(destdir, filename=None, fileobj=None, memberFn=None):
+    """Extract a tar file in a single pass, skipping members with names
+       outside destdir.
+       destdir = the directory to extract to
+       filename = the tar file name, or
+       fileobj = the tar file object
+       memberFn = an optional function that is called with the TarFile
+                  object and each member before it is extracted, and that
+                  returns True if it handled the member itself."""
+    # the archive is read as a stream, so it is decompressed only once.
+    tf=None
+    inf=None
     try:
         if filename is not None:
-            tf=tarfile.open(filename, mode='r:gz')
-        else:
-            tf=tarfile.open(fileobj=fileobj, mode='r:gz')
-        files=tf.getmembers()
-             
-        nfiles=[]
-        for file in files:            
-            if not os.path.isabs(file.name) and not \
-                      os.path.normpath(file.name).startswith(".."): 
-                nfiles.append(file)
-        tf.extractall(destdir, nfiles)
-        tf.close()
+            inf=open(filename, 'rb')
+            fileobj=inf
+        tf=_openStream(fileobj)
+        directories=[]
+        for member in tf:
+            if not isSafeName(member.name):
+                log.info("Not extracting %s: outside %s"%(member.name,
+                                                          destdir))
+                continue
+            if memberFn is not None and memberFn(tf, member):
+                continue
+            if member.isdir():
+                # like extractall(): the directory attributes are set at the
+                # end, so that read-only directories can be filled first.
+                directories.append(member)
+                dirInfo=copy.copy(member)
+                dirInfo.mode=0700
+                tf.extract(dirInfo, destdir)
+            else:
+                tf.extract(member, destdir)
+        directories.sort(key=lambda member: member.name, reverse=True)
+        for member in directories:
+            dirpath=os.path.join(destdir, member.name)
+            try:
+                tf.chown(member, dirpath)
+                tf.utime(member, dirpath)
+                tf.chmod(member, dirpath)
+            except tarfile.ExtractError:
+                pass
     except OSError as e:
         raise TarfileError("%s: %s"%(destdir, e.strerror))
+    except IOError as e:
+        raise TarfileError("%s: %s"%(destdir, e.strerror))
     except tarfile.TarError:
-        raise TarfileError("Couldnt read tar.gz file")
+        raise TarfileError("Couldnt read tar file")
     finally:
-        del(tf)
+        if tf is not None:
+            tf.close()
+        if inf is not None:
+            inf.close()
+
+def _openStream(fileobj):
+    """Open a (seekable) tar file object for reading as a stream, detecting
+       its compression."""
+    # tarfile's own gzip stream only reads the first member of gzip files
+    # with multiple members, so gzip files are decompressed with GzipFile.
+    pos=fileobj.tell()
+    magic=fileobj.read(3)
+    fileobj.seek(pos)
+    if magic[:2] == "\037\213":
+        return tarfile.open(fileobj=gzip.GzipFile(fileobj=fileobj, mode='rb'),
+                            mode='r|')
+    elif magic == "BZh":
+        return tarfile.open(fileobj=fileobj, mode='r|bz2')
+    else:
+        return tarfile.open(fileobj=fileobj, mode='r|')
 
 
 def backupFile(filename, Nmax=4):
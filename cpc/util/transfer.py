@@ -0,0 +1,412 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import gzip
+import json
+import shutil
+import time
+import hashlib
+import tarfile
+import logging
+import threading
+try:
+    from collections import OrderedDict
+except ImportError:
+    from cpc.util.ordered_dict import OrderedDict
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+import exception
+import file
+
+log=logging.getLogger(__name__)
+
+# Transfer codecs for the tar archives with command and run directories that
+# are sent between servers and workers:
+#   gzip      : gzip-compressed tar (the original format)
+#   gzip-fast : gzip-compressed tar with the fastest compression level
+#   auto      : like gzip-fast, but files in formats that compress poorly
+#               are stored without compression
+#   tar       : uncompressed tar
+# All but 'tar' produce valid tar.gz files (files with multiple gzip members
+# in the case of 'auto'), so they can be read by any receiver. A receiver that
+# can read all codecs says so in the accept header.
+codecs=[ "gzip", "gzip-fast", "auto", "tar" ]
+defaultCodec="gzip"
+
+# the request header with the comma-separated list of accepted codecs
+acceptHeader='accept-transfer-codecs'
+# the response header with the codec the response is encoded with
+codecHeader='transfer-codec'
+
+# file name extensions of formats that compress poorly
+compressedExtensions=[ '.xtc', '.trr', '.cpt', '.gz', '.tgz', '.bz2', '.zip',
+                       '.xz' ]
+
+# Workers keep a content-addressed cache of the input files they received.
+# They list the hashes of the cached files in their worker-ready requests,
+# and the server leaves out the files with these hashes from the archive.
+# Instead, each command directory gets a manifest with the relative file names
+# and hashes of the files that were left out, that the worker then copies
+# from its cache.
+# the name of the manifest file
+manifestName='_cached_files.json'
+# the request field with the space-separated hashes of the worker's files
+cachedFilesField='cached-files'
+# the minimum size of files to cache: smaller files aren't worth it.
+minCachedSize=65536
+
+# Workers leave out result files that are identical to input files that came
+# from the server (like unchanged inputs, or a previous checkpoint that is the
+# same as the input checkpoint). The archive then contains a manifest with
+# the relative names of these result files and the names of the input files
+# they are identical to, that the server copies them from.
+# the name of the manifest file
+resultManifestName='_unchanged_files.json'
+# the response header with which a server says that it can read the manifest
+resultManifestHeader='accept-result-manifest'
+
+# Archives are written into the response while they are sent, with chunked
+# transfer encoding, if the receiver says it can read such responses with
+# this request header. Older receivers need a content-length, so archives
+# for them are spooled to a file first.
+acceptStreamHeader='accept-streamed-archives'
+
+class TransferCodecError(exception.CpcError):
+    pass
+
+
+def isGzip(codec):
+    """Whether a codec produces gzip-compressed tar files."""
+    return codec != "tar"
+
+def chooseCodec(accepted, preferred):
+    """Choose the codec to send an archive with.
+       accepted = the value of the receiver's accept header, or None
+       preferred = the preferred codec
+       returns: the codec name."""
+    if preferred not in codecs:
+        raise TransferCodecError("Unknown transfer codec '%s'"%preferred)
+    if isGzip(preferred):
+        return preferred
+    if accepted is not None:
+        if preferred in [ name.strip() for name in accepted.split(',') ]:
+            return preferred
+    return defaultCodec
+
+def hashFile(filename):
+    """Get the content hash of a file as a hex string."""
+    h=hashlib.sha1()
+    inf=open(filename, 'rb')
+    try:
+        while True:
+            data=inf.read(1024*1024)
+            if len(data) == 0:
+                break
+            h.update(data)
+    finally:
+        inf.close()
+    return h.hexdigest()
+
+def scanInputFiles(dirname, knownHashes=None):
+    """Get the size, modification time and content hash of all files in a
+       directory that are large enough to be worth comparing.
+       dirname = the directory
+       knownHashes = an optional dict of relative file names to hashes
+       returns: a dict of relative file names to (size, mtime, hash)
+                tuples."""
+    ret=dict()
+    for root, dirs, files in os.walk(dirname):
+        for fname in files:
+            path=os.path.join(root, fname)
+            if os.path.islink(path):
+                continue
+            st=os.stat(path)
+            if st.st_size < minCachedSize:
+                continue
+            name=os.path.relpath(path, dirname)
+            if knownHashes is not None and name in knownHashes:
+                fileHash=knownHashes[name]
+            else:
+                fileHash=hashFile(path)
+            ret[name]=(st.st_size, st.st_mtime, fileHash)
+    return ret
+
+def findInputFile(filename, name, inputFiles):
+    """Find the input file that a result file is identical to.
+       filename = the result file
+       name = the relative name of the result file
+       inputFiles = the dict of input files as returned by scanInputFiles()
+       returns: the relative name of the input file, or None."""
+    if os.path.islink(filename) or not os.path.isfile(filename):
+        return None
+    st=os.stat(filename)
+    if name in inputFiles:
+        size, mtime, fileHash=inputFiles[name]
+        if size == st.st_size and mtime == st.st_mtime:
+            return name
+    fileHash=None
+    for inputName, (size, mtime, inputHash) in inputFiles.iteritems():
+        if size == st.st_size:
+            if fileHash is None:
+                fileHash=hashFile(filename)
+            if fileHash == inputHash:
+                return inputName
+    return None
+
+def _listResultFiles(rundir, outputFiles):
+    """List the regular files of a command's results as tuples of file
+       names and relative names."""
+    ret=[]
+    if outputFiles is None or len(outputFiles) == 0:
+        for root, dirs, files in os.walk(rundir):
+            for fname in files:
+                filename=os.path.join(root, fname)
+                ret.append( (filename, os.path.relpath(filename, rundir)) )
+    else:
+        for name in outputFiles:
+            ret.append( (os.path.join(rundir, name), name) )
+    return ret
+
+def addResults(tf, rundir, outputFiles, inputFiles):
+    """Add the results of a command to an archive, leaving out the files
+       that are identical to input files.
+       tf = the TarWriter
+       rundir = the run directory
+       outputFiles = the list of output file names, or None to add the
+                     whole run directory
+       inputFiles = the dict of input files as returned by scanInputFiles(),
+                    or None if no files should be left out
+       returns: the number of files that were left out."""
+    unchanged=dict()
+    if inputFiles is not None and len(inputFiles) > 0:
+        for filename, name in _listResultFiles(rundir, outputFiles):
+            inputName=findInputFile(filename, name, inputFiles)
+            if inputName is not None:
+                unchanged[os.path.normpath(filename)]=(name, inputName)
+    # the manifest comes first, so the receiver can copy the files before
+    # the results that might overwrite them are extracted.
+    if len(unchanged) > 0:
+        tf.addData(resultManifestName,
+                   json.dumps(dict(unchanged.itervalues())))
+        exclude=lambda filename: os.path.normpath(filename) in unchanged
+    else:
+        exclude=None
+    if outputFiles is None or len(outputFiles) == 0:
+        tf.add(rundir, arcname=".", recursive=True, exclude=exclude)
+    else:
+        for name in outputFiles:
+            filename=os.path.join(rundir, name)
+            if os.path.exists(filename):
+                tf.add(filename, arcname=name, recursive=False,
+                       exclude=exclude)
+    return len(unchanged)
+
+
+class _ResultManifestReader(object):
+    """Handles the manifest of unchanged files while results are extracted:
+       the files are copied to temporary files when the manifest is read,
+       and moved into place when the extraction is done."""
+    def __init__(self, destdir):
+        self.destdir=destdir
+        self.first=True
+        self.staged=[]
+
+    def __call__(self, tf, member):
+        """The member function for cpc.util.file.extractSafely()."""
+        first=self.first
+        self.first=False
+        if os.path.normpath(member.name) != resultManifestName:
+            return False
+        if not first:
+            raise file.TarfileError("%s: manifest of unchanged files is not "
+                                    "at the start of the results"%
+                                    self.destdir)
+        manifest=json.load(tf.extractfile(member))
+        for name, inputName in manifest.iteritems():
+            if not (file.isSafeName(name) and file.isSafeName(inputName)):
+                raise file.TarfileError("Illegal file name in manifest")
+            src=os.path.join(self.destdir, inputName)
+            if not os.path.isfile(src):
+                raise file.TarfileError("%s: unchanged file %s not found"%
+                                        (self.destdir, inputName))
+            tmpName=os.path.join(self.destdir,
+                                 "._unchanged_%d"%len(self.staged))
+            shutil.copy2(src, tmpName)
+            self.staged.append( (tmpName, os.path.join(self.destdir, name)) )
+        return True
+
+    def finish(self):
+        """Move the unchanged files into place."""
+        for tmpName, dest in self.staged:
+            if not os.path.exists(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            os.rename(tmpName, dest)
+        if len(self.staged) > 0:
+            log.debug("Restored %d unchanged files in %s"%(len(self.staged),
+                                                           self.destdir))
+        self.staged=[]
+
+    def cleanup(self):
+        """Remove any remaining temporary files."""
+        for tmpName, dest in self.staged:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+
+def extractResults(destdir, fileobj):
+    """Extract an archive with command results into the command directory,
+       restoring the files that were left out because they were identical
+       to input files in that directory."""
+    reader=_ResultManifestReader(destdir)
+    try:
+        file.extractSafely(destdir, fileobj=fileobj, memberFn=reader)
+        reader.finish()
+    except OSError as e:
+        raise file.TarfileError("%s: %s"%(destdir, e.strerror))
+    finally:
+        reader.cleanup()
+
+def getAcceptValue():
+    """Get the value for the accept header of a receiver that can read all
+       codecs."""
+    return ",".join(codecs)
+
+
+class FileHashCache(object):
+    """Remembers the content hashes of files, so they don't need to be
+       recalculated while the files don't change."""
+    def __init__(self, maxEntries=10000):
+        self.lock=threading.Lock()
+        self.maxEntries=maxEntries
+        # dict of file name -> (mtime, size, hash), in least recently used
+        # order.
+        self.hashes=OrderedDict()
+
+    def getHash(self, filename):
+        """Get the content hash of a file."""
+        st=os.stat(filename)
+        with self.lock:
+            entry=self.hashes.pop(filename, None)
+            if (entry is not None and entry[0] == st.st_mtime and
+                entry[1] == st.st_size):
+                self.hashes[filename]=entry
+                return entry[2]
+        fileHash=hashFile(filename)
+        with self.lock:
+            self.hashes[filename]=(st.st_mtime, st.st_size, fileHash)
+            while len(self.hashes) > self.maxEntries:
+                self.hashes.popitem(last=False)
+        return fileHash
+
+
+class GzipMemberWriter(object):
+    """File object that gzip-compresses what is written to it, as a sequence
+       of gzip members whose compression level can be changed between
+       writes."""
+    def __init__(self, outf, level):
+        self.outf=outf
+        self.level=level
+        self.pos=0
+        self.gz=self._newMember()
+
+    def _newMember(self):
+        return gzip.GzipFile(filename='', mode='wb', compresslevel=self.level,
+                             fileobj=self.outf)
+
+    def setLevel(self, level):
+        """Set the compression level of the data written next."""
+        if level != self.level:
+            self.gz.close()
+            self.level=level
+            self.gz=self._newMember()
+
+    def write(self, data):
+        self.gz.write(data)
+        self.pos+=len(data)
+
+    def tell(self):
+        """Get the position in the uncompressed stream."""
+        return self.pos
+
+    def close(self):
+        """Finish the last gzip member. The output file is not closed."""
+        self.gz.close()
+
+
+class TarWriter(object):
+    """Writes a tar archive with a transfer codec to a file object."""
+    def __init__(self, outf, codec):
+        """Initialize with an output file object and a codec name."""
+        if codec not in codecs:
+            raise TransferCodecError("Unknown transfer codec '%s'"%codec)
+        self.codec=codec
+        self.gzw=None
+        if codec == "tar":
+            self.tf=tarfile.open(fileobj=outf, mode="w")
+        else:
+            if codec == "gzip":
+                level=9
+            else:
+                level=1
+            self.gzw=GzipMemberWriter(outf, level)
+            self.tf=tarfile.open(fileobj=self.gzw, mode="w")
+
+    def add(self, name, arcname, recursive=True, exclude=None):
+        """Add a file or directory to the archive, like TarFile.add().
+           exclude = an optional function that is called with each file
+                     name, and returns True if it should be left out."""
+        if self.codec != "auto" and exclude is None:
+            self.tf.add(name, arcname=arcname, recursive=recursive)
+        else:
+            self._add(name, arcname, recursive, exclude)
+
+    def addData(self, arcname, data):
+        """Add a file with the contents of a string to the archive."""
+        if self.codec == "auto":
+            self.gzw.setLevel(1)
+        tarinfo=tarfile.TarInfo(arcname)
+        tarinfo.size=len(data)
+        tarinfo.mtime=time.time()
+        self.tf.addfile(tarinfo, StringIO(data))
+
+    def _add(self, name, arcname, recursive, exclude):
+        """Add a file or directory, choosing the compression level for each
+           file with the 'auto' codec. Directories are walked in the same way
+           as TarFile.add() does."""
+        if exclude is not None and exclude(name):
+            return
+        if self.codec == "auto":
+            if os.path.splitext(name)[1].lower() in compressedExtensions:
+                self.gzw.setLevel(0)
+            else:
+                self.gzw.setLevel(1)
+        self.tf.add(name, arcname=arcname, recursive=False)
+        if recursive and os.path.isdir(name) and not os.path.islink(name):
+            for fname in os.listdir(name):
+                self._add(os.path.join(name, fname),
+                          os.path.join(arcname, fname), recursive, exclude)
+
+    def close(self):
+        """Finish the archive. The output file is not closed."""
+        self.tf.close()
+        if self.gzw is not None:
+            self.gzw.close()
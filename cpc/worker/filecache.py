@@ -0,0 +1,140 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import json
+import shutil
+import logging
+try:
+    from collections import OrderedDict
+except ImportError:
+    from cpc.util.ordered_dict import OrderedDict
+
+import cpc.util
+import cpc.util.file
+import cpc.util.transfer
+
+log=logging.getLogger(__name__)
+
+
+class FileCacheError(cpc.util.CpcError):
+    pass
+
+
+class FileCache(object):
+    """A content-addressed cache of the input files a worker received,
+       so that the server doesn't need to send them again for other
+       commands. Files are evicted in least recently used order when the
+       cache grows larger than its maximum size.
+
+       The cache is only used from the worker's main thread."""
+    def __init__(self, cacheDir, maxSize):
+        """Initialize with a (new) cache directory.
+           cacheDir = the directory to keep the cached files in
+           maxSize = the maximum total size of the cached files in bytes"""
+        self.cacheDir=cacheDir
+        self.maxSize=maxSize
+        # dict of hash -> file size, in least recently used order
+        self.entries=OrderedDict()
+        self.size=0
+        self.nHits=0
+        self.bytesHit=0
+        if not os.path.exists(cacheDir):
+            os.mkdir(cacheDir)
+
+    def _getFilename(self, fileHash):
+        return os.path.join(self.cacheDir, fileHash)
+
+    def getHashes(self):
+        """Trim the cache to its maximum size and get the list of hashes of
+           the cached files, to send to the server. Files are only evicted
+           here, so all returned files are still there when the response to
+           the request arrives."""
+        self.trim()
+        return self.entries.keys()
+
+    def trim(self):
+        """Evict the least recently used files until the cache fits in its
+           maximum size."""
+        while self.size > self.maxSize and len(self.entries) > 0:
+            fileHash, size=self.entries.popitem(last=False)
+            self.size-=size
+            try:
+                os.remove(self._getFilename(fileHash))
+            except OSError:
+                pass
+            log.debug("Evicted %s from file cache"%fileHash)
+
+    def add(self, filename, fileHash=None):
+        """Add a copy of a file to the cache, if it isn't there yet.
+           fileHash = the file's content hash, if it is known"""
+        if fileHash is None:
+            fileHash=cpc.util.transfer.hashFile(filename)
+        if fileHash in self.entries:
+            # mark it as recently used
+            self.entries[fileHash]=self.entries.pop(fileHash)
+            return
+        size=os.path.getsize(filename)
+        tmpName=self._getFilename("%s.tmp"%fileHash)
+        shutil.copyfile(filename, tmpName)
+        os.rename(tmpName, self._getFilename(fileHash))
+        self.entries[fileHash]=size
+        self.size+=size
+
+    def addFiles(self, dirname, inputFiles):
+        """Add the input files of a command directory.
+           dirname = the command directory
+           inputFiles = the dict of input files, as returned by
+                        cpc.util.transfer.scanInputFiles()"""
+        for name, (size, mtime, fileHash) in inputFiles.iteritems():
+            self.add(os.path.join(dirname, name), fileHash)
+
+    def restore(self, cmddir):
+        """Copy the files that the server left out of a command directory
+           from the cache, according to the directory's manifest.
+           Returns a dict of the relative names of the restored files to
+           their hashes."""
+        restored=dict()
+        manifestFile=os.path.join(cmddir, cpc.util.transfer.manifestName)
+        if not os.path.exists(manifestFile):
+            return restored
+        inf=open(manifestFile, 'r')
+        try:
+            manifest=json.load(inf)
+        finally:
+            inf.close()
+        for name, fileHash in manifest.iteritems():
+            if not cpc.util.file.isSafeName(name):
+                raise FileCacheError("Illegal file name in manifest: %s"%name)
+            if fileHash not in self.entries:
+                raise FileCacheError("File %s with hash %s not in cache"%
+                                     (name, fileHash))
+            dest=os.path.join(cmddir, name)
+            if not os.path.exists(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            # the file is copied, because commands may change their inputs.
+            shutil.copyfile(self._getFilename(fileHash), dest)
+            restored[name]=fileHash
+            self.entries[fileHash]=self.entries.pop(fileHash)
+            self.nHits+=1
+            self.bytesHit+=self.entries[fileHash]
+        os.remove(manifestFile)
+        log.debug("Restored %d files from file cache in %s"%
+                  (len(manifest), cmddir))
+        return restored
@@ -130,12 +130,27 @@ class HeartbeatSender(object):
             else:
                 return None
 
-    def _sendPing(self, first, last):
-        """Do the actual sending"""
-        changed=self.cmdsChanged
-        self.cmdsChanged=False
+    def getBatchItems(self):
+        """Get the heartbeat items XML to send along with a batch of
+           finished commands, or None if no heartbeat is being sent. The
+           change in workloads counts as signaled."""
+        with self.lock:
+            if not self.run:
+                return None
+            self.cmdsChanged=False
+            return self._getItemsXML()
+
+    def handleBatchResponse(self, status, respData):
+        """Handle the heartbeat part of the response to a batch of finished
+           commands."""
+        with self.lock:
+            log.debug("Sent heartbeat signal with finished commands. Result was %s"%
+                      status)
+            self._handleResponse(status, respData)
+
+    def _getItemsXML(self):
+        """Write the heartbeat items of the running workloads to xml."""
         with self.runCondVar:
-            # first write the items to xml
             cmds=self.worker._getWorkloads()
             co=StringIO()
             co.write('<heartbeat worker_id="%s">'%self.workerID)
@@ -145,10 +160,18 @@ class HeartbeatSender(object):
                     for subwl in item.joinedTo:
                         subwl.hbi.writeXML(co)
             co.write("</heartbeat>")
+        return co.getvalue()
+
+    def _sendPing(self, first, last):
+        """Do the actual sending"""
+        changed=self.cmdsChanged
+        self.cmdsChanged=False
+        # first write the items to xml
+        itemsXML=self._getItemsXML()
         clnt=WorkerMessage()
         resp=clnt.workerHeartbeatRequest(self.workerID, self.workerDir, 
                                          first, last, changed, 
-                                         co.getvalue())
+                                         itemsXML)
         presp=ProcessedResponse(resp)
         if last:
             timestr=" last"
@@ -160,11 +183,16 @@ class HeartbeatSender(object):
             timestr+=" update"
         log.debug("Sent%s heartbeat signal. Result was %s"%
                   (timestr, presp.getStatus()))
-        if presp.getStatus() != "OK":
+        return self._handleResponse(presp.getStatus(), presp.getData())
+
+    def _handleResponse(self, status, respData):
+        """Handle a heartbeat response, and return the number of seconds to
+           wait for the next ping."""
+        if status != "OK":
             # if the response was not OK, the upstream server thinks we're 
             # dead and has signaled that to the originating server. We 
             # should just die now.
-            faulty=presp.getData()
+            faulty=respData
             log.info("Error from heartbeat request. Stopping %s"%str(faulty))
             #log.error("Got error from heartbeat request. Stopping worker.")
             if ( type(faulty) == type(dict()) and 'faulty' in faulty): 
@@ -173,7 +201,6 @@ class HeartbeatSender(object):
             else:
                 pass
                 #sys.exit(1)
-        respData=presp.getData()
         if type(respData) == type(dict()):
             rettime=int(respData['heartbeat-time'])
             self.randomFile=respData['random-file']
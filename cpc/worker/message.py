@@ -22,12 +22,14 @@ Created on Mar 10, 2011
 
 @author: iman
 '''
+import json
 import logging
 from cpc.network.com.client_base import ClientBase
 from cpc.network.com.input import Input
 from cpc.network.com.file_input import FileInput
 from cpc.network.server_request import ServerRequest
 from cpc.util.conf.connection_bundle import ConnectionBundle
+import cpc.util.transfer
 
 log=logging.getLogger(__name__)
 class WorkerMessage(ClientBase):
@@ -50,14 +52,29 @@ class WorkerMessage(ClientBase):
         self.privateKey = self.conf.getPrivateKey()
         self.keychain = self.conf.getCaChainFile()
 
-    def workerRequest(self, workerID, archdata):
+    def workerRequest(self, workerID, archdata, maxWait=None,
+                      cachedFiles=None):
+        """Ask for commands to run.
+           maxWait = the maximum time in seconds the server may wait for
+                     commands to be queued, or None for the server's
+                     default.
+           cachedFiles = the list of hashes of the files in the worker's
+                         file cache, or None."""
         cmdstring='worker-ready'
         fields = []
         fields.append(Input('cmd', cmdstring))
         fields.append(Input('version', "1"))
         fields.append(Input('worker', archdata))
         fields.append(Input('worker-id', workerID))
+        if maxWait is not None:
+            fields.append(Input('max-wait', str(maxWait)))
+        if cachedFiles is not None:
+            fields.append(Input(cpc.util.transfer.cachedFilesField,
+                                " ".join(cachedFiles)))
         headers = dict()
+        headers[cpc.util.transfer.acceptHeader] = \
+                cpc.util.transfer.getAcceptValue()
+        headers[cpc.util.transfer.acceptStreamHeader] = '1'
         response= self.putRequest(ServerRequest.prepareRequest(fields, [],
                                                                headers))
         return response
@@ -84,6 +101,39 @@ class WorkerMessage(ClientBase):
                                                                files, headers))
         return response
     
+    def commandsFinishedRequest(self, results, heartbeat=None):
+        """Send the results of a batch of finished commands in one request.
+           results = a list of tuples of cmdID, origServer, returncode,
+                     cputime and jobTarFileobj.
+           heartbeat = None, or a tuple of workerID, workerDir and
+                       heartbeatItemsXML to send a heartbeat update with
+                       the results."""
+        cmdstring='commands-finished'
+        fields = []
+        fields.append(Input('cmd', cmdstring))
+        fields.append(Input('version', "1"))
+        cmds=[]
+        files=[]
+        for cmdID, origServer, returncode, cputime, jobTarFileobj in results:
+            cmds.append( { 'cmd_id' : cmdID,
+                           'project_server' : origServer,
+                           'return_code' : returncode,
+                           'used_cpu_time' : cputime } )
+            jobTarFileobj.seek(0)
+            files.append(FileInput('run_data_%d'%len(files), 'cmd.tar.gz',
+                                   jobTarFileobj))
+        fields.append(Input('commands', json.dumps(cmds)))
+        if heartbeat is not None:
+            workerID, workerDir, heartbeatItemsXML=heartbeat
+            fields.append(Input('worker_id', workerID))
+            fields.append(Input('worker_dir', workerDir))
+            fields.append(Input('iteration', "update"))
+            fields.append(Input('heartbeat_items', heartbeatItemsXML))
+        log.debug("sending commands finished for %d commands"%len(cmds))
+        response= self.putRequest(ServerRequest.prepareRequest(fields,
+                                                               files))
+        return response
+
     def workerHeartbeatRequest(self, workerID, workerDir, first, last, changed,
                                heartbeatItemsXML):
         cmdstring='worker-heartbeat'                   
@@ -27,12 +27,16 @@ import time
 
 
 import cpc.util.file
+import cpc.util.transfer
 import cpc.command
 from cpc.command.platform_reservation import PlatformReservation
 from cpc.util.plugin import PlatformPlugin
 import workload
+import filecache
 import heartbeat
 from cpc.worker.message import WorkerMessage
+from cpc.network.com.client_response import ProcessedResponse
+from cpc.network.https_connection_pool import ClientConnectionPool
 
 log=logging.getLogger(__name__)
 import sys
@@ -40,6 +44,15 @@ import sys
 class WorkerError(cpc.util.CpcError):
     pass
 
+# the maximum time in seconds the server may hold a worker-ready request
+# while waiting for commands for this worker (a long poll).
+longPollTime=30
+# the extra time in seconds to wait for the response to a long poll before
+# giving up on it.
+longPollMargin=30
+# the time in seconds between worker-ready requests to servers that don't
+# support long polls.
+pollTime=30
 
 # variables for the signal handler associated with workers
 signalHandlerLock=threading.Lock() # the lock for the workers list
@@ -169,6 +182,31 @@ class Worker(object):
         self.workloads=[]
         self.iteration=0
         self.acceptCommands = True
+        # whether the server supports long polls: set with every response.
+        self.longPoll=False
+        # the outstanding long-poll request thread, the time it started and
+        # the platforms with the resources it offered.
+        self.pollThread=None
+        self.pollStartTime=None
+        self.pollOffer=None
+        # the long polls that were given up on but may still be answered:
+        # a dict of poll thread -> the platforms with the resources it 
+        # offered. These resources are not offered again until the poll
+        # finishes. See _getOfferedPlatforms()
+        self.abandonedPolls=dict()
+        # the results of the long polls that have finished, as a list of
+        # (thread, response, exception info) tuples.
+        self.pollResults=[]
+        # whether the server takes finished commands in batches: set with
+        # every response.
+        self.batchFinished=False
+        # the cache of input files, so the server doesn't need to send them
+        # again.
+        self.fileCache=None
+        if self.conf.getWorkerFileCacheSize() > 0:
+            self.fileCache=filecache.FileCache(
+                                    os.path.join(self.mainDir, "_file_cache"),
+                                    self.conf.getWorkerFileCacheSize())
         # install the signal handler
         signalHandlerAddWorker(self)
 
@@ -211,10 +249,19 @@ class Worker(object):
             startWaitingTime=time.time()
             with self.runCondVar:
                 acceptCommands=self.acceptCommands
-            if acceptCommands:
-                resp=self._obtainCommands()
+            # take the response of a finished long poll even if we no
+            # longer accept commands: the server has handed out its commands,
+            # so they must be run or returned.
+            resp=self._takePollResponse()
+            if acceptCommands or resp is not None:
+                # ask for commands if there was no long poll.
+                if resp is None and self.pollThread is None:
+                    resp=self._obtainCommands()
                 # and extract the command and run directory
-                workloads=self._extractCommands(resp)
+                if resp is not None:
+                    workloads=self._extractCommands(resp)
+                else:
+                    workloads=[]
                 log.info("Got %d commands."%len(workloads))
                 for workload in workloads:
                     log.info("cmd ID=%s"%workload.cmd.id)
@@ -251,20 +298,37 @@ class Worker(object):
                     if not workload.running:
                         haveFinishedWorkloads=True
                         break
-                if self.acceptCommands and not haveFinishedWorkloads:
+                havePollResults=len(self.pollResults) > 0
+                if ( self.acceptCommands and not haveFinishedWorkloads and
+                     not havePollResults ):
                     haveRemainingResources=self._haveRemainingResources()
-                    if haveRemainingResources:
-                        log.info("Have free resources. Waiting 30 seconds")
-                        self.runCondVar.wait(30)
+                    if haveRemainingResources and self.longPoll:
+                        # the server answers as soon as there are commands
+                        if self.pollThread is None:
+                            log.info("Have free resources. Waiting for commands")
+                            self._startPoll()
+                        self._waitForPoll()
+                        continueWaiting=False
+                    elif haveRemainingResources:
+                        log.info("Have free resources. Waiting %d seconds"%
+                                 pollTime)
+                        self.runCondVar.wait(pollTime)
                         continueWaiting=False
                     else:
                         # we can't ask for new jobs, so we wait indefinitely
                         self.runCondVar.wait()
+                elif ( not haveFinishedWorkloads and not havePollResults and
+                       self.pollThread is not None ):
+                    # we're stopping, but the commands of the outstanding
+                    # long poll must still be taken.
+                    self._waitForPoll()
+                    continueWaiting=False
                 else:
                     continueWaiting=False
                 # now sleep one second to make sure that jobs stopping around
                 # the same time are reported back at once.
-                time.sleep(1)
+                if len(self.pollResults) == 0:
+                    time.sleep(1)
                 # loop over all workloads
                 for workload in self.workloads:
                     if not workload.running:
@@ -291,17 +355,29 @@ class Worker(object):
             # now deal with finished workloads.
             for workload in finishedWorkloads:
                 workload.finish(self.plugin, self.args)
-                workload.returnResults()
+            sentHeartbeat=False
+            if len(finishedWorkloads)>0:
+                if self.batchFinished:
+                    sentHeartbeat=self._returnResults(finishedWorkloads)
+                else:
+                    for workload in finishedWorkloads:
+                        workload.returnResults()
+            for workload in finishedWorkloads:
                 workload.releasePlatform()
             if len(finishedWorkloads)>0:
-                self.heartbeat.delWorkloads(finishedWorkloads)
+                if not sentHeartbeat:
+                    self.heartbeat.delWorkloads(finishedWorkloads)
                 for workload in finishedWorkloads:
                     self.workloads.remove(workload)
             with self.runCondVar:
                 acceptCommands=self.acceptCommands
-            if not acceptCommands and len(self.workloads)==0:
+            if ( not acceptCommands and len(self.workloads)==0 and
+                 self.pollThread is None and len(self.pollResults)==0 ):
                 self.quit = True
         self.heartbeat.stop()
+        stats=ClientConnectionPool().getStats()
+        log.info("Sent %d requests over %d connections."%
+                 (stats['requests'], stats['connections']))
 
 
     def cleanup(self):
@@ -351,12 +427,176 @@ class Worker(object):
 
     def _obtainCommands(self):
         """Obtain a command from the up-most server given a list of
-           platforms and exelist. Returns the client response object."""
+           platforms and exelist, without waiting for new commands to be
+           queued. Returns the client response object."""
+        runreq_clnt=WorkerMessage()
+        resp=runreq_clnt.workerRequest(self.id, self._getRequestString(), 0,
+                                       self._getCachedFiles())
+        self._checkLongPoll(resp)
+        self._checkBatchFinished(resp)
+        return resp
+
+    def _startPoll(self):
+        """Start a long-poll request for commands in a separate thread.
+           Assumes a locked runCondVar."""
+        # the request is made here because the remaining resources are
+        # only changed in the main thread.
+        self.pollOffer=copy.deepcopy(self._getOfferedPlatforms())
+        req=self._getRequestString(self.pollOffer)
+        cachedFiles=self._getCachedFiles()
+        self.pollStartTime=time.time()
+        self.pollThread=threading.Thread(target=self._poll,
+                                         args=(req, cachedFiles),
+                                         name="WorkerPollThread")
+        self.pollThread.daemon=True
+        self.pollThread.start()
+
+    def _poll(self, req, cachedFiles):
+        """Run a long-poll request and signal its response."""
+        resp=None
+        excInfo=None
+        try:
+            runreq_clnt=WorkerMessage()
+            resp=runreq_clnt.workerRequest(self.id, req, longPollTime,
+                                           cachedFiles)
+        except:
+            excInfo=sys.exc_info()
+        with self.runCondVar:
+            self.pollResults.append( (threading.currentThread(), resp,
+                                      excInfo) )
+            self.runCondVar.notifyAll()
+
+    def _waitForPoll(self):
+        """Wait for the outstanding long poll to finish, for at most the time
+           the server may hold it plus a margin. A poll that takes longer is
+           given up on, so that a new one can be made; its response is still
+           taken if it comes in later, so the resources it offered are kept
+           out of new requests until then. Assumes a locked runCondVar."""
+        remaining=self.pollStartTime+longPollTime+longPollMargin-time.time()
+        if remaining > 0:
+            self.runCondVar.wait(remaining)
+        elif len(self.pollResults) == 0:
+            log.warning("No response to long poll in %d seconds; giving up on it"%
+                        (longPollTime+longPollMargin))
+            self.abandonedPolls[self.pollThread]=self.pollOffer
+            self.pollThread=None
+            self.pollOffer=None
+
+    def _takePollResponse(self):
+        """Get the response of a finished long-poll request, or None if there
+           is none. Re-raises any exception the request raised."""
+        with self.runCondVar:
+            if len(self.pollResults) == 0:
+                return None
+            thread, resp, excInfo=self.pollResults.pop(0)
+            if thread is self.pollThread:
+                self.pollThread=None
+                self.pollOffer=None
+            # the commands in the response are reserved from the remaining
+            # resources before any new request is made.
+            self.abandonedPolls.pop(thread, None)
+        if excInfo is not None:
+            raise excInfo[0], excInfo[1], excInfo[2]
+        self._checkLongPoll(resp)
+        self._checkBatchFinished(resp)
+        return resp
+
+    def _checkLongPoll(self, resp):
+        """Check whether the server supports long polls, based on its
+           response to a worker-ready request. Older servers don't, and must
+           be polled."""
+        longPoll=False
+        if resp.headers.has_key('worker-ready-max-wait'):
+            try:
+                longPoll=int(resp.headers['worker-ready-max-wait']) > 0
+            except ValueError:
+                pass
+        if longPoll != self.longPoll:
+            if longPoll:
+                log.info("Server supports long polls")
+            else:
+                log.info("Server doesn't support long polls: polling every %d seconds"%
+                         pollTime)
+            self.longPoll=longPoll
+
+    def _checkBatchFinished(self, resp):
+        """Check whether the server takes the results of finished commands
+           in batches, based on its response to a worker-ready request."""
+        batchFinished=resp.headers.has_key('commands-finished-batch')
+        if batchFinished != self.batchFinished:
+            if batchFinished:
+                log.info("Server takes finished commands in batches")
+            self.batchFinished=batchFinished
+
+    def _returnResults(self, finishedWorkloads):
+        """Send the results of the finished workloads and the workloads
+           joined to them, together with a heartbeat update, in one request.
+           Returns whether the heartbeat update was sent."""
+        results=[]
+        for workload in finishedWorkloads:
+            results.extend(workload.packResults())
+        itemsXML=self.heartbeat.getBatchItems()
+        hb=None
+        if itemsXML is not None:
+            hb=(self.id, self.mainDir, itemsXML)
+        try:
+            clnt=WorkerMessage()
+            resp=clnt.commandsFinishedRequest(
+                            [ workload.getResultInfo(tff)
+                              for workload, tff in results ], hb)
+            presp=ProcessedResponse(resp)
+        finally:
+            for workload, tff in results:
+                tff.close()
+        if presp.getStatus() != "OK":
+            log.error("Error returning finished commands: %s"%
+                      presp.getMessage())
+            return False
+        respData=presp.getData()
+        for item in respData['commands']:
+            if item['status'] != "OK":
+                log.error("Error returning command %s: %s"%
+                          (item['cmd_id'], item.get('message')))
+        if 'heartbeat' in respData:
+            self.heartbeat.handleBatchResponse(respData['heartbeat']['status'],
+                                               respData['heartbeat']['data'])
+        log.debug("Returned %d finished commands"%len(results))
+        return hb is not None
+
+    def _getCachedFiles(self):
+        """Get the list of hashes of the files in the file cache to send
+           with a worker-ready request, or None if there is no cache.
+           Only one worker-ready request may be outstanding at a time."""
+        if self.fileCache is None:
+            return None
+        return self.fileCache.getHashes()
+
+    def _getOfferedPlatforms(self):
+        """Get the platforms with the resources that can be offered to the 
+           server: the remaining resources, minus those offered by long 
+           polls that were given up on but may still be answered."""
+        if len(self.abandonedPolls) == 0:
+            return self.remainingPlatforms
+        ret=copy.deepcopy(self.remainingPlatforms)
+        for offer in self.abandonedPolls.itervalues():
+            for platform, offered in zip(ret, offer):
+                for rsrc in platform.getMaxResources().itervalues():
+                    if offered.hasMaxResource(rsrc.name):
+                        rsrc.value -= offered.getMaxResource(rsrc.name)
+        return ret
+
+    def _getRequestString(self, platforms=None):
+        """Get the worker-ready request string with our platforms and
+           executables.
+           platforms = the platforms with the resources to offer, or None
+                       for the ones from _getOfferedPlatforms()."""
+        if platforms is None:
+            platforms=self._getOfferedPlatforms()
         # Send a run request with our arch+binaries
         req=u'<?xml version="1.0"?>\n'
         req+=u'<worker-request>\n'
         req+=u'<worker-arch-capabilities>\n'
-        for platform in self.remainingPlatforms:
+        for platform in platforms:
             req+=platform.printXML()
         req+='\n'
         req+=self.exelist.printPartialXML()
@@ -368,10 +608,7 @@ class Worker(object):
         req+=u'</worker-requirements>\n'
         req+=u'</worker-request>\n'
         log.debug('request string is: %s'%req)
-        runreq_clnt=WorkerMessage()
-        resp=runreq_clnt.workerRequest(self.id,req)
-        #print "Got %s"%(resp.read(len(resp)))
-        return resp
+        return req
 
     def _extractCommands(self, resp):
         """Extract a command and a run directory from a server response.
@@ -390,6 +627,15 @@ class Worker(object):
 
 
             log.debug("Originating server: %s"%origServer)
+            # the results are returned with the codec the server chose.
+            if resp.headers.has_key(cpc.util.transfer.codecHeader):
+                codec=resp.headers[cpc.util.transfer.codecHeader]
+            else:
+                codec=cpc.util.transfer.defaultCodec
+            # whether the server can restore results that are the same as
+            # their inputs.
+            resultManifest=resp.headers.has_key(
+                                    cpc.util.transfer.resultManifestHeader)
             rundir=os.path.join(self.mainDir, "%d"%self.iteration)
             log.debug("run directory: %s"%rundir)
             #os.mkdir(rundir)
@@ -399,6 +645,17 @@ class Worker(object):
             for subdir in os.listdir(rundir):
                 cmddir=os.path.join(rundir, subdir)
                 if os.path.exists(os.path.join(cmddir, "command.xml")):
+                    restored=None
+                    inputFiles=None
+                    if self.fileCache is not None:
+                        restored=self.fileCache.restore(cmddir)
+                    if self.fileCache is not None or resultManifest:
+                        inputFiles=cpc.util.transfer.scanInputFiles(cmddir,
+                                                                    restored)
+                    if self.fileCache is not None:
+                        self.fileCache.addFiles(cmddir, inputFiles)
+                    if not resultManifest:
+                        inputFiles=None
                     log.debug("trying command directory: %s"%cmddir)
                     # there is a command here. Get the command.
                     cr=cpc.command.CommandReader()
@@ -416,7 +673,8 @@ class Worker(object):
                     workloads.append(workload.WorkLoad(self.mainDir, cmd,
                                                        cmddir, origServer,
                                                        exe, pf, id,
-                                                       self.runCondVar))
+                                                       self.runCondVar,
+                                                       codec, inputFiles))
                     i+=1
             resp.close()
         self.iteration+=1
@@ -466,11 +724,12 @@ class Worker(object):
                     workloadlist.remove(j)
 
     def _haveRemainingResources(self):
-        """Check whether any of the resources has been depleted.
+        """Check whether any of the resources that can be offered to the
+           server has been depleted.
            returns: True if none of the resources have been depleted, False
                     otherwise
            """
-        for platform in self.remainingPlatforms:
+        for platform in self._getOfferedPlatforms():
             for rsrc in platform.getMaxResources().itervalues():
                 if rsrc.value <= 0:
                     return False
@@ -26,7 +26,6 @@ import logging
 import subprocess
 import shlex
 import tempfile
-import tarfile
 import shutil
 import threading
 import traceback
@@ -39,6 +38,7 @@ except ImportError:
 
 
 import cpc.util
+import cpc.util.transfer
 from  cpc.command import Resource
 from  cpc.command import RunVars
 from  cpc.command import RunVarReader
@@ -61,11 +61,18 @@ class WorkLoad(object):
     """The description of a single command with run directory and originating
        server."""
     def __init__(self, workerDir, cmd, rundir, originatingServer, executable, 
-                 platform, id, condVar):
+                 platform, id, condVar, transferCodec="gzip",
+                 inputFiles=None):
         self.condVar=condVar
         self.cmd=cmd # the command. A constant property
         self.rundir=rundir # full path of the run directory. A constant property
         self.originatingServer=originatingServer # A constant property
+        # the codec for the archive with results. A constant property
+        self.transferCodec=transferCodec
+        # the input files that the server has, as returned by
+        # cpc.util.transfer.scanInputFiles(), or None if the server can't
+        # restore result files from them. A constant property
+        self.inputFiles=inputFiles
         self.executable=executable
         self.platform=platform
         self.addArgs="" # additional arguments
@@ -192,34 +199,48 @@ class WorkLoad(object):
         retstr=vars.expandStr(initialArgStr)
         return retstr
 
-    def returnResults(self):
+    def packResults(self):
+        """Pack the run data of this workload and the workloads joined to
+           it, and remove their run directories.
+           Returns a list of tuples of workload and run data file object."""
         with self.condVar:
-            log.debug("Returning run data for cmd id %s"%self.cmd.id)
+            log.debug("Packing run data for cmd id %s"%self.cmd.id)
             tff=tempfile.TemporaryFile()
             outputFiles=self.cmd.getOutputFiles()
-            tf=tarfile.open(fileobj=tff, mode="w:gz")
-            if outputFiles is None or len(outputFiles)==0:
-                tf.add(self.rundir, arcname=".", recursive=True)
-            else:
+            tf=cpc.util.transfer.TarWriter(tff, self.transferCodec)
+            if outputFiles is not None and len(outputFiles) > 0:
                 outputFiles.append('stdout')
                 outputFiles.append('stderr')
-                for name in outputFiles:
-                    fname=os.path.join(self.rundir,name)
-                    if os.path.exists(fname):
-                        tf.add(fname, arcname=name, recursive=False)
+            nUnchanged=cpc.util.transfer.addResults(tf, self.rundir,
+                                                    outputFiles,
+                                                    self.inputFiles)
+            if nUnchanged > 0:
+                log.debug("Left out %d unchanged files for cmd id %s"%
+                          (nUnchanged, self.cmd.id))
             tf.close()
             del(tf)
             tff.seek(0)
             shutil.rmtree(self.rundir, ignore_errors=True)
-            # and send it back 
+            ret=[ (self, tff) ]
+            for workload in self.joinedTo:
+                ret.extend(workload.packResults())
+            return ret
+
+    def getResultInfo(self, tff):
+        """Get the tuple describing this workload's results for
+           WorkerMessage.commandsFinishedRequest()"""
+        return (self.cmd.id, self.originatingServer, self.returncode,
+                self._getCputime(), tff)
+
+    def returnResults(self):
+        """Send the run data back in a command-finished request per
+           command, for servers that don't support batches."""
+        for workload, tff in self.packResults():
+            log.debug("Returning run data for cmd id %s"%workload.cmd.id)
             clnt= WorkerMessage()
             # the cmddir, taskID and projectID together define a unique command.
-            clnt.commandFinishedRequest(self.cmd.id, self.originatingServer, 
-                                        self.returncode, self._getCputime(), 
-                                        tff)
+            clnt.commandFinishedRequest(*workload.getResultInfo(tff))
             tff.close()
-            for workload in self.joinedTo:
-                workload.returnResults()
 
     def run(self, plugin, pluginArgs):
         """Run the workload in a separate thread. Signal the condvar when
@@ -0,0 +1,148 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+from cStringIO import StringIO
+from cpc.util.conf.server_conf import ServerConf
+from cpc.dataflow.project import Project
+from cpc.dataflow.task import TaskQueue
+from cpc.server.queue.cmdqueue import CmdQueue
+
+
+class TestStateJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.confDir=tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.confDir, "server"))
+        open(os.path.join(self.confDir, "server", "server.conf"), "w").close()
+        self.conf=ServerConf(confdir=self.confDir)
+        self.conf.execBasedir=os.path.abspath(
+                        os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+        self.projectDir=os.path.join(self.confDir, "proj")
+
+    def tearDown(self):
+        shutil.rmtree(self.confDir)
+
+    def _makeProject(self):
+        cmdQueue=CmdQueue()
+        return Project("proj", self.projectDir, self.conf,
+                       TaskQueue(cmdQueue), cmdQueue)
+
+    def testReplay(self):
+        prj=self._makeProject()
+        prj.importName("int")
+        prj.addInstance("a", "int::add")
+        prj.writeState()
+        self.assertFalse(prj.getJournal().needsSnapshot())
+        outf=StringIO()
+        prj.addInstance("b", "int::add")
+        prj.scheduleConnect("a:out.c", "b:in.a", outf)
+        prj.scheduleSet("a:in.a", "1", outf)
+        prj.scheduleSet("b:in.b", "2", outf)
+        self.assertTrue(prj.getJournal().write() > 0)
+        self.assertEquals(prj.getJournal().write(), 0)
+
+        prj2=self._makeProject()
+        prj2.readState()
+        self.assertEquals(prj2.getNamedValue("a:in.a").value, 1)
+        self.assertEquals(prj2.getNamedValue("b:in.b").value, 2)
+        self.assertFalse(prj2.getJournal().needsSnapshot())
+
+    def testIncompleteJournal(self):
+        prj=self._makeProject()
+        prj.importName("int")
+        prj.addInstance("a", "int::add")
+        prj.writeState()
+        prj.scheduleSet("a:in.a", "1", StringIO())
+        prj.getJournal().write()
+        outf=open(os.path.join(self.projectDir, "_state.journal"), "a")
+        outf.write('<entry network="">\n  <active id="a" state="he')
+        outf.close()
+
+        prj2=self._makeProject()
+        prj2.readState()
+        self.assertEquals(prj2.getNamedValue("a:in.a").value, 1)
+        # the journal can't be appended to anymore
+        self.assertTrue(prj2.getJournal().needsSnapshot())
+
+    def testChangeTracking(self):
+        prj=self._makeProject()
+        prj.importName("int")
+        prj.addInstance("a", "int::add")
+        self.assertTrue(prj.isChanged())
+        self.assertTrue(prj.saveState() > 0)
+        self.assertFalse(prj.isChanged())
+        self.assertTrue(prj.isSnapshotCurrent())
+        self.assertEquals(prj.saveState(), 0)
+        prj.scheduleSet("a:in.a", "1", StringIO())
+        self.assertTrue(prj.isChanged())
+        self.assertTrue(prj.saveState() > 0)
+        self.assertFalse(prj.isChanged())
+        # the change is only in the journal
+        self.assertFalse(prj.isSnapshotCurrent())
+
+        prj2=self._makeProject()
+        prj2.readState()
+        self.assertFalse(prj2.isChanged())
+        self.assertFalse(prj2.isSnapshotCurrent())
+        prj2.writeState()
+        self.assertTrue(prj2.isSnapshotCurrent())
+
+    def testWriteDuringTransaction(self):
+        prj=self._makeProject()
+        prj.importName("int")
+        prj.addInstance("a", "int::add")
+        prj.addInstance("b", "int::add")
+        prj.writeState()
+        started=threading.Event()
+        finish=threading.Event()
+        def transaction():
+            # two updates under a single hold of the update lock, as in a
+            # transaction
+            with prj.updateLock:
+                prj.scheduleSet("a:in.a", "1", StringIO())
+                started.set()
+                finish.wait(10)
+                prj.scheduleSet("b:in.b", "2", StringIO())
+        written=[]
+        def write():
+            written.append(prj.getJournal().write())
+        transactionThread=threading.Thread(target=transaction)
+        transactionThread.start()
+        started.wait(10)
+        writeThread=threading.Thread(target=write)
+        writeThread.start()
+        # the journal write waits for the transaction to finish
+        writeThread.join(0.2)
+        self.assertTrue(writeThread.isAlive())
+        finish.set()
+        transactionThread.join(10)
+        writeThread.join(10)
+        self.assertTrue(written[0] > 0)
+        # both updates were in the journal write
+        self.assertEquals(prj.getJournal().write(), 0)
+
+        prj2=self._makeProject()
+        prj2.readState()
+        self.assertEquals(prj2.getNamedValue("a:in.a").value, 1)
+        self.assertEquals(prj2.getNamedValue("b:in.b").value, 2)
@@ -0,0 +1,120 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+# 
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published 
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import os
+import shutil
+import tempfile
+from cpc.util.conf.server_conf import ServerConf
+from cpc.dataflow.task import Task, TaskQueue
+
+
+class FakeProject(object):
+    def __init__(self, name):
+        self.name=name
+    def getName(self):
+        return self.name
+
+class FakeTask(object):
+    def __init__(self, project, taskClass, nr):
+        self.project=project
+        self.taskClass=taskClass
+        self.nr=nr
+
+
+class TestTaskQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.confDir=tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.confDir, "server"))
+        open(os.path.join(self.confDir, "server", "server.conf"), "w").close()
+        ServerConf(confdir=self.confDir)
+        self.queue=TaskQueue(None)
+        self.proj1=FakeProject("proj1")
+        self.proj2=FakeProject("proj2")
+
+    def tearDown(self):
+        shutil.rmtree(self.confDir)
+
+    def testClassPrecedence(self):
+        self.queue.put(FakeTask(self.proj1, Task.generatedClass, 0))
+        self.queue.put(FakeTask(self.proj1, Task.commandClass, 1))
+        self.queue.put(FakeTask(self.proj1, Task.userClass, 2))
+        self.assertEquals([ self.queue.get().nr for i in range(3) ], 
+                          [ 2, 1, 0 ])
+        self.assertTrue(self.queue.empty())
+
+    def testClassBurst(self):
+        self.queue.classBurst=2
+        self.queue.classMaxWait=0
+        self.queue.put(FakeTask(self.proj1, Task.generatedClass, 0))
+        for i in range(1, 6):
+            self.queue.put(FakeTask(self.proj1, Task.userClass, i))
+        self.assertEquals([ self.queue.get().nr for i in range(6) ], 
+                          [ 1, 2, 0, 3, 4, 5 ])
+
+    def testClassMaxWait(self):
+        self.queue.classBurst=0
+        self.queue.classMaxWait=10
+        self.queue.put(FakeTask(self.proj1, Task.generatedClass, 0))
+        self.queue.put(FakeTask(self.proj1, Task.userClass, 1))
+        self.queue.put(FakeTask(self.proj1, Task.userClass, 2))
+        self.assertEquals(self.queue.get().nr, 1)
+        # make the generated task look old
+        dq=self.queue.classes[Task.generatedClass][self.proj1]
+        dq[0]=(dq[0][0], dq[0][1]-10)
+        self.assertEquals([ self.queue.get().nr for i in range(2) ], [ 0, 2 ])
+
+    def testProjectRoundRobin(self):
+        for i in range(4):
+            self.queue.put(FakeTask(self.proj1, Task.generatedClass, i))
+        self.queue.put(FakeTask(self.proj2, Task.generatedClass, 10))
+        self.queue.put(FakeTask(self.proj2, Task.generatedClass, 11))
+        self.assertEquals([ self.queue.get().nr for i in range(6) ], 
+                          [ 0, 10, 1, 11, 2, 3 ])
+
+    def testNoneAndStats(self):
+        self.queue.put(FakeTask(self.proj1, Task.userClass, 0))
+        self.queue.put(FakeTask(self.proj2, Task.generatedClass, 1))
+        self.queue.putNone()
+        self.assertEquals(self.queue.get(), None)
+        stats=self.queue.getStats()
+        self.assertEquals(stats['depth'], 2)
+        self.assertEquals(stats['projects'], { "proj1" : 1, "proj2" : 1 })
+        self.queue.get()
+        stats=self.queue.getStats()
+        self.assertEquals(stats['user']['get'], 1)
+        self.assertEquals(stats['generated']['put'], 1)
+        self.assertEquals(stats['generated']['depth'], 1)
+
+    def testSpillAndThrottle(self):
+        self.queue.maxsize=2
+        self.queue.throttleTime=0
+        for i in range(4):
+            self.queue.put(FakeTask(self.proj1, Task.generatedClass, i))
+        self.assertFalse(self.queue.throttle())
+        self.queue.get()
+        self.queue.get()
+        self.queue.get()
+        self.assertTrue(self.queue.throttle())
+        stats=self.queue.getStats()
+        self.assertEquals(stats['spilled'], 2)
+        self.assertEquals(stats['peak_depth'], 4)
+        self.assertEquals(stats['throttled'], 1)
+        self.assertEquals(stats['throttle_timeouts'], 1)
@@ -0,0 +1,134 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import json
+import threading
+import time
+# the server imports the commands first; broadcast_message can't be
+# imported on its own.
+import cpc.server.message
+from cpc.network.broadcast_message import BroadcastMessage
+from cpc.network.com.input import Input
+
+
+class FakeConf(object):
+    def __init__(self, timeout, fanOut):
+        self.timeout=timeout
+        self.fanOut=fanOut
+    def getBroadcastTimeout(self):
+        return self.timeout
+    def getBroadcastFanOut(self):
+        return self.fanOut
+
+
+class FakeResponse(object):
+    """Stands in for a client response with a JSON body."""
+    def __init__(self, status, message, data=None):
+        self.content_type="text/json"
+        self.message=FakeMessage(json.dumps([ { 'status' : status,
+                                                'message' : message,
+                                                'data' : data } ]))
+
+
+class FakeMessage(object):
+    def __init__(self, body):
+        self.body=body
+    def __len__(self):
+        return len(self.body)
+    def read(self, size):
+        return self.body
+
+
+class RecordingBroadcast(BroadcastMessage):
+    """Answers messages after a per-node delay, relays relayed messages
+       itself, and records the requests."""
+    def __init__(self, timeout=5, fanOut=0, delays=None, failing=()):
+        self.conf=FakeConf(timeout, fanOut)
+        self.delays=delays or dict()
+        self.failing=failing
+        self.lock=threading.Lock()
+        self.requests=[]
+
+    def _sendRequest(self, nodeId, fields, files, headers):
+        params=dict( (field.name, field.value) for field in fields )
+        with self.lock:
+            self.requests.append( (nodeId, params['cmd']) )
+        time.sleep(self.delays.get(nodeId, 0))
+        if nodeId in self.failing:
+            raise Exception("node %s unreachable"%nodeId)
+        if params['cmd'] == "broadcast-relay":
+            results={ nodeId : { 'status' : 'OK', 'message' : 'relayed' } }
+            results.update(self.relay(json.loads(params['relay_nodes']),
+                                      json.loads(params['relay_fields']),
+                                      float(params['relay_timeout'])))
+            return FakeResponse("OK", "", results)
+        return FakeResponse("OK", "done %s"%nodeId)
+
+
+class TestBroadcast(unittest.TestCase):
+
+    def setUp(self):
+        self.fields=[ Input('cmd', "network-topology-update") ]
+        self.nodeIds=[ "node%d"%i for i in range(7) ]
+
+    def testConcurrent(self):
+        bcast=RecordingBroadcast(delays=dict( (nodeId, 0.3)
+                                              for nodeId in self.nodeIds ))
+        startTime=time.time()
+        results=bcast._sendToNodes(self.nodeIds, self.fields, [], dict(), 5,
+                                   True)
+        # the nodes are sent to at the same time, not one after another
+        self.assertTrue(time.time()-startTime < 1.5)
+        self.assertEquals(sorted(results.keys()), self.nodeIds)
+        self.assertEquals(results["node3"], { 'status' : 'OK',
+                                              'message' : 'done node3' })
+
+    def testTimeoutAndError(self):
+        bcast=RecordingBroadcast(timeout=0.5, delays={ "node1" : 2 },
+                                 failing=("node2",))
+        results=bcast._sendToNodes(self.nodeIds, self.fields, [], dict(),
+                                   0.5, False)
+        self.assertEquals(results["node1"]['status'], "TIMEOUT")
+        self.assertEquals(results["node2"]['status'], "ERROR")
+        self.assertEquals(results["node0"]['status'], "OK")
+
+    def testRelay(self):
+        bcast=RecordingBroadcast(fanOut=2)
+        results=bcast._sendToNodes(self.nodeIds, self.fields, [], dict(), 5,
+                                   True)
+        self.assertEquals(sorted(results.keys()), self.nodeIds)
+        # node0 and node1 relay to their groups of three; node0 relays
+        # through node2 again, and every node gets the message once.
+        relays=[ nodeId for nodeId, cmd in bcast.requests
+                 if cmd == "broadcast-relay" ]
+        self.assertEquals(sorted(relays), [ "node0", "node1", "node2" ])
+        self.assertEquals(len(bcast.requests), len(self.nodeIds))
+        for nodeId in self.nodeIds:
+            self.assertEquals(results[nodeId]['status'], "OK")
+
+    def testRelayFallback(self):
+        bcast=RecordingBroadcast(fanOut=2, failing=("node0",))
+        results=bcast._sendToNodes(self.nodeIds, self.fields, [], dict(), 5,
+                                   True)
+        self.assertEquals(results["node0"]['status'], "ERROR")
+        # the rest of node0's group is sent to directly
+        for nodeId in [ "node2", "node4", "node6" ]:
+            self.assertEquals(results[nodeId], { 'status' : 'OK',
+                                                 'message' : 'done %s'%nodeId })
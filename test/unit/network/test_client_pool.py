@@ -0,0 +1,146 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import errno
+import httplib
+import socket
+import time
+from cpc.network.com import client_connection
+from cpc.network.com.connection_base import ConnectionBase, \
+                                           StaleConnectionError
+from cpc.network.com.client_base import ClientBase, ClientConnectionError
+from cpc.network.https_connection_pool import ClientConnectionPool
+from cpc.network.server_request import ServerRequest
+
+
+class FakeHttpsConnection(object):
+    """Stands in for an https connection; fails its first request if the
+       server 'closed' it, or after the request was processed if it was
+       'reset'."""
+    def __init__(self, stale=False):
+        self.stale=stale
+        self.reset=False
+        self.closed=False
+        self.nRequests=0
+    def connect(self):
+        pass
+    def close(self):
+        self.closed=True
+
+
+class FakeClientConnection(client_connection.ClientConnectionRequireCert):
+    def newConnection(self):
+        return FakeHttpsConnection()
+
+    def sendRequest(self, req, method="POST"):
+        if self.conn.stale:
+            raise StaleConnectionError(httplib.BadStatusLine(''))
+        self.conn.nRequests+=1
+        if self.conn.reset:
+            raise socket.error(errno.ECONNRESET, "Connection reset by peer")
+        self.keepAlive=True
+        self.handleSocket()
+        return method
+
+
+class FailingHttpsConnection(object):
+    """An https connection that fails while sending or receiving."""
+    def __init__(self, sendError=None, receiveError=None):
+        self.sendError=sendError
+        self.receiveError=receiveError
+    def request(self, method, url, body, headers):
+        if self.sendError is not None:
+            raise self.sendError
+    def getresponse(self):
+        raise self.receiveError
+
+
+class FailingConnection(ConnectionBase):
+    def __init__(self, conn):
+        self.conn=conn
+    def prepareHeaders(self, request):
+        return request
+
+
+class TestClientPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool=ClientConnectionPool()
+        self.pool.pool.clear()
+        self.origClass=client_connection.ClientConnectionRequireCert
+        client_connection.ClientConnectionRequireCert=FakeClientConnection
+
+    def tearDown(self):
+        client_connection.ClientConnectionRequireCert=self.origClass
+        self.pool.pool.clear()
+
+    def testIdleEviction(self):
+        conn=FakeHttpsConnection()
+        self.pool.putConnection(conn, "host", 1)
+        self.assertTrue(self.pool.getConnection("host", 1) is conn)
+        self.assertTrue(self.pool.getConnection("host", 1) is None)
+        self.pool.putConnection(conn, "host", 1)
+        self.pool.getOrCreateQueue("host", 1).queue[0]=(conn, time.time()-
+                                                    self.pool.maxIdleTime-1)
+        self.assertTrue(self.pool.getConnection("host", 1) is None)
+        self.assertTrue(conn.closed)
+
+    def testReuse(self):
+        stats=self.pool.getStats()
+        clnt=ClientBase("host", 1, None)
+        req=ServerRequest.prepareRequest([], [])
+        for i in range(5):
+            self.assertEquals(clnt.putRequest(req), "PUT")
+        newStats=self.pool.getStats()
+        self.assertEquals(newStats['requests']-stats['requests'], 5)
+        self.assertEquals(newStats['connections']-stats['connections'], 1)
+        conn=self.pool.getConnection("host", 1)
+        self.assertEquals(conn.nRequests, 5)
+        # a connection that the server closed is replaced
+        conn.stale=True
+        self.pool.putConnection(conn, "host", 1)
+        self.assertEquals(clnt.postRequest(req), "POST")
+        self.assertTrue(self.pool.getConnection("host", 1) is not conn)
+
+    def testNoRetryAfterSend(self):
+        clnt=ClientBase("host", 1, None)
+        req=ServerRequest.prepareRequest([], [])
+        clnt.putRequest(req)
+        conn=self.pool.getConnection("host", 1)
+        nRequests=conn.nRequests
+        # the request reached the server before the connection failed: it
+        # must not be sent again.
+        conn.reset=True
+        self.pool.putConnection(conn, "host", 1)
+        self.assertRaises(ClientConnectionError, clnt.postRequest, req)
+        self.assertEquals(conn.nRequests, nRequests+1)
+
+    def testStaleConnectionErrors(self):
+        req=ServerRequest.prepareRequest([], [])
+        conn=FailingConnection(FailingHttpsConnection(
+                    sendError=socket.error(errno.EPIPE, "Broken pipe")))
+        self.assertRaises(StaleConnectionError, conn.sendRequest, req)
+        conn=FailingConnection(FailingHttpsConnection(
+                    receiveError=httplib.BadStatusLine('')))
+        self.assertRaises(StaleConnectionError, conn.sendRequest, req)
+        conn=FailingConnection(FailingHttpsConnection(
+                    receiveError=socket.error(errno.ECONNRESET,
+                                              "Connection reset by peer")))
+        self.assertRaises(socket.error, conn.sendRequest, req)
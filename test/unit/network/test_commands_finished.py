@@ -0,0 +1,114 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import tempfile
+import cpc.network.node
+from cpc.network.node import Node
+from cpc.network.server_response import ServerResponse
+from cpc.network.http.http_method_parser import HttpMethodParser
+from cpc.server.message.worker import SCCommandsFinished
+from cpc.worker.message import WorkerMessage
+
+
+class DummyConf(object):
+    def getClientHost(self):
+        return "localhost"
+    def getServerSecurePort(self):
+        return 14807
+    def getPrivateKey(self):
+        return None
+    def getCaChainFile(self):
+        return None
+
+
+class DummyServerState(object):
+    def __init__(self):
+        self.conf=DummyConf()
+
+
+class FakeTaskQueue(object):
+    def __init__(self):
+        self.nThrottled=0
+    def throttle(self):
+        self.nThrottled+=1
+        return True
+
+
+class RecordingCommandsFinished(SCCommandsFinished):
+    """Records the finished commands instead of handling them."""
+    def __init__(self):
+        SCCommandsFinished.__init__(self)
+        self.finished=[]
+        self.taskQueue=FakeTaskQueue()
+
+    def finishCommand(self, serverState, cmdID, workerServer, projServer,
+                      returncode, cputime, runfile, haveRemoteData):
+        if cmdID == "bad":
+            raise Exception("unknown command")
+        self.finished.append( (cmdID, workerServer, projServer, returncode,
+                               cputime, runfile.read()) )
+        return self.taskQueue
+
+
+class TestCommandsFinished(unittest.TestCase):
+
+    def setUp(self):
+        self.selfNode=cpc.network.node.selfNode
+        cpc.network.node.selfNode=Node("server-a", 14807, 13807,
+                                       "localhost", "localhost")
+
+    def tearDown(self):
+        cpc.network.node.selfNode=self.selfNode
+
+    def _makeFile(self, data):
+        tff=tempfile.TemporaryFile()
+        tff.write(data)
+        tff.seek(0)
+        return tff
+
+    def testBatch(self):
+        requests=[]
+        clnt=WorkerMessage(conf=DummyConf())
+        clnt.putRequest=lambda req: requests.append(req)
+        clnt.commandsFinishedRequest(
+                    [ ("cmd1", "server-a", 0, 1.5, self._makeFile("data1")),
+                      ("bad", "server-a", 0, 1., self._makeFile("x")),
+                      ("cmd2", "server-b", None, 2., self._makeFile("data2")) ])
+        self.assertEquals(len(requests), 1)
+        req=requests[0]
+        headers=dict( (key.lower(), str(value)) for key, value in
+                      req.headers.iteritems() )
+        request=HttpMethodParser.handleMultipart(headers,
+                                                 self._makeFile(req.msg[:]))
+        self.assertEquals(request.getParam('cmd'), 'commands-finished')
+        cmd=RecordingCommandsFinished()
+        response=ServerResponse()
+        cmd.run(DummyServerState(), request, response)
+        self.assertEquals(cmd.finished,
+                          [ ("cmd1", "server-a", "server-a", 0, 1.5, "data1"),
+                            ("cmd2", "server-a", "server-b", None, 2.,
+                             "data2") ])
+        self.assertEquals(response.resp[0]['status'], 'OK')
+        results=response.resp[0]['data']['commands']
+        self.assertEquals([ item['status'] for item in results ],
+                          [ 'OK', 'ERROR', 'OK' ])
+        self.assertEquals(results[1]['cmd_id'], 'bad')
+        # the worker is throttled once for the whole batch.
+        self.assertEquals(cmd.taskQueue.nThrottled, 1)
@@ -0,0 +1,114 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import os
+import sys
+import tempfile
+import time
+from cpc.network.com.input import Input
+from cpc.network.com.file_input import FileInput
+from cpc.network.http.messaging import Messaging
+from cpc.network.http.http_method_parser import HttpMethodParser
+
+
+class TestMultipart(unittest.TestCase):
+
+    def _makeFile(self, data):
+        tff=tempfile.TemporaryFile()
+        tff.write(data)
+        tff.seek(0)
+        return tff
+
+    def _browserBody(self, fields, files):
+        """Make a multipart body like browsers do: without content-length
+           headers in the parts."""
+        boundary="--"+Messaging.BOUNDARY
+        body=""
+        for name, value in fields:
+            body+=('%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n'
+                   '%s\r\n'%(boundary, name, value))
+        for name, value in files:
+            body+=('%s\r\nContent-Disposition: form-data; name="%s"; '
+                   'filename="%s"\r\nContent-Type: application/x-tar\r\n\r\n'
+                   '%s\r\n'%(boundary, name, name, value))
+        body+="%s--\r\n"%boundary
+        return body
+
+    def _parse(self, body, nextRequest=""):
+        headers={ 'content-type' : 'multipart/form-data; boundary=%s'%
+                                   Messaging.BOUNDARY,
+                  'content-length' : str(len(body)) }
+        stream=self._makeFile(body+nextRequest)
+        request=HttpMethodParser.handleMultipart(headers, stream)
+        # nothing after the body may be read.
+        self.assertEquals(stream.read(), nextRequest)
+        return request
+
+    def _payload(self, size):
+        # binary data with parts of the boundary and line ends in it
+        data=os.urandom(size/2)+"\r\n--"+Messaging.BOUNDARY[:-1]+"\r\n"
+        return data+os.urandom(size-len(data))
+
+    def testClientMessage(self):
+        payload=self._payload(100000)
+        body=Messaging.encode_multipart_formdata(
+                    [ Input('cmd', 'command-finished'),
+                      Input('cmd_id', 'a\r\nb') ],
+                    [ FileInput('run_data', 'cmd.tar.gz',
+                                self._makeFile(payload)) ])
+        request=self._parse(body[:], "PUT /copernicus HTTP/1.1\r\n")
+        self.assertEquals(request.getParam('cmd'), 'command-finished')
+        self.assertEquals(request.getParam('cmd_id'), 'a\r\nb')
+        self.assertEquals(request.getFile('run_data').read(), payload)
+
+    def testBrowserMessage(self):
+        payload=self._payload(100000)
+        body=self._browserBody([ ('cmd', 'project-upload'),
+                                 ('project', 'test') ],
+                               [ ('upload', payload) ])
+        request=self._parse(body)
+        self.assertEquals(request.getParam('cmd'), 'project-upload')
+        self.assertEquals(request.getParam('project'), 'test')
+        self.assertEquals(request.getFile('upload').read(), payload)
+
+    def testBenchmark(self):
+        """Time parsing large binary uploads, with and without content-length
+           headers in the parts. The payload size can be set with the
+           CPC_MULTIPART_BENCHMARK_SIZE environment variable."""
+        size=int(os.environ.get("CPC_MULTIPART_BENCHMARK_SIZE", "20000000"))
+        payload=self._payload(size)
+        results=[]
+        for name, body in [
+                ( "client", Messaging.encode_multipart_formdata(
+                                [ Input('cmd', 'command-finished') ],
+                                [ FileInput('run_data', 'cmd.tar.gz',
+                                            self._makeFile(payload)) ])[:] ),
+                ( "browser", self._browserBody([ ('cmd', 'project-upload') ],
+                                               [ ('upload', payload) ]) ) ]:
+            startTime=time.time()
+            request=self._parse(body)
+            parseTime=time.time()-startTime
+            self.assertEquals(len(request.getFile(
+                                request.files.keys()[0]).read()), size)
+            results.append( (name, parseTime) )
+        sys.stderr.write("\nMultipart parser benchmark (%d bytes):\n"%size)
+        for name, parseTime in results:
+            sys.stderr.write("  %-7s: %.3f s, %.1f MB/s\n"%
+                             (name, parseTime, size/parseTime/1e6))
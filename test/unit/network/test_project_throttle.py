@@ -0,0 +1,95 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import cpc.server.message
+from cpc.server.message.project import SCProjectCommit, SCProjectSet, \
+                                       SCProjectRerun
+from cpc.network.server_response import ServerResponse
+
+
+class FakeTaskQueue(object):
+    def __init__(self):
+        self.nThrottled=0
+    def throttle(self):
+        self.nThrottled+=1
+        return True
+
+
+class FakeProjectList(object):
+    def __init__(self, taskQueue):
+        self.taskQueue=taskQueue
+    def getTaskQueue(self):
+        return self.taskQueue
+
+
+class FakeServerState(object):
+    def __init__(self, taskQueue):
+        self.projectList=FakeProjectList(taskQueue)
+    def getProjectList(self):
+        return self.projectList
+
+
+class FakeProject(object):
+    """Records the calls that generate tasks."""
+    def __init__(self):
+        self.calls=[]
+    def getName(self):
+        return "proj"
+    def commit(self, outf):
+        self.calls.append("commit")
+    def scheduleSet(self, itemname, setval, outf, *args, **kwargs):
+        self.calls.append("set")
+    def rerun(self, item, recursive, clearError, outf):
+        self.calls.append("rerun")
+
+
+class FakeRequest(object):
+    def __init__(self, params):
+        self.params=params
+    def hasParam(self, name):
+        return name in self.params
+    def getParam(self, name):
+        return self.params[name]
+    def haveFile(self, name):
+        return False
+
+
+def fakeGetProject(project):
+    return lambda request, serverState: project
+
+
+class TestProjectThrottle(unittest.TestCase):
+
+    def setUp(self):
+        self.project=FakeProject()
+        self.taskQueue=FakeTaskQueue()
+        self.serverState=FakeServerState(self.taskQueue)
+
+    def _run(self, cmd, params):
+        cmd.getProject=fakeGetProject(self.project)
+        cmd.run(self.serverState, FakeRequest(params), ServerResponse())
+
+    def testThrottle(self):
+        self._run(SCProjectSet(), { 'item' : 'a.in.x', 'value' : '1' })
+        self._run(SCProjectCommit(), {})
+        self._run(SCProjectRerun(), { 'item' : 'a' })
+        self.assertEquals(self.project.calls, [ "set", "commit", "rerun" ])
+        # each command that generates tasks throttles the client
+        self.assertEquals(self.taskQueue.nThrottled, 3)
@@ -0,0 +1,154 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import BaseHTTPServer
+import socket
+import threading
+import time
+from cpc.network.copernicus_server import HTTPServer__base
+from cpc.network.reactor import ReactorMixIn, ReactorConnection, ReactorError
+from cpc.network.request_pool import RequestPool
+
+
+class FakeConf(object):
+    def getKeepAliveTimeout(self):
+        return 1
+
+
+class FakeState(object):
+    def __init__(self):
+        self.requestPool=RequestPool(4, 16, 2)
+        self.requestPool.start()
+    def getRequestPool(self):
+        return self.requestPool
+
+
+class EchoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers with the request path and body, and keeps the connection
+       the way handler_base does."""
+    protocol_version="HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.rfile=self.request.requestInput
+        self.request.requestInput=None
+
+    def handle(self):
+        self.close_connection=1
+        self.handle_one_request()
+        if not self.close_connection:
+            self.request.parkTimeout=1
+            self.request.park=True
+
+    def do_POST(self):
+        body=self.rfile.read(int(self.headers['content-length']))
+        reply="%s %s"%(self.path, body)
+        self.send_response(200)
+        self.send_header("content-length", len(reply))
+        self.send_header("Connection", "keep-alive")
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AttributeSocket(socket.socket):
+    """A plain socket that, like an SSL socket, can be given attributes."""
+    pass
+
+
+class ReactorServer(ReactorMixIn, HTTPServer__base):
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           EchoHandler)
+        self.conf=FakeConf()
+        self.serverState=FakeState()
+
+    def get_request(self):
+        sock, clientAddress=self.socket.accept()
+        return AttributeSocket(_sock=sock._sock), clientAddress
+
+
+def request(path, body):
+    return "POST %s HTTP/1.1\r\ncontent-length: %d\r\n\r\n%s"%(path,
+                                                                len(body),
+                                                                body)
+
+
+class TestReactor(unittest.TestCase):
+
+    def setUp(self):
+        self.server=ReactorServer()
+        th=threading.Thread(target=self.server.serve_forever,
+                            kwargs={ 'poll_interval' : 0.05 })
+        th.daemon=True
+        th.start()
+        self.sock=socket.create_connection(self.server.server_address)
+        self.sock.settimeout(5)
+
+    def tearDown(self):
+        self.sock.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _readReplies(self, n):
+        """Read n replies; returns their bodies."""
+        fo=self.sock.makefile("rb")
+        ret=[]
+        for i in range(n):
+            length=None
+            while True:
+                line=fo.readline().strip()
+                if line == "":
+                    break
+                if line.lower().startswith("content-length:"):
+                    length=int(line.split(":")[1])
+            ret.append(fo.read(length))
+        return ret
+
+    def testKeepAlive(self):
+        for i in range(3):
+            self.sock.sendall(request("/%d"%i, "body%d"%i))
+            self.assertEquals(self._readReplies(1), [ "/%d body%d"%(i, i) ])
+
+    def testPipelined(self):
+        self.sock.sendall(request("/a", "x")+request("/b", "y"))
+        self.assertEquals(self._readReplies(2), [ "/a x", "/b y" ])
+
+    def testSplitBody(self):
+        data=request("/split", "z"*100000)
+        self.sock.sendall(data[:10])
+        time.sleep(0.1)
+        self.sock.sendall(data[10:50000])
+        time.sleep(0.1)
+        self.sock.sendall(data[50000:])
+        self.assertEquals(self._readReplies(1), [ "/split "+"z"*100000 ])
+
+    def testIdleTimeout(self):
+        self.sock.sendall(request("/a", "x"))
+        self._readReplies(1)
+        # the connection is closed once it has been idle for a second.
+        self.assertEquals(self.sock.recv(1), "")
+
+    def testBadRequest(self):
+        conn=ReactorConnection(None, None, None)
+        self.assertRaises(ReactorError, conn.feed,
+                          "POST / HTTP/1.1\r\ncontent-length: x\r\n\r\n")
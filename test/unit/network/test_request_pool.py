@@ -0,0 +1,80 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import threading
+import time
+from cpc.network.request_pool import RequestPool, RequestPoolFullError
+
+
+class TestRequestPool(unittest.TestCase):
+
+    def testBoundedQueue(self):
+        pool=RequestPool(2, 2, 1)
+        pool.start()
+        release=threading.Event()
+        done=[]
+        def request(i):
+            release.wait()
+            done.append(i)
+        # two requests run, two wait in the queue, the fifth is rejected.
+        for i in range(2):
+            pool.submit(request, i)
+        while pool.getStats()['busy'] < 2:
+            time.sleep(0.01)
+        for i in range(2, 4):
+            pool.submit(request, i)
+        time.sleep(0.1)
+        self.assertRaises(RequestPoolFullError, pool.submit, request, 4)
+        release.set()
+        while len(done) < 4:
+            time.sleep(0.01)
+        stats=pool.getStats()
+        self.assertEquals(stats['handled'], 4)
+        self.assertEquals(stats['rejected'], 1)
+        self.assertTrue(stats['max_queue_time'] >= 0.1)
+
+    def testBulk(self):
+        pool=RequestPool(4, 8, 2)
+        pool.start()
+        lock=threading.Lock()
+        active=[0, 0]
+        def bulkRequest():
+            with pool.bulk():
+                with lock:
+                    active[0]+=1
+                    active[1]=max(active[0], active[1])
+                time.sleep(0.05)
+                with lock:
+                    active[0]-=1
+        for i in range(6):
+            pool.submit(bulkRequest)
+        while pool.getStats()['handled'] < 6 or pool.getStats()['busy'] > 0:
+            time.sleep(0.01)
+        # at most two bulk transfers ran at the same time.
+        self.assertEquals(active[1], 2)
+
+    def testLongPolls(self):
+        pool=RequestPool(4, 8, 2)
+        self.assertTrue(pool.startLongPoll())
+        self.assertTrue(pool.startLongPoll())
+        self.assertFalse(pool.startLongPoll())
+        pool.endLongPoll()
+        self.assertTrue(pool.startLongPoll())
+        self.assertEquals(pool.getStats()['long_polls_refused'], 1)
@@ -0,0 +1,175 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import hashlib
+import httplib
+import os
+import shutil
+import tarfile
+import tempfile
+from cStringIO import StringIO
+from cpc.network import server_response
+from cpc.network.server_response import ServerResponse, ChunkedWriter
+import cpc.util.log
+import cpc.util.transfer
+from cpc.network.com.connection_base import ConnectionBase
+
+
+class ChunkRecorder(object):
+    """File object that checksums what is written to it, and records the
+       largest write."""
+    def __init__(self):
+        self.hash=hashlib.sha1()
+        self.size=0
+        self.maxWrite=0
+    def write(self, data):
+        self.hash.update(data)
+        self.size+=len(data)
+        self.maxWrite=max(self.maxWrite, len(data))
+
+
+class FakeSocket(object):
+    """Socket that httplib reads a recorded response from."""
+    def __init__(self, data):
+        self.data=data
+    def makefile(self, mode, bufsize=0):
+        return StringIO(self.data)
+
+
+def readChunked(body):
+    """Decode a chunked response body the way the client does."""
+    resp=httplib.HTTPResponse(FakeSocket("HTTP/1.1 200 OK\r\n"
+                                         "Transfer-Encoding: chunked\r\n"
+                                         "\r\n"+body))
+    resp.begin()
+    return resp.read()
+
+
+class FakeConn(object):
+    """HTTP connection that answers each request with a recorded response."""
+    def __init__(self, data):
+        self.data=data
+    def request(self, method, url, body, headers):
+        pass
+    def getresponse(self):
+        resp=httplib.HTTPResponse(FakeSocket(self.data))
+        resp.begin()
+        return resp
+
+
+class FakeConnection(ConnectionBase):
+    def __init__(self, data):
+        self.conn=FakeConn(data)
+    def prepareHeaders(self, request):
+        return request
+    def handleResponseHeaders(self, response):
+        pass
+    def handleSocket(self):
+        pass
+
+
+class FakeRequest(object):
+    def __init__(self):
+        self.msg=""
+        self.headers={}
+
+
+class TestServerResponse(unittest.TestCase):
+
+    def testWriteFile(self):
+        size=5*server_response.chunkSize+123
+        tff=tempfile.TemporaryFile()
+        h=hashlib.sha1()
+        for i in range(size/1000+1):
+            data=("%999d\n"%i)[:min(1000, size-1000*i)]
+            tff.write(data)
+            h.update(data)
+        response=ServerResponse()
+        response.setFile(tff, 'application/x-tar')
+        self.assertTrue(response.isFile())
+        self.assertEquals(response.getFileSize(), size)
+        outf=ChunkRecorder()
+        response.writeFile(outf)
+        response.close()
+        tff.close()
+        self.assertEquals(outf.size, size)
+        self.assertEquals(outf.hash.hexdigest(), h.hexdigest())
+        self.assertTrue(outf.maxWrite <= server_response.chunkSize)
+
+    def testChunkedWriter(self):
+        outf=StringIO()
+        cw=ChunkedWriter(outf)
+        data=[ ("%d"%i)*(i*1000) for i in range(1, 200) ]
+        for d in data:
+            cw.write(d)
+        cw.write("")
+        self.assertEquals(cw.tell(), sum(len(d) for d in data))
+        cw.close()
+        body=outf.getvalue()
+        self.assertTrue(body.endswith("0\r\n\r\n"))
+        self.assertEquals(readChunked(body), "".join(data))
+        # an empty stream is just the last chunk
+        outf=StringIO()
+        ChunkedWriter(outf).close()
+        self.assertEquals(readChunked(outf.getvalue()), "")
+
+    def testStreamArchive(self):
+        """A tar archive written into the response stream can be read
+           back by the client, for each codec."""
+        srcdir=tempfile.mkdtemp()
+        try:
+            for i in range(10):
+                outf=open(os.path.join(srcdir, "f%d"%i), "w")
+                outf.write(("%d\n"%i)*(i*10000))
+                outf.close()
+            for codec in cpc.util.transfer.codecs:
+                response=ServerResponse()
+                def writeArchive(outf):
+                    tf=cpc.util.transfer.TarWriter(outf, codec)
+                    tf.add(srcdir, arcname=".", recursive=True)
+                    tf.close()
+                response.setStream(writeArchive, 'application/x-tar')
+                self.assertTrue(response.isStream())
+                self.assertFalse(response.isFile())
+                outf=StringIO()
+                cw=ChunkedWriter(outf)
+                response.writeStream(cw)
+                cw.close()
+                data=readChunked(outf.getvalue())
+                tf=tarfile.open(fileobj=StringIO(data), mode="r:*")
+                for i in range(10):
+                    self.assertEquals(tf.extractfile("./f%d"%i).read(),
+                                      ("%d\n"%i)*(i*10000))
+                tf.close()
+        finally:
+            shutil.rmtree(srcdir)
+
+    def testClientReadsStream(self):
+        data="".join( "%d\n"%i for i in range(100000) )
+        outf=StringIO()
+        cw=ChunkedWriter(outf)
+        cw.write(data)
+        cw.close()
+        conn=FakeConnection("HTTP/1.1 200 OK\r\n"
+                            "Content-Type: application/x-tar\r\n"
+                            "Transfer-Encoding: chunked\r\n"
+                            "\r\n"+outf.getvalue())
+        resp=conn.sendRequest(FakeRequest())
+        self.assertEquals(resp.getRawData().read(len(data)+1), data)
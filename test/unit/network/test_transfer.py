@@ -0,0 +1,170 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import os
+import sys
+import shutil
+import tarfile
+import tempfile
+import time
+import cpc.util.file
+from cpc.util import transfer
+from cpc.worker.filecache import FileCache
+from cpc.server.message.worker import SCWorkerReady
+
+
+class TestTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir=tempfile.mkdtemp()
+        self.srcDir=os.path.join(self.tmpDir, "src")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _makeRunDir(self, size):
+        """Make a run directory with a text file and a file with
+           incompressible data, both of the given size."""
+        os.makedirs(os.path.join(self.srcDir, "sub"))
+        outf=open(os.path.join(self.srcDir, "sub", "md.log"), "w")
+        line="Step %d: energy is -1234.5678\n"
+        n=0
+        while outf.tell() < size:
+            outf.write(line%n)
+            n+=1
+        outf.close()
+        outf=open(os.path.join(self.srcDir, "traj.xtc"), "wb")
+        outf.write(os.urandom(size))
+        outf.close()
+
+    def _read(self, dirname):
+        ret={}
+        for root, dirs, files in os.walk(dirname):
+            for fname in files:
+                path=os.path.join(root, fname)
+                inf=open(path, "rb")
+                ret[os.path.relpath(path, dirname)]=inf.read()
+                inf.close()
+        return ret
+
+    def _write(self, codec):
+        tff=tempfile.TemporaryFile()
+        tf=transfer.TarWriter(tff, codec)
+        tf.add(self.srcDir, arcname=".", recursive=True)
+        tf.close()
+        tff.seek(0)
+        return tff
+
+    def testRoundtrip(self):
+        self._makeRunDir(100000)
+        expected=self._read(self.srcDir)
+        for codec in transfer.codecs:
+            tff=self._write(codec)
+            if transfer.isGzip(codec):
+                # any gzip reader must be able to read it
+                tf=tarfile.open(fileobj=tff, mode="r:gz")
+                self.assertTrue("./sub/md.log" in tf.getnames())
+                tf.close()
+                tff.seek(0)
+            destDir=os.path.join(self.tmpDir, codec)
+            cpc.util.file.extractSafely(destDir, fileobj=tff)
+            tff.close()
+            self.assertEquals(self._read(destDir), expected)
+
+    def testChooseCodec(self):
+        self.assertEquals(transfer.chooseCodec(None, "tar"), "gzip")
+        self.assertEquals(transfer.chooseCodec("gzip, auto", "tar"), "gzip")
+        self.assertEquals(transfer.chooseCodec(transfer.getAcceptValue(),
+                                               "tar"), "tar")
+        self.assertEquals(transfer.chooseCodec(None, "auto"), "auto")
+        self.assertRaises(transfer.TransferCodecError,
+                          transfer.chooseCodec, None, "lzma")
+
+    def testFileCache(self):
+        self._makeRunDir(100000)
+        expected=self._read(self.srcDir)
+        cache=FileCache(os.path.join(self.tmpDir, "cache"), 250000)
+        cache.addFiles(self.srcDir, transfer.scanInputFiles(self.srcDir))
+        cachedFiles=set(cache.getHashes())
+        self.assertEquals(len(cachedFiles), 2)
+        # the server leaves out the cached files
+        tff=tempfile.TemporaryFile()
+        tf=transfer.TarWriter(tff, "auto")
+        SCWorkerReady()._addCmdDir(tf, self.srcDir, "cmd", cachedFiles)
+        tf.close()
+        tff.seek(0)
+        destDir=os.path.join(self.tmpDir, "dest")
+        cpc.util.file.extractSafely(destDir, fileobj=tff)
+        cmdDir=os.path.join(destDir, "cmd")
+        self.assertEquals(self._read(cmdDir).keys(), [transfer.manifestName])
+        restored=cache.restore(cmdDir)
+        self.assertEquals(len(restored), 2)
+        self.assertEquals(self._read(cmdDir), expected)
+        # the least recently used file is evicted
+        cache.maxSize=150000
+        self.assertEquals(len(cache.getHashes()), 1)
+
+    def testUnchangedResults(self):
+        self._makeRunDir(100000)
+        # the server's command directory, and the worker's run directory
+        cmdDir=os.path.join(self.tmpDir, "cmd")
+        shutil.copytree(self.srcDir, cmdDir)
+        inputFiles=transfer.scanInputFiles(self.srcDir)
+        # the input 'checkpoint' is renamed, and a new one written
+        os.rename(os.path.join(self.srcDir, "traj.xtc"),
+                  os.path.join(self.srcDir, "prev.xtc"))
+        outf=open(os.path.join(self.srcDir, "traj.xtc"), "wb")
+        outf.write(os.urandom(100000))
+        outf.close()
+        expected=self._read(self.srcDir)
+        tff=tempfile.TemporaryFile()
+        tf=transfer.TarWriter(tff, "auto")
+        nUnchanged=transfer.addResults(tf, self.srcDir, None, inputFiles)
+        tf.close()
+        self.assertEquals(nUnchanged, 2)
+        self.assertTrue(tff.tell() < 150000)
+        tff.seek(0)
+        transfer.extractResults(cmdDir, tff)
+        self.assertEquals(self._read(cmdDir), expected)
+
+    def testBenchmark(self):
+        """Compare archive sizes and times of the codecs. The size of the
+           files can be set with the CPC_TRANSFER_BENCHMARK_SIZE environment
+           variable."""
+        size=int(os.environ.get("CPC_TRANSFER_BENCHMARK_SIZE", "2000000"))
+        self._makeRunDir(size)
+        results=[]
+        for codec in transfer.codecs:
+            startTime=time.time()
+            tff=self._write(codec)
+            writeTime=time.time()-startTime
+            tff.seek(0, os.SEEK_END)
+            tarSize=tff.tell()
+            tff.seek(0)
+            startTime=time.time()
+            cpc.util.file.extractSafely(os.path.join(self.tmpDir, codec),
+                                        fileobj=tff)
+            readTime=time.time()-startTime
+            tff.close()
+            results.append( (codec, tarSize, writeTime, readTime) )
+        sys.stderr.write("\nTransfer codec benchmark (2x%d bytes):\n"%size)
+        for codec, tarSize, writeTime, readTime in results:
+            sys.stderr.write("  %-9s: %9d bytes, write %.3f s, read %.3f s\n"%
+                             (codec, tarSize, writeTime, readTime))
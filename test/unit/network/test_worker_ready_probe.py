@@ -0,0 +1,78 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import time
+from cpc.server.message import worker
+
+
+class FakeNode(object):
+    def __init__(self, nodeId, delay, hasWork):
+        self.nodeId=nodeId
+        self.delay=delay
+        self.hasWork=hasWork
+    def getId(self):
+        return self.nodeId
+
+
+def fakeProbeNode(node, workerData, topology, timeout, answers):
+    time.sleep(node.delay)
+    answers.put( (node, node.hasWork) )
+
+
+class TestProbeNodes(unittest.TestCase):
+
+    def setUp(self):
+        self.origProbeNode=worker._probeNode
+        worker._probeNode=fakeProbeNode
+
+    def tearDown(self):
+        worker._probeNode=self.origProbeNode
+
+    def testOrder(self):
+        nodes=[ FakeNode("slow", 0.4, True),
+                FakeNode("fast", 0.05, True),
+                FakeNode("empty", 0, False),
+                FakeNode("old", 0, None),
+                FakeNode("hung", 10, True) ]
+        startTime=time.time()
+        found=worker.probeNodes(nodes, "", None, 1)
+        # the first server with work is found without waiting for the rest
+        node, hasWork=found.next()
+        self.assertEquals( (node.getId(), hasWork), ("fast", True) )
+        self.assertTrue(time.time()-startTime < 0.3)
+        # servers that don't know probes are asked last; hung servers are
+        # skipped
+        self.assertEquals([ (node.getId(), hasWork) for node, hasWork in
+                            found ],
+                          [ ("slow", True), ("old", None) ])
+        self.assertTrue(time.time()-startTime < 2)
+
+    def testLateCaller(self):
+        nodes=[ FakeNode("fast", 0, True),
+                FakeNode("slow", 0.2, True),
+                FakeNode("old", 0.2, None),
+                FakeNode("hung", 10, True) ]
+        found=worker.probeNodes(nodes, "", None, 0.5)
+        self.assertEquals(found.next()[0].getId(), "fast")
+        # forwarding to the first server took longer than the timeout:
+        # the answers that came in meanwhile are still used.
+        time.sleep(0.8)
+        self.assertEquals([ node.getId() for node, hasWork in found ],
+                          [ "slow", "old" ])
@@ -0,0 +1,164 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+# 
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published 
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import threading
+import time
+from cpc.server.queue.cmdqueue import CmdQueue, QueueableItem, QueueError
+
+
+class FakeTask(object):
+    def __init__(self, project, priority=0):
+        self.project=project
+        self.priority=priority
+
+class FakeCommand(QueueableItem):
+    def __init__(self, id, project, executable, priority=0):
+        QueueableItem.__init__(self)
+        self.id=id
+        self.task=FakeTask(project, priority)
+        self.executable=executable
+
+    def tryGenID(self):
+        pass
+
+    def getFullPriority(self):
+        return self.task.priority
+
+
+class TestCmdQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = CmdQueue()
+        self.cmds = []
+        for i in range(10):
+            cmd=FakeCommand("cmd%d"%i, "proj%d"%(i%2), "exe%d"%(i%3), 
+                            priority=i%3)
+            self.cmds.append(cmd)
+            self.queue.add(cmd)
+
+    def testPriorityOrder(self):
+        got=[]
+        cmd=self.queue.get()
+        while cmd is not None:
+            got.append(cmd)
+            cmd=self.queue.get()
+        prios=[ c.getFullPriority() for c in got ]
+        self.assertEquals(prios, sorted(prios, reverse=True))
+        # FIFO order within a single priority
+        self.assertEquals([ c.id for c in got if c.getFullPriority() == 0 ],
+                          [ "cmd0", "cmd3", "cmd6", "cmd9" ])
+        self.assertEquals(self.queue.getSize(), 0)
+
+    def testRemoveExists(self):
+        self.assertTrue(self.queue.exists("cmd4"))
+        self.queue.remove(self.cmds[4])
+        self.assertFalse(self.queue.exists("cmd4"))
+        self.assertEquals(self.queue.getSize(), 9)
+        self.assertRaises(QueueError, self.queue.remove, self.cmds[4])
+        self.assertTrue(self.cmds[4] not in self.queue.list())
+
+    def testGetUntilKeepsOrder(self):
+        def takeExe1(parm, cmd):
+            return (True, cmd.executable == "exe1")
+        got=self.queue.getUntil(takeExe1, None)
+        self.assertEquals(sorted([ c.id for c in got ]), 
+                          [ "cmd1", "cmd4", "cmd7" ])
+        self.assertEquals([ c.id for c in self.queue.list() ],
+                          [ "cmd2", "cmd5", "cmd8", "cmd0", "cmd3", "cmd6", 
+                            "cmd9" ])
+        self.assertEquals(self.queue.listByExecutable("exe1"), [])
+
+    def testInactive(self):
+        self.cmds[2].deactivate()
+        self.assertEquals(self.queue.get(), self.cmds[5])
+        self.assertTrue(self.queue.exists("cmd2"))
+        self.assertEquals(self.queue.getSize(), 8)
+        self.cmds[2].activate()
+        self.assertEquals(self.queue.getSize(), 9)
+        self.assertEquals(self.queue.get(), self.cmds[8])
+        self.assertEquals(self.queue.get(), self.cmds[2])
+
+    def testDeleteByProject(self):
+        self.cmds[3].deactivate()
+        self.queue.get()
+        self.assertEquals(len(self.queue.listByProject("proj1")), 5)
+        self.assertEquals(self.queue.deleteByProject("proj1"), 5)
+        self.assertEquals(self.queue.listByProject("proj1"), [])
+        self.assertFalse(self.queue.exists("cmd3"))
+        for cmd in self.queue.list():
+            self.assertEquals(cmd.task.project, "proj0")
+
+    def testGetUntilBuckets(self):
+        def selectExe2(parm, key):
+            parm.append(key)
+            return key[0] == "exe2"
+        def takeAll(parm, cmd):
+            return (True, True)
+        keys=[]
+        got=self.queue.getUntilBuckets(selectExe2, takeAll, keys)
+        self.assertEquals(len(keys), 6)
+        self.assertEquals(sorted([ c.id for c in got ]), 
+                          [ "cmd2", "cmd5", "cmd8" ])
+        self.assertEquals(self.queue.getSize(), 7)
+        self.assertEquals(len(self.queue.buckets), 4)
+
+    def testGetUntilBucketsKeepsOrder(self):
+        def selectAll(parm, key):
+            return True
+        def takeAll(parm, cmd):
+            parm.append(cmd.id)
+            return (True, True)
+        # re-queueing an item puts it at the back of its priority
+        self.queue.add(self.cmds[2])
+        expected=[ cmd.id for cmd in 
+                   sorted(self.cmds, key=lambda cmd: -cmd.task.priority) 
+                   if cmd is not self.cmds[2] ]
+        expected.insert(expected.index("cmd8")+1, "cmd2")
+        seen=[]
+        got=self.queue.getUntilBuckets(selectAll, takeAll, seen)
+        self.assertEquals(seen, expected)
+        self.assertEquals([ c.id for c in got ], expected)
+        self.assertEquals(self.queue.getSize(), 0)
+
+    def testHasBuckets(self):
+        def selectExe(parm, key):
+            return key[0] == parm
+        self.assertTrue(self.queue.hasBuckets(selectExe, "exe2"))
+        self.assertFalse(self.queue.hasBuckets(selectExe, "exe3"))
+        for cmd in self.cmds:
+            if cmd.executable == "exe2":
+                cmd.deactivate()
+        self.assertFalse(self.queue.hasBuckets(selectExe, "exe2"))
+        # nothing was taken from the queue
+        self.assertEquals(len(self.queue.listByExecutable("exe2")), 3)
+
+    def testWaitForAdd(self):
+        addCount=self.queue.getAddCount()
+        self.assertEquals(self.queue.waitForAdd(addCount, 0.01), addCount)
+        cmd=FakeCommand("cmd10", "proj0", "exe0")
+        th=threading.Timer(0.05, self.queue.add, (cmd,))
+        startTime=time.time()
+        th.start()
+        newAddCount=self.queue.waitForAdd(addCount, 10)
+        self.assertEquals(newAddCount, addCount+1)
+        self.assertTrue(time.time()-startTime < 5)
+        # an add that already happened doesn't block
+        self.assertEquals(self.queue.waitForAdd(addCount, 10), newAddCount)
+        th.join()
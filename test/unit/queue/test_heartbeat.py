@@ -0,0 +1,165 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import time
+from cpc.util.conf.server_conf import ServerConf
+from cpc.command.heartbeat.item import HeartbeatItem
+from cpc.server.queue.cmdqueue import CmdQueue
+import cpc.server.state.heartbeat
+from cpc.server.state.heartbeat import RunningCmdList, WorkerDataList
+from test.unit.queue.test_cmdqueue import FakeCommand
+
+
+class FakeRunningCommand(FakeCommand):
+    def __init__(self, id, project, executable, priority=0):
+        FakeCommand.__init__(self, id, project, executable, priority)
+        self.running=False
+        self.workerServer=None
+
+    def setRunning(self, running, workerServer=None):
+        self.running=running
+        self.workerServer=workerServer
+
+
+class TestRunningCmdList(unittest.TestCase):
+
+    def setUp(self):
+        self.confDir=tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.confDir, "server"))
+        open(os.path.join(self.confDir, "server", "server.conf"), "w").close()
+        self.conf=ServerConf(confdir=self.confDir)
+        # the configuration is shared between tests
+        self.conf.set("heartbeat_file",
+                      os.path.join(self.confDir, "heartbeatlist.xml"))
+
+    def tearDown(self):
+        shutil.rmtree(self.confDir)
+
+    def _makeList(self, nCmds):
+        cmdQueue=CmdQueue()
+        cmds=[]
+        for i in range(nCmds):
+            cmd=FakeRunningCommand("cmd%d"%i, "proj", "exe")
+            cmdQueue.add(cmd)
+            cmds.append(cmd)
+        return RunningCmdList(self.conf, cmdQueue, WorkerDataList()), cmds
+
+    def testRestore(self):
+        rcl, cmds=self._makeList(4)
+        for cmd in cmds:
+            rcl.cmdQueue.remove(cmd)
+        rcl.add(cmds[:2], "server1", 60)
+        rcl.writeState()
+        # these are only in the journal
+        rcl.add(cmds[2:], "server2", 120)
+        rcl.remove(cmds[0])
+
+        rcl2, cmds2=self._makeList(0)
+        rcl2.readState()
+        # the commands as they are read in with their project states
+        cmds2=[ FakeRunningCommand("cmd%d"%i, "proj", "exe")
+                for i in range(4) ]
+        for cmd in cmds2:
+            if not rcl2.restore(cmd):
+                rcl2.cmdQueue.add(cmd)
+        rcl2.finishRestore()
+        running=sorted(cmd.id for cmd in rcl2.getCmdList())
+        self.assertEquals(running, [ "cmd1", "cmd2", "cmd3" ])
+        self.assertEquals(rcl2.cmdQueue.find("cmd0"), cmds2[0])
+        self.assertEquals(rcl2.cmdQueue.find("cmd1"), None)
+        self.assertTrue(cmds2[3].running)
+        self.assertEquals(cmds2[3].workerServer, "server2")
+        self.assertEquals(rcl2.runningCommands["cmd1"].getHeartbeatInterval(),
+                          60)
+
+    def testBeforeRestore(self):
+        rcl, cmds=self._makeList(2)
+        for cmd in cmds:
+            rcl.cmdQueue.remove(cmd)
+        rcl.add(cmds, "server1", 60)
+
+        rcl2, cmds2=self._makeList(0)
+        rcl2.readState()
+        # heartbeats for commands whose projects haven't been read yet are
+        # answered, and their data is used when they are restored.
+        items=[ HeartbeatItem("cmd0", "server1", "/run/cmd0") ]
+        faulty=[]
+        self.assertTrue(rcl2.ping("worker1", "/run", 0, items, False, faulty))
+        self.assertEquals(faulty, [])
+        self.assertEquals(items[0].getState(), HeartbeatItem.stateOK)
+        # finished commands wait until they are restored.
+        restored=[]
+        def finish():
+            rcl2.waitForRestore("cmd0")
+            restored.append(rcl2.runningCommands["cmd0"])
+        th=threading.Thread(target=finish)
+        th.start()
+        time.sleep(0.1)
+        self.assertEquals(restored, [])
+        cmd0=FakeRunningCommand("cmd0", "proj", "exe")
+        self.assertTrue(rcl2.restore(cmd0))
+        th.join(5)
+        self.assertEquals(restored[0].getWorkerID(), "worker1")
+        self.assertEquals(restored[0].getRunDir(), "/run/cmd0")
+        # commands that weren't restored are unknown once restoring is done.
+        rcl2.finishRestore()
+        rcl2.waitForRestore("cmd1")
+        items=[ HeartbeatItem("cmd1", "server1", "/run/cmd1") ]
+        self.assertFalse(rcl2.ping("worker1", "/run", 0, items, False,
+                                   faulty))
+        self.assertEquals(faulty, [ "cmd1" ])
+
+    def testJournalOutsideLock(self):
+        rcl, cmds=self._makeList(3)
+        for cmd in cmds:
+            rcl.cmdQueue.remove(cmd)
+        rcl.writeState()
+        locked=[]
+        def recordingOpen(filename, mode='r'):
+            if filename == rcl.journalFilename:
+                locked.append(rcl.lock.locked())
+            return open(filename, mode)
+        cpc.server.state.heartbeat.open=recordingOpen
+        try:
+            rcl.add(cmds[:1], "server1", 60)
+            rcl.add(cmds[1:], "server1", 60)
+            rcl.remove(cmds[1])
+        finally:
+            del cpc.server.state.heartbeat.open
+        # the journal is appended to without holding the list's lock
+        self.assertEquals(locked, [ False, False, False ])
+        inf=open(rcl.journalFilename)
+        journal=inf.read()
+        inf.close()
+        self.assertTrue(journal.index('"cmd0"') < journal.index('"cmd2"') <
+                        journal.index('<removed-command cmd_id="cmd1"/>'))
+
+    def testDispatchLatency(self):
+        rcl, cmds=self._makeList(2)
+        for cmd in cmds:
+            rcl.cmdQueue.remove(cmd)
+        rcl.add(cmds, "server1", 60)
+        stats=rcl.getDispatchStats()
+        self.assertEquals(stats['commands'], 2)
+        self.assertTrue(stats['max_latency'] >= stats['mean_latency'] >= 0)
@@ -0,0 +1,106 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import json
+import threading
+from cpc.server.state.heartbeat_forward import HeartbeatForwarder
+
+
+class FakeConf(object):
+    def __init__(self, window):
+        self.window=window
+    def getHeartbeatForwardWindow(self):
+        return self.window
+
+
+class FakeResponse(object):
+    """Stands in for a client response with a JSON body."""
+    def __init__(self, status, data):
+        self.content_type="text/json"
+        self.message=FakeMessage(json.dumps([ { 'status' : status,
+                                                'message' : '',
+                                                'data' : data } ]))
+
+
+class FakeMessage(object):
+    def __init__(self, body):
+        self.body=body
+    def __len__(self):
+        return len(self.body)
+    def read(self, size):
+        return self.body
+
+
+class RecordingForwarder(HeartbeatForwarder):
+    """Answers forwarded heartbeats with the command IDs of the items in
+       their XML as faulty, and records the requests."""
+    def __init__(self, window, batchStatus="OK"):
+        HeartbeatForwarder.__init__(self, FakeConf(window))
+        self.batchStatus=batchStatus
+        self.requests=[]
+
+    def _batchRequest(self, dest, workerServer, heartbeats):
+        self.requests.append( (dest, len(heartbeats)) )
+        return FakeResponse(self.batchStatus,
+                            [ [ hb['heartbeat_items'] ] for hb in heartbeats ])
+
+    def _singleRequest(self, dest, workerServer, heartbeat):
+        self.requests.append( (dest, 1) )
+        return FakeResponse("ERROR", [ heartbeat['heartbeat_items'] ])
+
+
+class TestHeartbeatForwarder(unittest.TestCase):
+
+    def _forwardAll(self, forwarder, nWorkers):
+        results=dict()
+        def forward(i):
+            results[i]=forwarder.forward("server-b", "server-a",
+                                         "worker%d"%i, "/tmp/worker%d"%i,
+                                         "none", "cmd%d"%i)
+        threads=[ threading.Thread(target=forward, args=(i,))
+                  for i in range(nWorkers) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def testBatch(self):
+        forwarder=RecordingForwarder(0.5)
+        results=self._forwardAll(forwarder, 10)
+        self.assertEquals(forwarder.requests, [ ("server-b", 10) ])
+        # every worker gets its own faulty items back
+        for i in range(10):
+            self.assertEquals(results[i], [ "cmd%d"%i ])
+        self.assertEquals(forwarder.getStats(), { 'heartbeats' : 10,
+                                                  'requests' : 1 })
+
+    def testFallback(self):
+        # older servers don't know the batch request
+        forwarder=RecordingForwarder(0.5, "ERROR")
+        results=self._forwardAll(forwarder, 3)
+        self.assertEquals(len(forwarder.requests), 4)
+        for i in range(3):
+            self.assertEquals(results[i], [ "cmd%d"%i ])
+
+    def testNoWindow(self):
+        forwarder=RecordingForwarder(0)
+        results=self._forwardAll(forwarder, 3)
+        self.assertEquals(forwarder.requests, [ ("server-b", 1) ]*3)
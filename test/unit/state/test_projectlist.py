@@ -0,0 +1,140 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import time
+from cStringIO import StringIO
+from cpc.util.conf.server_conf import ServerConf
+from cpc.server.queue.cmdqueue import CmdQueue
+from cpc.server.state.projectlist import ProjectList
+from cpc.server.state.heartbeat import RunningCmdList, WorkerDataList
+
+
+class FakeServerState(object):
+    def __init__(self, conf, cmdQueue):
+        self.runningCmdList=RunningCmdList(conf, cmdQueue, WorkerDataList())
+    def getRunningCmdList(self):
+        return self.runningCmdList
+
+
+class TestProjectList(unittest.TestCase):
+
+    def setUp(self):
+        self.confDir=tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.confDir, "server"))
+        open(os.path.join(self.confDir, "server", "server.conf"), "w").close()
+        self.conf=ServerConf(confdir=self.confDir)
+        self.conf.execBasedir=os.path.abspath(
+                        os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+        self.conf.set("run_dir", os.path.join(self.confDir, "run"))
+        # the configuration is shared between tests
+        self.conf.set("project_file",
+                      os.path.join(self.confDir, "projects.xml"))
+        self.conf.set("heartbeat_file",
+                      os.path.join(self.confDir, "heartbeatlist.xml"))
+
+    def tearDown(self):
+        shutil.rmtree(self.confDir)
+
+    def testLazyLoad(self):
+        pl=ProjectList(self.conf, CmdQueue())
+        for name in [ "active", "dormant" ]:
+            pl.add(name)
+            prj=pl.get(name)
+            prj.importName("int")
+            prj.addInstance("a", "int::add")
+        prj=pl.get("active")
+        prj.scheduleSet("a:in.a", "1", StringIO())
+        prj.scheduleSet("a:in.b", "2", StringIO())
+        prj.activate("a")
+        self.assertEquals(prj.getTaskCount(), 1)
+        pl.saveState(self.conf.getProjectFile())
+
+        cmdQueue=CmdQueue()
+        pl2=ProjectList(self.conf, cmdQueue)
+        pl2.readState(FakeServerState(self.conf, cmdQueue),
+                      self.conf.getProjectFile())
+        self.assertEquals(sorted(pl2.list()), [ "active", "dormant" ])
+        self.assertFalse(pl2.isLoaded("active"))
+        self.assertFalse(pl2.isLoaded("dormant"))
+        pl2.loadActive(0)
+        self.assertTrue(pl2.isLoaded("active"))
+        self.assertFalse(pl2.isLoaded("dormant"))
+        self.assertEquals(pl2.getTaskQueue().getStats()['projects'],
+                          { "active" : 1 })
+        # unread projects are left alone when saving
+        pl2.saveState(self.conf.getProjectFile())
+        prj=pl2.get("dormant")
+        self.assertTrue(pl2.isLoaded("dormant"))
+        self.assertEquals(prj.getNamedInstance("a").getName(), "a")
+
+    def _makeProjects(self, nProjects, nInstances):
+        pl=ProjectList(self.conf, CmdQueue())
+        for i in range(nProjects):
+            name="prj%d"%i
+            pl.add(name)
+            prj=pl.get(name)
+            prj.importName("int")
+            outf=StringIO()
+            for j in range(nInstances):
+                prj.addInstance("add_%d"%j, "int::add")
+                prj.scheduleSet("add_%d:in.a"%j, "%d"%j, outf)
+            prj.scheduleSet("add_0:in.b", "1", outf)
+            # one task makes the project active
+            prj.activate("add_0")
+        pl.saveState(self.conf.getProjectFile())
+
+    def _loadProjects(self, nThreads):
+        cmdQueue=CmdQueue()
+        pl=ProjectList(self.conf, cmdQueue)
+        pl.readState(FakeServerState(self.conf, cmdQueue),
+                     self.conf.getProjectFile())
+        done=threading.Event()
+        startTime=time.time()
+        pl.loadActive(nThreads, done.set)
+        done.wait(60)
+        self.assertTrue(done.isSet())
+        return pl, time.time()-startTime
+
+    def testLoadTimes(self):
+        """Read project states in load threads and check the reported load
+           times. The number of projects and instances per project can be
+           set with the CPC_LOAD_BENCHMARK_PROJECTS and
+           CPC_LOAD_BENCHMARK_SIZE environment variables."""
+        nProjects=int(os.environ.get("CPC_LOAD_BENCHMARK_PROJECTS", "4"))
+        nInstances=int(os.environ.get("CPC_LOAD_BENCHMARK_SIZE", "50"))
+        self._makeProjects(nProjects, nInstances)
+        sys.stderr.write("\nProject load benchmark (%d projects, %d instances):\n"%
+                         (nProjects, nInstances))
+        for nThreads in [ 0, nProjects ]:
+            pl, loadTime=self._loadProjects(nThreads)
+            stats=pl.getLoadStats()
+            self.assertEquals(stats['unloaded'], 0)
+            self.assertTrue(stats['active_load_time'] <= loadTime)
+            self.assertEquals(len(stats['projects']), nProjects)
+            for times in stats['projects'].itervalues():
+                self.assertTrue(times['read_time'] >= 0)
+            self.assertEquals(pl.get("prj0").getNamedValue("add_0:in.b").value,
+                              1)
+            sys.stderr.write("  %d threads: %.3f s\n"%(nThreads, loadTime))
@@ -0,0 +1,72 @@
+# This file is part of Copernicus
+# http://www.copernicus-computing.org/
+#
+# Copyright (C) 2011, Sander Pronk, Iman Pouya, Erik Lindahl, and others.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+import copy
+import threading
+import time
+from cpc.command.platform import Platform
+from cpc.command.resource import Resource
+from cpc.worker import worker
+
+
+class FakeResponse(object):
+    def __init__(self):
+        self.headers={ 'worker-ready-max-wait' : '30' }
+
+
+class TestWorkerPoll(unittest.TestCase):
+
+    def setUp(self):
+        # a worker with only the state that the long-poll handling needs
+        self.worker=worker.Worker.__new__(worker.Worker)
+        platform=Platform("smp", "x86_64", False)
+        platform.addMaxResource(Resource("cores", 4))
+        self.worker.remainingPlatforms=[ platform ]
+        self.worker.runCondVar=threading.Condition()
+        self.worker.pollThread=None
+        self.worker.pollStartTime=None
+        self.worker.pollOffer=None
+        self.worker.pollResults=[]
+        self.worker.abandonedPolls=dict()
+        self.worker.longPoll=True
+        self.worker.batchFinished=False
+
+    def _getOfferedCores(self):
+        return self.worker._getOfferedPlatforms()[0].getMaxResource("cores")
+
+    def testAbandonedPollResources(self):
+        wk=self.worker
+        thread=object()
+        wk.pollThread=thread
+        wk.pollOffer=copy.deepcopy(wk._getOfferedPlatforms())
+        wk.pollStartTime=time.time()-worker.longPollTime-worker.longPollMargin
+        with wk.runCondVar:
+            wk._waitForPoll()
+        self.assertTrue(wk.pollThread is None)
+        # the abandoned poll's resources can't be offered again
+        self.assertEquals(self._getOfferedCores(), 0)
+        self.assertFalse(wk._haveRemainingResources())
+        self.assertEquals(wk.remainingPlatforms[0].getMaxResource("cores"), 4)
+        # until its late response is taken
+        resp=FakeResponse()
+        wk.pollResults.append( (thread, resp, None) )
+        self.assertTrue(wk._takePollResponse() is resp)
+        self.assertEquals(self._getOfferedCores(), 4)
+        self.assertTrue(wk._haveRemainingResources())